@@ -1,25 +1,58 @@
 from flask import Flask
 from flask_cors import CORS
-from .config import Config, DevelopmentConfig
+from werkzeug.middleware.proxy_fix import ProxyFix
+from .config import Config, DevelopmentConfig, config_from_env
+from .json_provider import create_json_provider
 
 
 def create_app(config: Config = DevelopmentConfig()):
     app = Flask(__name__)
     app.config.from_object(config)
+    app.json = create_json_provider(app, app.config["JSON_PROVIDER"])
     CORS(app, resources={r"/api/*": {"origins": "*"}})
+    if app.config["PROXY_FIX_X_FOR"] > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_FIX_X_FOR"])
 
-    from .jwt import jwt
+    from .jwt import jwt, identity_cache
     from .db import db
+    from .pool import pool_monitor
     from . import book
     from . import auth
     from . import admin
-    from .tasks import procrastinate_app
+    from .migrate import apply_migrations, migrate_command
+    from .availability import availability_cache
+    from .availability_feed import availability_feed
+    from .passwords import password_hasher
+    from .ratelimit import login_rate_limiter
+    from .outbox import outbox_relay
+    from .emails import email_sender
+    from .tasks import job_queue_monitor
+    from .retry import transaction_retrier
 
     jwt.init_app(app)
+    identity_cache.init_app(app)
     db.init_app(app)
+    with app.app_context():
+        pool_monitor.init_app(app, db.engine)
+    availability_cache.init_app(app)
+    availability_feed.init_app(app)
+    password_hasher.init_app(app)
+    login_rate_limiter.init_app(app)
+    outbox_relay.init_app(app)
+    email_sender.init_app(app)
+    job_queue_monitor.init_app(app)
+    transaction_retrier.init_app(app)
+    app.cli.add_command(migrate_command)
+    if app.config["MIGRATE_ON_STARTUP"]:
+        with app.app_context():
+            apply_migrations()
     app.register_blueprint(book.bp)
     app.register_blueprint(auth.bp)
     app.register_blueprint(admin.bp)
-    procrastinate_app.open()
 
     return app
+
+
+# Run by gunicorn, e.g. gunicorn 'app:create_app_from_env()'
+def create_app_from_env():
+    return create_app(config_from_env())
@@ -1,14 +1,27 @@
-from flask import Blueprint, request, jsonify, Response
-from flask_jwt_extended import jwt_required, get_current_user
+from flask import (
+    Blueprint,
+    request,
+    jsonify,
+    Response,
+    current_app,
+    stream_with_context,
+)
+from flask_jwt_extended import jwt_required, get_current_user, get_jwt
 from .user import User
 from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 from .db import db
-from psycopg.errors import SerializationFailure
 from functools import wraps
 from .validate import validate_date, validate_hour_24, validate_capacity
-import time
+from .availability import availability_cache
+from .metrics import collect_metrics
+from .json_provider import JSONFragment
+from .tasks import send_time_slot_removed_emails_task
+from .outbox import enqueue
+from .retry import transaction_retrier
+from .etag import make_etag, not_modified, with_etag, get_availability_version
+from datetime import date, timedelta
 
-TRANSACTION_RETRY_AMOUNT = 3
 
 bp = Blueprint("admin", __name__, url_prefix="/api/admin")
 
@@ -21,33 +34,8 @@ def role_required(role: str):
             if user is None:
                 return Response(response="User not logged in!", status=401)
 
-            record = (
-                db.session.execute(
-                    text(
-                        """
-                        SELECT COUNT(*) > 0 AS user_has_role
-                        FROM Users u
-                        INNER JOIN UserRoles ur
-                            ON u.userID = ur.userID
-                        WHERE u.userID = :user_id
-                          AND ur.userRole = :role;
-                        """
-                    ),
-                    {"user_id": user.user_id, "role": role},
-                )
-                .mappings()
-                .fetchone()
-            )
-
-            if record is None:
-                return Response(response="Error checking user permissions", status=500)
-
-            user_has_role = record.get("user_has_role")
-
-            if user_has_role is None:
-                return Response(response="Error checking user permissions", status=500)
-
-            if not user_has_role:
+            # Roles are signed into the access token at login, so checking them doesn't touch the database
+            if role not in get_jwt().get("roles", []):
                 return Response(
                     response="Permission denied",
                     status=401,
@@ -110,46 +98,227 @@ def add_appointment_time_slot():
     if not validate_capacity(capacity):
         return Response(response=f"Invalid capacity: {capacity}", status=400)
 
-    appointment_exists_record = (
+    # The unique index on (date, hour24) stands in for checking whether the slot exists first
+    record = (
         db.session.execute(
             text(
                 """
-                SELECT COUNT(*) > 0 AS appointment_exists
-                FROM AppointmentTimeSlots
-                WHERE date = :date
-                  AND hour24 = :hour_24;
+                INSERT INTO AppointmentTimeSlots
+                (date, hour24, capacity)
+                VALUES
+                (:date, :hour_24, :capacity)
+                ON CONFLICT (date, hour24) DO NOTHING
+                RETURNING appointmentID AS appointment_id;
                 """
             ),
-            {"date": date, "hour_24": hour_24},
+            {"date": date, "hour_24": hour_24, "capacity": capacity},
         )
         .mappings()
         .fetchone()
     )
 
-    if appointment_exists_record is None:
-        return Response("Failed to add appointment time slot", status=500)
+    if record is None:
+        db.session.rollback()
+        return Response("Appointment time slot already exists", status=409)
 
-    appointment_exists = appointment_exists_record.get("appointment_exists")
-    if appointment_exists is None:
-        return Response("Failed to add appointment time slot", status=500)
+    db.session.commit()
+    availability_cache.invalidate(date)
+    return jsonify({"message": "Successfully added appointment time slot"})
 
-    if appointment_exists:
-        return Response("Appointment time slot already exists", status=409)
 
-    db.session.execute(
-        text(
-            """
-            INSERT INTO AppointmentTimeSlots
-            (date, hour24, capacity)
-            VALUES
-            (:date, :hour_24, :capacity);
-            """
-        ),
-        {"date": date, "hour_24": hour_24, "capacity": capacity},
+def is_int(value) -> bool:
+    # JSON true and false come through as bools, which are ints to isinstance
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Counts the days from start_date up to but not including end_date that fall on one of the weekdays (0 is Monday),
+# without stepping through them
+def count_recurrence_days(start_date: date, end_date: date, weekdays: set[int]) -> int:
+    days = max((end_date - start_date).days, 0)
+    full_weeks, remaining_days = divmod(days, 7)
+    return full_weeks * len(weekdays) + sum(
+        1 for offset in range(remaining_days) if (start_date.weekday() + offset) % 7 in weekdays
     )
 
+
+# Expands a recurrence of weekdays (0 is Monday) and hours over the days from start_date up to but not including
+# end_date
+def expand_time_slot_recurrence(
+    start_date: date,
+    end_date: date,
+    weekdays: set[int],
+    hours: list[int],
+) -> list[tuple[date, int]]:
+    time_slots = []
+    day = start_date
+    while day < end_date:
+        if day.weekday() in weekdays:
+            for hour_24 in hours:
+                time_slots.append((day, hour_24))
+        day += timedelta(days=1)
+
+    return time_slots
+
+
+# The number of time slots is worked out before the recurrence is expanded, so a recurrence spanning centuries is
+# turned away without building a slot for each of its hours
+def parse_time_slot_recurrence(
+    recurrence: dict, max_time_slots: int, max_hour_ranges: int
+) -> list[tuple[date, int, int]] | str:
+    for key in ("start_date", "end_date", "weekdays", "hour_ranges", "capacity"):
+        if not key in recurrence:
+            return f"{key} not present in recurrence"
+
+    start_date: date
+    end_date: date
+    try:
+        start_date = date.fromisoformat(recurrence["start_date"])
+        end_date = date.fromisoformat(recurrence["end_date"])
+    except (TypeError, ValueError):
+        return "Start or end date does not exist"
+
+    weekdays = recurrence["weekdays"]
+    if not isinstance(weekdays, list) or not all(
+        is_int(weekday) and 0 <= weekday <= 6 for weekday in weekdays
+    ):
+        return f"Invalid weekdays: {weekdays}"
+
+    hour_ranges = recurrence["hour_ranges"]
+    if not isinstance(hour_ranges, list) or len(hour_ranges) > max_hour_ranges:
+        return f"hour_ranges must be a list of at most {max_hour_ranges} ranges"
+    if not all(
+        isinstance(hour_range, list)
+        and len(hour_range) == 2
+        and all(is_int(hour_24) for hour_24 in hour_range)
+        and 0 <= hour_range[0] < hour_range[1] <= 24
+        for hour_range in hour_ranges
+    ):
+        return f"Invalid hour_ranges: {hour_ranges}"
+
+    capacity = recurrence["capacity"]
+    if not validate_capacity(capacity):
+        return f"Invalid capacity: {capacity}"
+
+    # Overlapping ranges and repeated weekdays would only add the same slots again
+    weekday_set = set(weekdays)
+    hours = sorted({hour_24 for start_hour, end_hour in hour_ranges for hour_24 in range(start_hour, end_hour)})
+    if count_recurrence_days(start_date, end_date, weekday_set) * len(hours) > max_time_slots:
+        return f"At most {max_time_slots} time slots can be added at once"
+
+    return [
+        (day, hour_24, int(capacity))
+        for day, hour_24 in expand_time_slot_recurrence(start_date, end_date, weekday_set, hours)
+    ]
+
+
+def parse_time_slot_list(time_slots: list) -> list[tuple[date, int, int]] | str:
+    parsed = []
+    for time_slot in time_slots:
+        if not isinstance(time_slot, dict):
+            return f"Invalid time slot: {time_slot}"
+
+        time_slot_date = time_slot.get("date")
+        if not validate_date(time_slot_date):
+            return f"Invalid date: {time_slot_date}"
+        try:
+            time_slot_date = date.fromisoformat(time_slot_date)
+        except ValueError:
+            return f"Invalid date: {time_slot_date}"
+
+        hour_24 = time_slot.get("hour_24")
+        if not validate_hour_24(hour_24):
+            return f"Invalid hour_24: {hour_24}"
+
+        capacity = time_slot.get("capacity")
+        if not validate_capacity(capacity):
+            return f"Invalid capacity: {capacity}"
+
+        parsed.append((time_slot_date, int(hour_24), int(capacity)))
+
+    return parsed
+
+
+@bp.post("/add_appointment_time_slots")
+@jwt_required()
+@role_required("admin")
+def add_appointment_time_slots():
+    json: dict | None = request.get_json()
+
+    if json is None:
+        return Response(
+            response="Didn't send JSON to add_appointment_time_slots POST request",
+            status=400,
+        )
+    if ("time_slots" in json) == ("recurrence" in json):
+        return Response(
+            response="Exactly one of time_slots or recurrence must be present in add_appointment_time_slots POST request",
+            status=400,
+        )
+
+    max_time_slots = current_app.config["ADMIN_MAX_BULK_TIME_SLOTS"]
+    time_slots: list[tuple[date, int, int]] | str
+    if "time_slots" in json:
+        if not isinstance(json["time_slots"], list):
+            return Response(response="time_slots must be a list", status=400)
+        time_slots = parse_time_slot_list(json["time_slots"])
+    else:
+        if not isinstance(json["recurrence"], dict):
+            return Response(response="recurrence must be an object", status=400)
+        time_slots = parse_time_slot_recurrence(
+            json["recurrence"], max_time_slots, current_app.config["ADMIN_MAX_RECURRENCE_HOUR_RANGES"]
+        )
+
+    if isinstance(time_slots, str):
+        return Response(response=time_slots, status=400)
+
+    # Later entries for the same hour are dropped, the same as if they had been sent as separate requests
+    unique_time_slots: dict[tuple[date, int], int] = dict()
+    for time_slot_date, hour_24, capacity in time_slots:
+        unique_time_slots.setdefault((time_slot_date, hour_24), capacity)
+
+    if len(unique_time_slots) > max_time_slots:
+        return Response(
+            response=f"At most {max_time_slots} time slots can be added at once",
+            status=400,
+        )
+
+    created_dates: list[date] = []
+    if len(unique_time_slots) > 0:
+        # Every slot goes in with one statement, with the columns sent as arrays and zipped back together by unnest
+        records = (
+            db.session.execute(
+                text(
+                    """
+                    INSERT INTO AppointmentTimeSlots
+                    (date, hour24, capacity)
+                    SELECT *
+                    FROM unnest(CAST(:dates AS DATE[]), CAST(:hours AS INT[]), CAST(:capacities AS INT[]))
+                    ON CONFLICT (date, hour24) DO NOTHING
+                    RETURNING date AS date;
+                    """
+                ),
+                {
+                    "dates": [time_slot_date for time_slot_date, _ in unique_time_slots],
+                    "hours": [hour_24 for _, hour_24 in unique_time_slots],
+                    "capacities": list(unique_time_slots.values()),
+                },
+            )
+            .mappings()
+            .fetchall()
+        )
+        created_dates = [record.get("date") for record in records]
+
     db.session.commit()
-    return jsonify({"message": "Successfully added appointment time slot"})
+    for created_date in set(created_dates):
+        availability_cache.invalidate(created_date)
+
+    return jsonify(
+        {
+            "message": "Successfully added appointment time slots",
+            "created": len(created_dates),
+            "skipped": len(time_slots) - len(created_dates),
+        }
+    )
 
 
 @bp.delete("/remove_appointment_time_slot")
@@ -178,182 +347,469 @@ def remove_appointment_time_slot():
     if appointment_id < 1:
         return Response(f"Invalid appointment ID: {appointment_id}", status=400)
 
-    tries = 0
-    while tries < TRANSACTION_RETRY_AMOUNT:
-        try:
-            appointment_record = (
-                db.session.execute(
-                    text(
-                        """
-                        SELECT appointmentID AS appointment_id, date AS date, hour24 AS hour_24
-                        FROM AppointmentTimeSlots
-                        WHERE appointmentID = :appointment_id;
-                        """
-                    ),
-                    {"appointment_id": appointment_id},
-                )
-                .mappings()
-                .fetchone()
+    def remove() -> Response:
+        removed = remove_time_slots(
+            "appointmentID = :appointment_id", {"appointment_id": appointment_id}
+        )
+
+        if len(removed.appointment_ids) == 0:
+            db.session.rollback()
+            return Response(
+                f"Appointment time slot with id {appointment_id} does not exist",
+                status=409,
             )
 
-            if appointment_record is None:
-                return Response(
-                    f"Appointment time slot with id {appointment_id} does not exist",
-                    status=409,
+        db.session.commit()
+        removed.finish()
+        return jsonify({"message": "Successfully removed appointment time slot"})
+
+    try:
+        return transaction_retrier.run("remove_appointment_time_slot", remove)
+    except DBAPIError as e:
+        print(e)
+        return Response(response="Failed to remove appointment time slot", status=500)
+
+
+class RemovedTimeSlots:
+    def __init__(self):
+        self.appointment_ids: set[int] = set()
+        self.dates: set[date] = set()
+        self.bookings = 0
+        # (email, name, date, time) of everyone whose booking was removed
+        self.recipients: list[tuple[str, str, str, str]] = []
+
+    # Called once the removal is committed
+    def finish(self):
+        for removed_date in self.dates:
+            availability_cache.invalidate(removed_date)
+
+
+# Deletes the time slots matching condition, a WHERE clause over AppointmentTimeSlots, along with their bookings.
+# The slots are locked and their bookings deleted in one statement that also returns who needs to be told, then the
+# slots themselves are deleted in a second. The emails go into the outbox in the same transaction, which the caller commits
+def remove_time_slots(condition: str, params: dict) -> RemovedTimeSlots:
+    records = (
+        db.session.execute(
+            text(
+                f"""
+                WITH Slots AS (
+                    SELECT appointmentID, date, hour24
+                    FROM AppointmentTimeSlots
+                    WHERE {condition}
+                    FOR UPDATE
+                ), RemovedBookings AS (
+                    DELETE FROM Bookings b
+                    USING Slots s
+                    WHERE b.appointmentID = s.appointmentID
+                    RETURNING b.appointmentID, b.userID
                 )
+                SELECT s.appointmentID AS appointment_id, s.date AS date, s.hour24 AS hour_24,
+                       u.email AS email, u.name AS name
+                FROM Slots s
+                LEFT OUTER JOIN RemovedBookings rb
+                    ON s.appointmentID = rb.appointmentID
+                LEFT OUTER JOIN Users u
+                    ON rb.userID = u.userID;
+                """
+            ),
+            params,
+        )
+        .mappings()
+        .fetchall()
+    )
 
-            user_email_records = (
-                db.session.execute(
-                    text(
-                        """
-                        SELECT u.email AS email
-                        FROM Bookings b
-                        INNER JOIN Users u
-                            ON b.userID = u.userID
-                        WHERE b.appointmentID = :appointment_id;
-                        """
-                    ),
-                    {"appointment_id": appointment_id},
+    removed = RemovedTimeSlots()
+    for record in records:
+        removed.appointment_ids.add(record.get("appointment_id"))
+        removed.dates.add(record.get("date"))
+        if record.get("email") is not None:
+            removed.bookings += 1
+            removed.recipients.append(
+                (
+                    record.get("email"),
+                    record.get("name"),
+                    str(record.get("date")),
+                    f"{record.get('hour_24')}:00",
                 )
-                .mappings()
-                .fetchall()
             )
-            for record in user_email_records:
-                # TODO notify users that their appointment has been cancelled
-                pass
 
-            db.session.execute(
-                text(
-                    """
-                    DELETE FROM Bookings
-                    WHERE appointmentID = :appointment_id;
-                    """
-                ),
-                {"appointment_id": appointment_id},
-            )
+    if len(removed.appointment_ids) > 0:
+        db.session.execute(
+            text(
+                """
+                DELETE FROM AppointmentTimeSlots
+                WHERE appointmentID = ANY(:appointment_ids);
+                """
+            ),
+            {"appointment_ids": list(removed.appointment_ids)},
+        )
 
-            db.session.execute(
-                text(
-                    """
-                    DELETE FROM AppointmentTimeSlots
-                    WHERE appointmentID = :appointment_id; 
-                    """
-                ),
-                {"appointment_id": appointment_id},
-            )
+    if len(removed.recipients) > 0:
+        enqueue(send_time_slot_removed_emails_task, recipients=removed.recipients)
 
-            db.session.commit()
-            return jsonify({"message": "Successfully removed appointment time slot"})
-        except SerializationFailure:
-            db.session.rollback()
-            tries += 1
-            time.sleep(2 * tries)
+    return removed
 
-    return Response(response="Failed to remove appointment time slot", status_code=500)
 
+@bp.delete("/remove_appointment_time_slots")
+@jwt_required()
+@role_required("admin")
+def remove_appointment_time_slots():
+    json: dict | None = request.get_json()
 
-@bp.get("/get_all_appointments")
+    if json is None:
+        return Response(
+            response="Didn't send JSON to remove_appointment_time_slots DELETE request",
+            status=400,
+        )
+
+    condition: str
+    params: dict
+    if "appointment_ids" in json:
+        appointment_ids = json["appointment_ids"]
+        if not isinstance(appointment_ids, list) or not all(
+            is_int(appointment_id) and appointment_id > 0
+            for appointment_id in appointment_ids
+        ):
+            return Response(f"Invalid appointment IDs: {appointment_ids}", status=400)
+
+        condition = "appointmentID = ANY(:appointment_ids)"
+        params = {"appointment_ids": appointment_ids}
+    elif "start_date" in json and "end_date" in json:
+        start_date: date
+        end_date: date
+        try:
+            start_date = date.fromisoformat(json["start_date"])
+            end_date = date.fromisoformat(json["end_date"])
+        except (TypeError, ValueError):
+            return Response(response="Start or end date does not exist", status=400)
+
+        condition = "date >= :start_date AND date < :end_date"
+        params = {"start_date": start_date, "end_date": end_date}
+    else:
+        return Response(
+            response="Either appointment_ids or start_date and end_date must be present in remove_appointment_time_slots DELETE request",
+            status=400,
+        )
+
+    def remove() -> Response:
+        removed = remove_time_slots(condition, params)
+        db.session.commit()
+        removed.finish()
+        return jsonify(
+            {
+                "message": "Successfully removed appointment time slots",
+                "removed_time_slots": len(removed.appointment_ids),
+                "removed_bookings": removed.bookings,
+            }
+        )
+
+    try:
+        return transaction_retrier.run("remove_appointment_time_slots", remove)
+    except DBAPIError as e:
+        print(e)
+        return Response(response="Failed to remove appointment time slots", status=500)
+
+
+@bp.get("/get_metrics")
 @jwt_required()
 @role_required("admin")
-def get_all_appointments():
-    start_date = request.args.get("start_date")
-    if not validate_date(start_date):
-        return Response(response=f"Invalid start date: {start_date}", status=400)
+def get_metrics():
+    return jsonify(collect_metrics())
+
+
+# Cursors point just past the last appointment of a page, in the order listings are sorted in
+def encode_appointment_cursor(appointment: dict) -> str:
+    return f"{appointment['date']}_{appointment['hour_24']}_{appointment['appointment_id']}"
 
-    end_date = request.args.get("end_date")
-    if not validate_date(end_date):
-        return Response(response=f"Invalid end date: {end_date}", status=400)
 
-    appointment_records = (
+def decode_appointment_cursor(cursor: str) -> tuple[date, int, int] | None:
+    try:
+        date_str, hour_24_str, appointment_id_str = cursor.split("_")
+        return date.fromisoformat(date_str), int(hour_24_str), int(appointment_id_str)
+    except ValueError:
+        return None
+
+
+# The slots making up one page of the admin listing, as a Page CTE along with its parameters
+def all_appointments_page(
+    start_date: str,
+    end_date: str,
+    after: tuple[date, int, int] | None,
+    limit: int | None,
+) -> tuple[str, dict]:
+    keyset_condition = (
+        "AND (a.date, a.hour24, a.appointmentID) > (:after_date, :after_hour_24, :after_appointment_id)"
+        if after is not None
+        else ""
+    )
+    after_date, after_hour_24, after_appointment_id = (
+        after if after is not None else (None, None, None)
+    )
+
+    page_sql = f"""
+        WITH Page AS (
+            SELECT a.appointmentID, a.date, a.hour24, a.capacity, a.slotsBooked, a.leaderUserID,
+                   a.subject, a.location, a.confirmationCode
+            FROM AppointmentTimeSlots a
+            WHERE a.date >= :start_date
+              AND a.date < :end_date
+              {keyset_condition}
+            ORDER BY a.date ASC, a.hour24 ASC, a.appointmentID ASC
+            LIMIT :limit
+        )
+        """
+    params = {
+        "start_date": start_date,
+        "end_date": end_date,
+        "after_date": after_date,
+        "after_hour_24": after_hour_24,
+        "after_appointment_id": after_appointment_id,
+        "limit": limit,
+    }
+
+    return page_sql, params
+
+
+# Yields each appointment in [start_date, end_date) after the cursor, at most limit of them if given, with its
+# bookings grouped in. Rows come off a server-side cursor and an appointment is yielded as soon as its last
+# booking row has been read, so memory use doesn't depend on the size of the range. Bookings are looked up per
+# appointment in the page rather than joined, so the planner can't pick a scan of every booking ever made
+def iter_all_appointments(
+    start_date: str,
+    end_date: str,
+    after: tuple[date, int, int] | None,
+    limit: int | None,
+):
+    page_sql, params = all_appointments_page(start_date, end_date, after, limit)
+
+    records = (
         db.session.execute(
             text(
-                """
-                WITH Appointments AS (
-                    SELECT ats.appointmentID AS appointmentID, ats.date AS date, ats.hour24 AS hour24,
-                           ats.capacity AS capacity, COUNT(b.userID) AS slotsBooked, ats.leaderUserID AS leaderUserID,
-                           ats.subject AS subject, ats.location AS location, ats.confirmationCode AS confirmationCode
-                    FROM AppointmentTimeSlots ats
-                    LEFT OUTER JOIN Bookings b
-                        ON ats.appointmentID = b.appointmentID
-                    GROUP BY ats.appointmentID, ats.date, ats.hour24, ats.capacity, ats.leaderUserID, ats.subject,
-                             ats.location
-                )
+                page_sql
+                + """
                 SELECT a.appointmentID AS appointment_id, a.date AS date, a.hour24 AS hour_24, a.capacity AS capacity,
                        a.slotsBooked AS slots_booked, u1.name AS leader_name, a.subject AS subject,
                        a.location AS location, a.confirmationCode AS confirmation_code, u2.name AS user_name,
-                       u2.email AS user_email, b.comments AS user_comments
-                FROM Appointments a
-                LEFT OUTER JOIN Bookings b
-                    ON a.appointmentID = b.appointmentID
+                       u2.email AS user_email, u2.comments AS user_comments
+                FROM Page a
+                LEFT OUTER JOIN LATERAL (
+                    SELECT u.name, u.email, b.comments
+                    FROM Bookings b
+                    INNER JOIN Users u
+                        ON b.userID = u.userID
+                    WHERE b.appointmentID = a.appointmentID
+                ) AS u2
+                    ON TRUE
                 LEFT OUTER JOIN Users u1
                     ON a.leaderUserID = u1.userID
-                LEFT OUTER JOIN Users u2
-                    ON b.userID = u2.userID
-                WHERE a.date >= :start_date
-                  AND a.date < :end_date
-                ORDER BY a.date ASC, a.hour24 ASC, u2.name ASC;
+                ORDER BY a.date ASC, a.hour24 ASC, a.appointmentID ASC, u2.name ASC;
                 """
             ),
-            {"start_date": start_date, "end_date": end_date},
+            params,
+            execution_options={"stream_results": True, "max_row_buffer": 1000},
         )
         .mappings()
-        .fetchall()
     )
 
-    if appointment_records is None:
-        return jsonify({"appointments": []})
-
-    appointments = []
-    appointments_to_bookings: dict[int, list[dict[str, str]]] = dict()
-    for record in appointment_records:
-        appointment_id = record.get("appointment_id")
-        if appointment_id in appointments_to_bookings:
-            appointments_to_bookings[appointment_id].append(
+    appointment: dict | None = None
+    for record in records:
+        if appointment is None or appointment["appointment_id"] != record.get(
+            "appointment_id"
+        ):
+            if appointment is not None:
+                yield appointment
+
+            appointment = {
+                "appointment_id": record.get("appointment_id"),
+                "date": str(record.get("date")),
+                "hour_24": record.get("hour_24"),
+                "capacity": record.get("capacity"),
+                "slots_booked": record.get("slots_booked"),
+            }
+            if record.get("slots_booked") > 0:
+                appointment["leader_name"] = record.get("leader_name")
+                appointment["subject"] = record.get("subject")
+                appointment["location"] = record.get("location")
+                appointment["confirmation_code"] = record.get("confirmation_code")
+                appointment["bookings"] = []
+
+        if "bookings" in appointment and record.get("user_email") is not None:
+            appointment["bookings"].append(
                 {
                     "name": record.get("user_name"),
                     "email": record.get("user_email"),
                     "comments": record.get("user_comments"),
                 }
             )
-        elif record.get("slots_booked") > 0:
-            appointments_to_bookings[appointment_id] = [
-                {
-                    "name": record.get("user_name"),
-                    "email": record.get("user_email"),
-                    "comments": record.get("user_comments"),
-                }
-            ]
 
-    seen: set[int] = set()
-    for record in appointment_records:
-        if record.get("appointment_id") in seen:
-            continue
-        seen.add(record.get("appointment_id"))
+    if appointment is not None:
+        yield appointment
 
-        if record.get("slots_booked") > 0:
-            appointments.append(
-                {
-                    "appointment_id": record.get("appointment_id"),
-                    "date": str(record.get("date")),
-                    "hour_24": record.get("hour_24"),
-                    "capacity": record.get("capacity"),
-                    "slots_booked": record.get("slots_booked"),
-                    "leader_name": record.get("leader_name"),
-                    "subject": record.get("subject"),
-                    "location": record.get("location"),
-                    "confirmation_code": record.get("confirmation_code"),
-                    "bookings": appointments_to_bookings[record.get("appointment_id")],
-                }
+
+# Has Postgres build the page's JSON array itself, one object per appointment with its bookings nested in, and
+# returns it as text along with how many appointments it holds and the cursor past the last of them
+def load_all_appointments_json(
+    start_date: str,
+    end_date: str,
+    after: tuple[date, int, int] | None,
+    limit: int | None,
+) -> tuple[str, int, str | None]:
+    page_sql, params = all_appointments_page(start_date, end_date, after, limit)
+
+    record = (
+        db.session.execute(
+            text(
+                page_sql
+                + """
+                SELECT CAST(COALESCE(json_agg(
+                           CASE WHEN a.slotsBooked > 0 THEN json_build_object(
+                               'appointment_id', a.appointmentID,
+                               'date', a.date,
+                               'hour_24', a.hour24,
+                               'capacity', a.capacity,
+                               'slots_booked', a.slotsBooked,
+                               'leader_name', u1.name,
+                               'subject', a.subject,
+                               'location', a.location,
+                               'confirmation_code', a.confirmationCode,
+                               'bookings', (
+                                   SELECT COALESCE(json_agg(json_build_object(
+                                              'name', u2.name,
+                                              'email', u2.email,
+                                              'comments', b.comments
+                                          ) ORDER BY u2.name ASC), '[]')
+                                   FROM Bookings b
+                                   INNER JOIN Users u2
+                                       ON b.userID = u2.userID
+                                   WHERE b.appointmentID = a.appointmentID
+                               )
+                           ) ELSE json_build_object(
+                               'appointment_id', a.appointmentID,
+                               'date', a.date,
+                               'hour_24', a.hour24,
+                               'capacity', a.capacity,
+                               'slots_booked', a.slotsBooked
+                           ) END
+                           ORDER BY a.date ASC, a.hour24 ASC, a.appointmentID ASC
+                       ), '[]') AS TEXT) AS appointments,
+                       COUNT(*) AS appointment_count,
+                       (array_agg(to_char(a.date, 'YYYY-MM-DD') || '_' || a.hour24 || '_' || a.appointmentID
+                                  ORDER BY a.date DESC, a.hour24 DESC, a.appointmentID DESC))[1] AS last_cursor
+                FROM Page a
+                LEFT OUTER JOIN Users u1
+                    ON a.leaderUserID = u1.userID;
+                """
+            ),
+            params,
+        )
+        .mappings()
+        .fetchone()
+    )
+
+    return (
+        record.get("appointments"),
+        record.get("appointment_count"),
+        record.get("last_cursor"),
+    )
+
+
+@bp.get("/get_all_appointments")
+@jwt_required()
+@role_required("admin")
+def get_all_appointments():
+    start_date = request.args.get("start_date")
+    if not validate_date(start_date):
+        return Response(response=f"Invalid start date: {start_date}", status=400)
+
+    end_date = request.args.get("end_date")
+    if not validate_date(end_date):
+        return Response(response=f"Invalid end date: {end_date}", status=400)
+
+    # Without limit the whole range is returned in one response, as before pagination was added
+    limit: int | None = None
+    if "limit" in request.args:
+        try:
+            limit = int(request.args["limit"])
+        except ValueError:
+            limit = 0
+        max_page_size = current_app.config["ADMIN_APPOINTMENTS_MAX_PAGE_SIZE"]
+        if limit < 1 or limit > max_page_size:
+            return Response(
+                response=f"Limit must be between 1 and {max_page_size}", status=400
             )
-        else:
-            appointments.append(
-                {
-                    "appointment_id": record.get("appointment_id"),
-                    "date": str(record.get("date")),
-                    "hour_24": record.get("hour_24"),
-                    "capacity": record.get("capacity"),
-                    "slots_booked": record.get("slots_booked"),
-                }
+
+    after: tuple[date, int, int] | None = None
+    if "after" in request.args:
+        after = decode_appointment_cursor(request.args["after"])
+        if after is None:
+            return Response(
+                response=f"Invalid cursor: {request.args['after']}", status=400
+            )
+
+    response_format = request.args.get("format", "json")
+    if response_format not in ("json", "ndjson"):
+        return Response(response=f"Invalid format: {response_format}", status=400)
+
+    etag = make_etag(
+        "all",
+        start_date,
+        end_date,
+        get_availability_version(start_date, end_date),
+        request.args.get("after"),
+        limit,
+        response_format,
+    )
+    not_modified_response = not_modified(etag, private=True)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    if response_format == "ndjson":
+        # One appointment per line, written out as they're grouped. When paginating, a last line holds the cursor
+        # for the next page, or null once there are no more
+        def generate():
+            appointment_count = 0
+            last_appointment: dict | None = None
+            for appointment in iter_all_appointments(start_date, end_date, after, limit):
+                appointment_count += 1
+                last_appointment = appointment
+                yield current_app.json.dumps(appointment) + "\n"
+
+            if limit is not None:
+                yield current_app.json.dumps(
+                    {
+                        "next_cursor": (
+                            encode_appointment_cursor(last_appointment)
+                            if appointment_count == limit
+                            else None
+                        )
+                    }
+                ) + "\n"
+
+        return with_etag(
+            Response(
+                stream_with_context(generate()), mimetype="application/x-ndjson"
+            ),
+            etag,
+            private=True,
+        )
+
+    body: dict
+    if current_app.config["APPOINTMENT_LISTING_AGGREGATION"] == "postgres":
+        appointments_json, appointment_count, last_cursor = load_all_appointments_json(
+            start_date, end_date, after, limit
+        )
+        # The array from Postgres is written out as-is rather than parsed and encoded again
+        body = {"appointments": JSONFragment(appointments_json)}
+        if limit is not None:
+            body["next_cursor"] = last_cursor if appointment_count == limit else None
+    else:
+        appointments = list(iter_all_appointments(start_date, end_date, after, limit))
+        body = {"appointments": appointments}
+        if limit is not None:
+            body["next_cursor"] = (
+                encode_appointment_cursor(appointments[-1])
+                if len(appointments) == limit
+                else None
             )
 
-    return jsonify({"appointments": appointments})
+    return with_etag(jsonify(body), etag, private=True)
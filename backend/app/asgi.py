@@ -0,0 +1,237 @@
+from datetime import date
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+from urllib.parse import parse_qs
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from werkzeug.http import parse_etags, quote_etag
+from . import create_app
+from .config import Config, config_from_env
+from .availability import availability_cache
+from .availability_feed import (
+    availability_feed,
+    change_in_range,
+    format_slot_event,
+    RETRY_EVENT,
+    KEEPALIVE_EVENT,
+    RESYNC_EVENT,
+)
+from .book import AVAILABLE_APPOINTMENTS_SQL, format_available_appointment
+from .etag import AVAILABILITY_VERSIONS_SQL, digest_versions, format_availability_versions, make_etag
+from .metrics import register_metrics
+from .validate import validate_date
+import asyncio
+
+# Matches what flask_cors adds to every /api/* response served by Flask
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+async def send_response(send, status: int, body: str, headers: list[tuple[bytes, bytes]] | None = None):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8"), *CORS_HEADERS, *(headers or [])],
+        }
+    )
+    await send({"type": "http.response.body", "body": body.encode("utf-8")})
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def load_available_appointments(connection: AsyncConnection, start_date: date, end_date: date) -> list[dict]:
+    result = await connection.execute(
+        AVAILABLE_APPOINTMENTS_SQL, {"start_date": start_date, "end_date": end_date}
+    )
+    return [format_available_appointment(record) for record in result.mappings().fetchall()]
+
+
+async def send_event(send, event: str):
+    await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+
+
+def header_value(scope, name: bytes) -> str | None:
+    for header_name, value in scope["headers"]:
+        if header_name == name:
+            return value.decode("latin-1")
+
+    return None
+
+
+# Entry point for running under uvicorn instead of gunicorn. The availability listing and feed, which make up most
+# requests and are the ones that hold connections open, are served on the event loop with an async engine and the
+# same SQL as the book blueprint. Every other route goes to the Flask app, which runs on a thread pool as it would
+# under gunicorn's gthread workers
+class AsyncApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(flask_app, workers=flask_app.config["ASGI_WSGI_THREADS"])
+        self.engine = create_async_engine(
+            flask_app.config["SQLALCHEMY_DATABASE_URI"],
+            pool_size=flask_app.config["ASYNC_DB_POOL_SIZE"],
+            max_overflow=flask_app.config["ASYNC_DB_MAX_OVERFLOW"],
+            pool_timeout=flask_app.config["DB_POOL_TIMEOUT_SECONDS"],
+            pool_recycle=flask_app.config["DB_POOL_RECYCLE_SECONDS"],
+            pool_pre_ping=flask_app.config["DB_POOL_PRE_PING"],
+            connect_args=flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"],
+        )
+        self.routes = {
+            "/api/book/get_available_appointments": self.get_available_appointments,
+            "/api/book/get_availability_feed": self.get_availability_feed,
+        }
+        register_metrics("async_db_pool", self.stats)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        if scope["type"] == "http" and scope["method"] == "GET":
+            handler = self.routes.get(scope["path"])
+            if handler is not None:
+                await handler(scope, receive, send)
+                return
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def get_available_appointments(self, scope, receive, send):
+        args = parse_qs(scope["query_string"].decode("latin-1"))
+        start_date = args.get("start_date", [None])[0]
+        if not validate_date(start_date):
+            await send_response(send, 400, f"Invalid start date: {start_date}")
+            return
+
+        end_date = args.get("end_date", [None])[0]
+        if not validate_date(end_date):
+            await send_response(send, 400, f"Invalid enddate: {end_date}")
+            return
+
+        try:
+            start = date.fromisoformat(start_date)
+            end = date.fromisoformat(end_date)
+        except ValueError as e:
+            print(str(e))
+            await send_response(send, 400, "Start or end date does not exist")
+            return
+
+        async with self.engine.connect() as connection:
+            result = await connection.execute(
+                AVAILABILITY_VERSIONS_SQL, {"start_date": start_date, "end_date": end_date}
+            )
+            day_versions = format_availability_versions(result.mappings().fetchall())
+            etag = make_etag("available", start_date, end_date, digest_versions(day_versions))
+            etag_headers = [(b"etag", quote_etag(etag).encode("latin-1")), (b"cache-control", b"no-cache")]
+
+            if parse_etags(header_value(scope, b"if-none-match")).contains(etag):
+                await send({"type": "http.response.start", "status": 304, "headers": [*CORS_HEADERS, *etag_headers]})
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            async def load_appointments(start_date: date, end_date: date) -> list[dict]:
+                return await load_available_appointments(connection, start_date, end_date)
+
+            appointments = await availability_cache.get_range_async(start, end, day_versions, load_appointments)
+
+        body = self.flask_app.json.dumps({"appointments": appointments}).encode("utf-8")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json"), *CORS_HEADERS, *etag_headers],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    # The same feed as the book blueprint's, except an open feed only costs a coroutine rather than a thread
+    async def get_availability_feed(self, scope, receive, send):
+        args = parse_qs(scope["query_string"].decode("latin-1"))
+        start_date = args.get("start_date", [None])[0]
+        if not validate_date(start_date):
+            await send_response(send, 400, f"Invalid start date: {start_date}")
+            return
+
+        end_date = args.get("end_date", [None])[0]
+        if not validate_date(end_date):
+            await send_response(send, 400, f"Invalid end date: {end_date}")
+            return
+
+        subscription = availability_feed.subscribe(asyncio.get_running_loop())
+        if subscription is None:
+            await send_response(
+                send, 503, "Availability feed unavailable, fall back to polling", [(b"retry-after", b"30")]
+            )
+            return
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache"),
+                        (b"x-accel-buffering", b"no"),
+                        *CORS_HEADERS,
+                    ],
+                }
+            )
+            await send_event(send, RETRY_EVENT)
+
+            while True:
+                next_change = asyncio.ensure_future(subscription.changes.get())
+                done, _ = await asyncio.wait(
+                    {next_change, disconnected},
+                    timeout=availability_feed.heartbeat_seconds,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if disconnected in done:
+                    next_change.cancel()
+                    return
+                if next_change not in done:
+                    # Keeps proxies from closing the connection
+                    next_change.cancel()
+                    await send_event(send, KEEPALIVE_EVENT)
+                    continue
+
+                if subscription.resync:
+                    await send_event(send, RESYNC_EVENT)
+                    break
+
+                change = next_change.result()
+                if change is None or not change_in_range(change, start_date, end_date):
+                    continue
+
+                await send_event(send, format_slot_event(self.flask_app.json.dumps(change)))
+
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            availability_feed.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        pool = self.engine.pool
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+
+
+# Run with uvicorn's --factory flag, e.g. uvicorn --factory app.asgi:create_asgi_app, which takes the config from
+# FLASK_ENV
+def create_asgi_app(config: Config | None = None) -> AsyncApp:
+    return AsyncApp(create_app(config if config is not None else config_from_env()))
@@ -7,10 +7,13 @@ from flask_jwt_extended import (
     get_current_user,
 )
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 from .db import db
-from bcrypt import checkpw, hashpw, gensalt
+from .passwords import password_hasher, PasswordHasherSaturated
+from .ratelimit import login_rate_limiter
 from .user import User
 from email_validator import validate_email, EmailNotValidError, ValidatedEmail
+from .etag import make_etag, not_modified, with_etag
 
 bp = Blueprint("auth", __name__, url_prefix="/api/auth")
 
@@ -57,7 +60,7 @@ def register():
                 """
                 SELECT *
                 FROM Users
-                WHERE email = :email;
+                WHERE lower(email) = lower(:email);
                 """
             ),
             {"email": email},
@@ -70,28 +73,42 @@ def register():
             response=f"Account with email {email} already present", status=409
         )
 
-    db.session.execute(
-        text(
-            """
-            INSERT INTO Users
-            (name, email, passwordSaltedHashed)
-            VALUES
-            (:name, :email, :password_hashed);
-            """
-        ),
-        {
-            "name": name,
-            "email": email,
-            "password_hashed": hashpw(bytes(password, "utf-8"), gensalt()),
-        },
-    )
+    password_hashed: bytes
+    try:
+        password_hashed = password_hasher.hash_password(password)
+    except PasswordHasherSaturated:
+        return password_hasher_busy_response()
+
+    # Two registrations for the same email can both pass the check above, in which case the unique index on
+    # lower(email) rejects the second insert
+    try:
+        db.session.execute(
+            text(
+                """
+                INSERT INTO Users
+                (name, email, passwordSaltedHashed)
+                VALUES
+                (:name, :email, :password_hashed);
+                """
+            ),
+            {
+                "name": name,
+                "email": email,
+                "password_hashed": password_hashed,
+            },
+        )
+    except IntegrityError:
+        db.session.rollback()
+        return Response(
+            response=f"Account with email {email} already present", status=409
+        )
     record = (
         db.session.execute(
             text(
                 """
                 SELECT *
                 FROM Users
-                WHERE email = :email;
+                WHERE lower(email) = lower(:email);
                 """
             ),
             {"email": email},
@@ -104,6 +121,8 @@ def register():
         user_id=record.get("userid"),
         name=record.get("name"),
         email=record.get("email"),
+        version=record.get("version"),
+        token_version=record.get("tokenversion"),
     )
 
     db.session.commit()
@@ -128,14 +147,27 @@ def login():
 
     email = json["email"]
     password = json["password"]
+    if not isinstance(email, str):
+        return Response(response=f"Invalid email address: {email}", status=400)
+
+    retry_after = login_rate_limiter.check(request.remote_addr, email)
+    if retry_after is not None:
+        return too_many_requests_response(retry_after)
 
+    # Roles are looked up here so they can be signed into the access token as claims
     record = (
         db.session.execute(
             text(
                 """
-                SELECT *
-                FROM Users
-                WHERE email = :email;
+                SELECT u.userID AS userid, u.name AS name, u.email AS email,
+                       u.passwordSaltedHashed AS passwordsaltedhashed, u.version AS version,
+                       u.tokenVersion AS tokenversion,
+                       COALESCE(array_agg(ur.userRole) FILTER (WHERE ur.userRole IS NOT NULL), '{}') AS roles
+                FROM Users u
+                LEFT OUTER JOIN UserRoles ur
+                    ON u.userID = ur.userID
+                WHERE lower(u.email) = lower(:email)
+                GROUP BY u.userID;
                 """
             ),
             {"email": email},
@@ -150,11 +182,23 @@ def login():
         user_id=record.get("userid"),
         name=record.get("name"),
         email=record.get("email"),
+        version=record.get("version"),
+        roles=record.get("roles"),
+        token_version=record.get("tokenversion"),
     )
 
     password_hashed = record.get("passwordsaltedhashed")
 
-    if checkpw(bytes(password, "utf-8"), password_hashed):
+    password_matches: bool
+    try:
+        password_matches = password_hasher.check_password(password, password_hashed)
+    except PasswordHasherSaturated:
+        return password_hasher_busy_response()
+
+    if password_matches:
+        if password_hasher.needs_rehash(password_hashed):
+            rehash_password(user.user_id, password)
+
         response = jsonify({"message": "Login successful"})
         access_token = create_access_token(identity=user)
         set_access_cookies(response, access_token)
@@ -163,6 +207,47 @@ def login():
     return Response(response=f"Incorrect password", status=400)
 
 
+# The password was stored with a different bcrypt cost than the one configured, and logging in is the only time
+# we have the plaintext to hash it again
+def rehash_password(user_id: int, password: str):
+    try:
+        password_hashed = password_hasher.hash_password(password)
+    except PasswordHasherSaturated:
+        # Not worth failing the login over; it will be retried the next time they log in
+        return
+
+    db.session.execute(
+        text(
+            """
+            UPDATE Users
+            SET passwordSaltedHashed = :password_hashed
+            WHERE userID = :user_id;
+            """
+        ),
+        {"password_hashed": password_hashed, "user_id": user_id},
+    )
+    db.session.commit()
+    password_hasher.record_rehash()
+
+
+# The password hasher's queue is full or the hash took too long, which is the server being overloaded rather than
+# anything the client did
+def password_hasher_busy_response() -> Response:
+    return Response(
+        response="Server busy, try again shortly",
+        status=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+def too_many_requests_response(retry_after: int = 1) -> Response:
+    return Response(
+        response="Too many requests, try again shortly",
+        status=429,
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
 @bp.post("/logout")
 def logout():
     response = jsonify({"message": "Logout successful"})
@@ -177,4 +262,9 @@ def get_user_info():
     if user is None:
         return Response(response="No valid user logged in", status=401)
 
-    return jsonify(user.format_to_dict_for_sending())
+    etag = make_etag("user", user.user_id, user.version)
+    not_modified_response = not_modified(etag, private=True)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    return with_etag(jsonify(user.format_to_dict_for_sending()), etag, private=True)
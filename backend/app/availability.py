@@ -0,0 +1,133 @@
+from datetime import date, timedelta
+from typing import Awaitable, Callable
+from .cache import Cache, NullCache, create_cache
+from .metrics import register_metrics
+
+
+# Caches the public availability listing in one bucket per day, so overlapping week views share entries and a
+# booking only has to invalidate the day its time slot is on. Buckets remember the day's version stamp from
+# AvailabilityVersions, so a change made by another process is never served from here
+class AvailabilityCache:
+    def __init__(self):
+        self.cache: Cache = NullCache()
+        self.max_days = 0
+        self.stale = 0
+
+    def init_app(self, app):
+        self.cache = create_cache(
+            app.config["AVAILABILITY_CACHE_BACKEND"],
+            app.config["AVAILABILITY_CACHE_MAX_SIZE"],
+            app.config["AVAILABILITY_CACHE_TTL_SECONDS"],
+        )
+        self.max_days = app.config["AVAILABILITY_CACHE_MAX_DAYS"]
+        self.stale = 0
+        register_metrics("availability_cache", self.stats)
+
+    def stats(self) -> dict[str, int]:
+        return {**self.cache.stats(), "stale": self.stale}
+
+    def get_day(self, day: str, version: int) -> list[dict] | None:
+        entry = self.cache.get(day)
+        if entry is None:
+            return None
+
+        cached_version, appointments = entry
+        if cached_version != version:
+            self.stale += 1
+            return None
+
+        return appointments
+
+    def get_range(
+        self,
+        start_date: date,
+        end_date: date,
+        day_versions: dict[str, int],
+        load_appointments: Callable[[date, date], list[dict]],
+    ) -> list[dict]:
+        days = days_in_range(start_date, end_date)
+
+        # Very wide ranges would flood the cache with buckets that are unlikely to be requested again
+        if len(days) > self.max_days:
+            return load_appointments(start_date, end_date)
+
+        appointments_by_day = self.lookup_days(days, day_versions)
+        missing_range = find_missing_range(days, appointments_by_day)
+        if missing_range is not None:
+            self.fill_days(appointments_by_day, day_versions, missing_range, load_appointments(*missing_range))
+
+        return collect_days(days, appointments_by_day)
+
+    # The same as get_range for the asyncio entry point, where loading the missing days has to be awaited
+    async def get_range_async(
+        self,
+        start_date: date,
+        end_date: date,
+        day_versions: dict[str, int],
+        load_appointments: Callable[[date, date], Awaitable[list[dict]]],
+    ) -> list[dict]:
+        days = days_in_range(start_date, end_date)
+
+        if len(days) > self.max_days:
+            return await load_appointments(start_date, end_date)
+
+        appointments_by_day = self.lookup_days(days, day_versions)
+        missing_range = find_missing_range(days, appointments_by_day)
+        if missing_range is not None:
+            self.fill_days(
+                appointments_by_day, day_versions, missing_range, await load_appointments(*missing_range)
+            )
+
+        return collect_days(days, appointments_by_day)
+
+    def lookup_days(self, days: list[date], day_versions: dict[str, int]) -> dict[str, list[dict] | None]:
+        return {str(day): self.get_day(str(day), day_versions.get(str(day), 0)) for day in days}
+
+    def fill_days(
+        self,
+        appointments_by_day: dict[str, list[dict] | None],
+        day_versions: dict[str, int],
+        missing_range: tuple[date, date],
+        loaded_appointments: list[dict],
+    ):
+        # Every missing day was loaded with a single query, so each bucket is filled from it, including empty days
+        first_missing_day, end_missing_day = missing_range
+        loaded_by_day: dict[str, list[dict]] = {
+            str(day): [] for day in days_in_range(first_missing_day, end_missing_day)
+        }
+        for appointment in loaded_appointments:
+            loaded_by_day[appointment["date"]].append(appointment)
+
+        for day, appointments in loaded_by_day.items():
+            if appointments_by_day[day] is None:
+                appointments_by_day[day] = appointments
+                self.cache.set(day, (day_versions.get(day, 0), appointments))
+
+    def invalidate(self, day: date | str):
+        self.cache.delete(str(day))
+
+
+def days_in_range(start_date: date, end_date: date) -> list[date]:
+    return [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days)]
+
+
+# The [start, end) span covering every day that wasn't cached, or None if they all were
+def find_missing_range(
+    days: list[date], appointments_by_day: dict[str, list[dict] | None]
+) -> tuple[date, date] | None:
+    missing_days = [day for day in days if appointments_by_day[str(day)] is None]
+    if len(missing_days) == 0:
+        return None
+
+    return missing_days[0], missing_days[-1] + timedelta(days=1)
+
+
+def collect_days(days: list[date], appointments_by_day: dict[str, list[dict] | None]) -> list[dict]:
+    appointments = []
+    for day in days:
+        appointments.extend(appointments_by_day[str(day)])
+
+    return sorted(appointments, key=lambda appointment: appointment["hour_24"])
+
+
+availability_cache = AvailabilityCache()
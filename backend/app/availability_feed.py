@@ -0,0 +1,199 @@
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+from typing import Callable
+from .availability import availability_cache
+from .metrics import register_metrics
+import asyncio
+import json
+import psycopg
+import time
+
+CHANNEL = "availability_changes"
+
+# Server-sent events written by both the WSGI and the asyncio feed endpoints
+RETRY_EVENT = "retry: 5000\n\n"
+KEEPALIVE_EVENT = ": keepalive\n\n"
+RESYNC_EVENT = "event: resync\ndata: {}\n\n"
+
+
+def format_slot_event(data: str) -> str:
+    return f"event: slot\ndata: {data}\n\n"
+
+
+# Whether a change moved a slot onto or off a day in [start_date, end_date)
+def change_in_range(change: dict, start_date: str, end_date: str) -> bool:
+    return any(
+        day is not None and start_date <= day < end_date
+        for day in (change["date"], change.get("previous_date"))
+    )
+
+
+class Subscription:
+    def __init__(self, queue_size: int, on_overflow: Callable[[], None]):
+        self.changes: Queue[dict | None] = Queue(maxsize=queue_size)
+        # Set when changes may have been missed, after which the client has to fetch availability again
+        self.resync = False
+        self.on_overflow = on_overflow
+
+    def deliver(self, change: dict | None):
+        try:
+            self.changes.put_nowait(change)
+        except Full:
+            self.overflow()
+
+    def overflow(self):
+        # Rather than block the listener on a slow client, tell it to start over
+        if not self.resync:
+            self.resync = True
+            self.on_overflow()
+
+
+# A subscription read from an event loop, for the asyncio entry point
+class AsyncSubscription(Subscription):
+    def __init__(self, queue_size: int, on_overflow: Callable[[], None], loop: asyncio.AbstractEventLoop):
+        self.changes: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=queue_size)
+        self.resync = False
+        self.on_overflow = on_overflow
+        self.loop = loop
+
+    def deliver(self, change: dict | None):
+        # asyncio queues aren't thread safe, so changes are handed over on the subscriber's own loop
+        try:
+            self.loop.call_soon_threadsafe(self._put, change)
+        except RuntimeError:
+            # The loop already closed, and the subscription with it
+            pass
+
+    def _put(self, change: dict | None):
+        try:
+            self.changes.put_nowait(change)
+        except asyncio.QueueFull:
+            self.overflow()
+
+
+# Fans slot changes published by Postgres on the availability_changes channel out to every open availability feed
+# in this process. One listener thread holds the only LISTEN connection, started on the first subscription so each
+# gunicorn worker gets its own after forking. Feeds read from a thread hold that thread for as long as they're open,
+# so they have a cap of their own, below the number of threads serving requests
+class AvailabilityFeed:
+    def __init__(self):
+        self.enabled = False
+        self.conninfo = ""
+        self.max_subscribers = 0
+        self.max_thread_subscribers = 0
+        self.queue_size = 0
+        self.heartbeat_seconds = 15
+        self._subscribers: set[Subscription] = set()
+        self._lock = Lock()
+        self._listener: Thread | None = None
+        self._listening = Event()
+        self.published = 0
+        self.overflowed = 0
+        self.reconnects = 0
+
+    def init_app(self, app):
+        self.enabled = app.config["AVAILABILITY_FEED_ENABLED"]
+        self.conninfo = app.config["DB_CONNINFO"]
+        self.max_subscribers = app.config["AVAILABILITY_FEED_MAX_SUBSCRIBERS"]
+        self.max_thread_subscribers = app.config["AVAILABILITY_FEED_MAX_THREAD_SUBSCRIBERS"]
+        self.queue_size = app.config["AVAILABILITY_FEED_QUEUE_SIZE"]
+        self.heartbeat_seconds = app.config["AVAILABILITY_FEED_HEARTBEAT_SECONDS"]
+        register_metrics("availability_feed", self.stats)
+
+    # Subscriptions made with an event loop are read from that loop instead of from a thread
+    def subscribe(self, loop: asyncio.AbstractEventLoop | None = None) -> Subscription | None:
+        with self._lock:
+            if not self.enabled or len(self._subscribers) >= self.max_subscribers:
+                return None
+            if loop is None and self._thread_subscribers() >= self.max_thread_subscribers:
+                return None
+
+            if loop is None:
+                subscription = Subscription(self.queue_size, self._count_overflow)
+            else:
+                subscription = AsyncSubscription(self.queue_size, self._count_overflow, loop)
+            self._subscribers.add(subscription)
+
+            if self._listener is None:
+                self._listener = Thread(
+                    target=self._listen, name="availability-feed", daemon=True
+                )
+                self._listener.start()
+
+            return subscription
+
+    def _thread_subscribers(self) -> int:
+        return sum(1 for subscription in self._subscribers if not isinstance(subscription, AsyncSubscription))
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def wait_until_listening(self, timeout: float) -> bool:
+        return self._listening.wait(timeout)
+
+    def publish(self, change: dict):
+        # Other processes' caches can't see this process' invalidations, but every process hears every change
+        availability_cache.invalidate(change["date"])
+        if change.get("previous_date") is not None:
+            availability_cache.invalidate(change["previous_date"])
+
+        with self._lock:
+            self.published += 1
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            subscription.deliver(change)
+
+    def _count_overflow(self):
+        with self._lock:
+            self.overflowed += 1
+
+    def resync_all(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            subscription.resync = True
+            subscription.deliver(None)
+
+    def _listen(self):
+        retry_seconds = 1
+        while True:
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as connection:
+                    connection.execute(f"LISTEN {CHANNEL};")
+                    if self._listening.is_set():
+                        # Anything committed while reconnecting was never heard
+                        self.resync_all()
+                    self._listening.set()
+                    retry_seconds = 1
+
+                    for notification in connection.notifies():
+                        try:
+                            self.publish(json.loads(notification.payload))
+                        except Exception as e:
+                            # The change can't be passed on, so subscribers have to fetch availability again
+                            print(e)
+                            self.resync_all()
+            # Anything else, like a subscriber failing, is retried the same way, so the feed never stops for good
+            except Exception as e:
+                print(e)
+
+            with self._lock:
+                self.reconnects += 1
+            time.sleep(retry_seconds)
+            retry_seconds = min(2 * retry_seconds, 30)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "thread_subscribers": self._thread_subscribers(),
+                "published": self.published,
+                "overflowed": self.overflowed,
+                "reconnects": self.reconnects,
+            }
+
+
+availability_feed = AvailabilityFeed()
@@ -1,10 +1,42 @@
-from flask import Blueprint, request, jsonify, Response
+from flask import (
+    Blueprint,
+    request,
+    jsonify,
+    Response,
+    current_app,
+    stream_with_context,
+)
 from sqlalchemy import text
 from .db import db
 from flask_jwt_extended import jwt_required, get_current_user
 from .user import User
 from .validate import validate_date
-from .tasks import procrastinate_app, book_new_appointment_task, cancel_appointment_task
+from .tasks import (
+    book_new_appointment_task,
+    book_existing_appointment_task,
+    cancel_appointment_task,
+)
+from .availability import availability_cache
+from .availability_feed import (
+    availability_feed,
+    change_in_range,
+    format_slot_event,
+    RETRY_EVENT,
+    KEEPALIVE_EVENT,
+    RESYNC_EVENT,
+)
+from .json_provider import JSONFragment
+from .outbox import outbox_params
+from .etag import (
+    digest_versions,
+    make_etag,
+    not_modified,
+    with_etag,
+    get_availability_versions,
+    get_scheduled_appointments_version,
+)
+from datetime import date
+from queue import Empty
 
 TRANSACTION_RETRY_AMOUNT = 3
 
@@ -21,43 +53,110 @@ def get_available_appointments():
     if not validate_date(end_date):
         return Response(response=f"Invalid enddate: {end_date}", status=400)
 
+    try:
+        start = date.fromisoformat(start_date)
+        end = date.fromisoformat(end_date)
+    except ValueError as e:
+        print(str(e))
+        return Response(response="Start or end date does not exist", status=400)
+
+    day_versions = get_availability_versions(start_date, end_date)
+    etag = make_etag("available", start_date, end_date, digest_versions(day_versions))
+    not_modified_response = not_modified(etag)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    appointments = availability_cache.get_range(start, end, day_versions, load_available_appointments)
+    return with_etag(jsonify({"appointments": appointments}), etag)
+
+
+# Server-sent events for every change to a slot's availability on days in [start_date, end_date), so the calendar
+# can update in place instead of polling get_available_appointments. A resync event means changes may have been
+# missed and availability should be fetched again
+@bp.get("/get_availability_feed")
+def get_availability_feed():
+    start_date = request.args.get("start_date")
+    if not validate_date(start_date):
+        return Response(response=f"Invalid start date: {start_date}", status=400)
+
+    end_date = request.args.get("end_date")
+    if not validate_date(end_date):
+        return Response(response=f"Invalid end date: {end_date}", status=400)
+
+    subscription = availability_feed.subscribe()
+    if subscription is None:
+        return Response(
+            response="Availability feed unavailable, fall back to polling",
+            status=503,
+            headers={"Retry-After": "30"},
+        )
+
+    def generate():
+        try:
+            yield RETRY_EVENT
+            while True:
+                try:
+                    change = subscription.changes.get(
+                        timeout=availability_feed.heartbeat_seconds
+                    )
+                except Empty:
+                    # Keeps proxies from closing the connection and notices clients that went away
+                    yield KEEPALIVE_EVENT
+                    continue
+
+                if subscription.resync:
+                    yield RESYNC_EVENT
+                    return
+
+                if change is None or not change_in_range(change, start_date, end_date):
+                    continue
+
+                yield format_slot_event(current_app.json.dumps(change))
+        finally:
+            availability_feed.unsubscribe(subscription)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Shared with the asyncio entry point in asgi.py, which runs the same query on its own engine
+AVAILABLE_APPOINTMENTS_SQL = text(
+    """
+    SELECT appointmentID AS appointment_id, date AS date, hour24 AS hour_24, capacity AS capacity,
+           slotsBooked AS slots_booked
+    FROM AppointmentTimeSlots
+    WHERE date >= :start_date
+      AND date < :end_date
+      AND capacity - slotsBooked > 0
+    ORDER BY date ASC, hour24 ASC;
+    """
+)
+
+
+def load_available_appointments(start_date: date, end_date: date) -> list[dict]:
     records = (
         db.session.execute(
-            text(
-                """
-                SELECT ats.appointmentID AS appointment_id, ats.date AS date, ats.hour24 AS hour_24,
-                       ats.capacity AS capacity, COUNT(b.userID) AS slots_booked
-                FROM AppointmentTimeSlots ats
-                LEFT OUTER JOIN Bookings b
-                    ON ats.appointmentID = b.appointmentID
-                LEFT OUTER JOIN Users u
-                    ON ats.leaderUserID = u.userID
-                WHERE ats.date >= :start_date
-                  AND ats.date < :end_date
-                GROUP BY ats.appointmentID, ats.date, ats.hour24, ats.capacity
-                HAVING ats.capacity - COUNT(b.userID) > 0
-                ORDER BY ats.hour24 ASC;
-                """
-            ),
+            AVAILABLE_APPOINTMENTS_SQL,
             {"start_date": start_date, "end_date": end_date},
         )
         .mappings()
         .fetchall()
     )
 
-    appointments = []
-    for record in records:
-        appointments.append(
-            {
-                "appointment_id": record.get("appointment_id"),
-                "date": str(record.get("date")),
-                "hour_24": record.get("hour_24"),
-                "capacity": record.get("capacity"),
-                "slots_booked": record.get("slots_booked"),
-            }
-        )
+    return [format_available_appointment(record) for record in records]
+
 
-    return jsonify({"appointments": appointments})
+def format_available_appointment(record) -> dict:
+    return {
+        "appointment_id": record.get("appointment_id"),
+        "date": str(record.get("date")),
+        "hour_24": record.get("hour_24"),
+        "capacity": record.get("capacity"),
+        "slots_booked": record.get("slots_booked"),
+    }
 
 
 @bp.get("/get_scheduled_appointments")
@@ -67,36 +166,42 @@ def get_user_appointments():
     if user is None:
         return Response(response="Permission denied", status=401)
 
+    etag = make_etag("scheduled", user.user_id, get_scheduled_appointments_version(user.user_id))
+    not_modified_response = not_modified(etag, private=True)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    appointments: list[dict] | JSONFragment
+    if current_app.config["APPOINTMENT_LISTING_AGGREGATION"] == "postgres":
+        # The array from Postgres is written out as-is rather than parsed and encoded again
+        appointments = JSONFragment(load_user_appointments_json(user.user_id))
+    else:
+        appointments = load_user_appointments(user.user_id)
+
+    return with_etag(jsonify({"appointments": appointments}), etag, private=True)
+
+
+def load_user_appointments(user_id: int) -> list[dict]:
     records = (
         db.session.execute(
             text(
                 """
-                WITH ScheduledAppointments AS (
-                SELECT ats.appointmentID AS appointmentID, ats.date AS date, ats.hour24 AS hour24,
-                       ats.capacity AS capacity, COUNT(b.userID) AS slotsBooked, ats.leaderUserID AS leaderUserID,
-                       ats.subject AS subject, ats.location AS location, ats.confirmationCode AS confirmationCode
+                SELECT ats.appointmentID AS appointment_id, ats.date AS date, ats.hour24 AS hour_24,
+                       ats.capacity AS capacity, ats.slotsBooked AS slots_booked, u1.name AS leader_name,
+                       ats.subject AS subject, ats.location AS location, ats.confirmationCode AS confirmation_code,
+                       u2.name AS user_name, u2.email AS user_email, b.comments AS user_comments
                 FROM AppointmentTimeSlots ats
                 INNER JOIN Bookings b
                     ON ats.appointmentID = b.appointmentID
+                INNER JOIN Users u1
+                    ON ats.leaderUserID = u1.userID
+                INNER JOIN Users u2
+                    ON b.userID = u2.userID
                 WHERE ats.appointmentID IN (SELECT appointmentID FROM Bookings WHERE userID = :user_id)
-                GROUP BY ats.appointmentID, ats.date, ats.hour24, ats.capacity, ats.leaderUserID, ats.subject,
-                         ats.location
-            )
-            SELECT sa.appointmentID AS appointment_id, sa.date AS date, sa.hour24 AS hour_24, sa.capacity AS capacity,
-                   sa.slotsBooked AS slots_booked, u1.name AS leader_name, sa.subject AS subject,
-                   sa.location AS location, sa.confirmationCode AS confirmation_code, u2.name AS user_name,
-                   u2.email AS user_email, b.comments AS user_comments
-            FROM ScheduledAppointments sa
-            INNER JOIN Bookings b
-                ON sa.appointmentID = b.appointmentID
-            INNER JOIN Users u1
-                ON sa.leaderUserID = u1.userID
-            INNER JOIN Users u2
-                ON b.userID = u2.userID
-            ORDER BY sa.date ASC, sa.hour24 ASC, u2.name ASC;
-            """
+                ORDER BY ats.date ASC, ats.hour24 ASC, u2.name ASC;
+                """
             ),
-            {"user_id": user.user_id},
+            {"user_id": user_id},
         )
         .mappings()
         .fetchall()
@@ -144,7 +249,51 @@ def get_user_appointments():
             }
         )
 
-    return jsonify({"appointments": appointments})
+    return appointments
+
+
+# Has Postgres build the JSON array of the user's appointments itself, one object per appointment with everyone's
+# bookings nested in, and returns it as text
+def load_user_appointments_json(user_id: int) -> str:
+    record = (
+        db.session.execute(
+            text(
+                """
+                SELECT CAST(COALESCE(json_agg(json_build_object(
+                           'appointment_id', ats.appointmentID,
+                           'date', ats.date,
+                           'hour_24', ats.hour24,
+                           'capacity', ats.capacity,
+                           'slots_booked', ats.slotsBooked,
+                           'leader_name', u1.name,
+                           'subject', ats.subject,
+                           'location', ats.location,
+                           'confirmation_code', ats.confirmationCode,
+                           'bookings', (
+                               SELECT json_agg(json_build_object(
+                                          'name', u2.name,
+                                          'email', u2.email,
+                                          'comments', b.comments
+                                      ) ORDER BY u2.name ASC)
+                               FROM Bookings b
+                               INNER JOIN Users u2
+                                   ON b.userID = u2.userID
+                               WHERE b.appointmentID = ats.appointmentID
+                           )
+                       ) ORDER BY ats.date ASC, ats.hour24 ASC), '[]') AS TEXT) AS appointments
+                FROM AppointmentTimeSlots ats
+                INNER JOIN Users u1
+                    ON ats.leaderUserID = u1.userID
+                WHERE ats.appointmentID IN (SELECT appointmentID FROM Bookings WHERE userID = :user_id);
+                """
+            ),
+            {"user_id": user_id},
+        )
+        .mappings()
+        .fetchone()
+    )
+
+    return record.get("appointments")
 
 
 @bp.post("/book_new_appointment")
@@ -205,56 +354,70 @@ def book_new_appointment():
         return Response(
             response="Comments length must be at most 512 characters", status=400
         )
-    
+
+    # Checking the slot is empty, reserving it and recording the follow-up task in the outbox happen in one
+    # statement. The slot row is locked first, so a concurrent booking of the same slot waits for this one and then
+    # sees slotsBooked is no longer 0
     record = (
         db.session.execute(
             text(
                 """
-                SELECT COUNT(*) > 0 AS appointment_is_valid
-                FROM AppointmentTimeSlots ats
-                LEFT OUTER JOIN Bookings b
-                    ON ats.appointmentID = b.appointmentID
-                WHERE ats.appointmentID = :appointment_id
-                    AND b.userID IS NULL;
+                WITH Slot AS (
+                    SELECT appointmentID, date
+                    FROM AppointmentTimeSlots
+                    WHERE appointmentID = :appointment_id
+                      AND slotsBooked = 0
+                    FOR UPDATE
+                ), Booked AS (
+                    INSERT INTO Bookings
+                    (appointmentID, userID, bookingTimestamp, comments, pending)
+                    SELECT appointmentID, :user_id, CURRENT_TIMESTAMP, :comments, TRUE
+                    FROM Slot
+                    ON CONFLICT (appointmentID, userID) DO NOTHING
+                    RETURNING appointmentID
+                ), Queued AS (
+                    INSERT INTO Outbox
+                    (taskName, args)
+                    SELECT :task_name, CAST(:task_args AS JSONB)
+                    FROM Booked
+                )
+                SELECT s.date AS date
+                FROM Slot s
+                WHERE EXISTS (SELECT 1 FROM Booked);
                 """
             ),
-            {"appointment_id": appointment_id},
+            {
+                "appointment_id": appointment_id,
+                "user_id": user.user_id,
+                "comments": "",
+                **outbox_params(
+                    book_new_appointment_task,
+                    appointment_id=appointment_id,
+                    user_id=user.user_id,
+                    comments=comments,
+                    subject=subject,
+                    location=location,
+                ),
+            },
         )
         .mappings()
         .fetchone()
     )
-    appointment_is_valid = record.get("appointment_is_valid")
 
     # Conflict error code is used here since if this error occurs it is likely that another person already
     # booked this appointment before the request was processed
-    if not appointment_is_valid:
+    if record is None:
         db.session.rollback()
         return Response(
             response="Appointment does not exist or already has been booked",
             status=409,
         )
 
-    db.session.execute(
-        text(
-            """
-            INSERT INTO Bookings
-            (appointmentID, userID, bookingTimestamp, comments, pending)
-            VALUES
-            (:appointment_id, :user_id, CURRENT_TIMESTAMP, :comments, TRUE);
-            """
-        ),
-        {
-            "appointment_id": appointment_id,
-            "user_id": user.user_id,
-            "comments": "",
-        },
-    )
+    appointment_date = record.get("date")
 
     db.session.commit()
-    
-    with procrastinate_app.open():
-        book_new_appointment_task.defer(appointment_id=appointment_id, user_id=user.user_id, comments=comments, subject=subject, location=location)
-    
+    availability_cache.invalidate(appointment_date)
+
     return jsonify({"message": "Successfully booked appointment"})
 
 
@@ -308,91 +471,94 @@ def book_existing_appointment():
             response="Confirmation code length must be exactly 6 characters", status=400
         )
 
-    tries = 0
+    # Every check, the reservation and its outbox entry happen in one statement against the locked slot row, so
+    # concurrent bookings of the same slot queue up behind each other and each sees the slotsBooked left by the last.
+    # The slot's values are returned either way so a refused booking can be explained
     record = (
         db.session.execute(
             text(
                 """
-                SELECT ats.capacity AS capacity, COUNT(b.userID) AS slots_booked,
-                        ats.leaderUserID AS leader_user_id, ats.confirmationCode AS confirmation_code
-                FROM AppointmentTimeSlots ats
-                LEFT OUTER JOIN Bookings b
-                    ON ats.appointmentID = b.appointmentID
-                WHERE ats.appointmentID = :appointment_id
-                GROUP BY ats.appointmentID, ats.capacity;
+                WITH Slot AS (
+                    SELECT appointmentID, date, capacity, slotsBooked, confirmationCode
+                    FROM AppointmentTimeSlots
+                    WHERE appointmentID = :appointment_id
+                    FOR UPDATE
+                ), Booked AS (
+                    INSERT INTO Bookings
+                    (appointmentID, userID, bookingTimestamp, comments, pending)
+                    SELECT appointmentID, :user_id, CURRENT_TIMESTAMP, :comments, TRUE
+                    FROM Slot
+                    WHERE slotsBooked > 0
+                      AND slotsBooked < capacity
+                      AND (confirmationCode IS NULL OR confirmationCode = :confirmation_code)
+                    ON CONFLICT (appointmentID, userID) DO NOTHING
+                    RETURNING appointmentID
+                ), Queued AS (
+                    INSERT INTO Outbox
+                    (taskName, args)
+                    SELECT :task_name, CAST(:task_args AS JSONB)
+                    FROM Booked
+                )
+                SELECT s.date AS date, s.capacity AS capacity, s.slotsBooked AS slots_booked,
+                       s.confirmationCode AS confirmation_code,
+                       EXISTS (SELECT 1 FROM Booked) AS booked
+                FROM Slot s;
                 """
             ),
-            {"appointment_id": appointment_id},
+            {
+                "appointment_id": appointment_id,
+                "user_id": user.user_id,
+                "comments": comments,
+                "confirmation_code": confirmation_code,
+                **outbox_params(
+                    book_existing_appointment_task,
+                    appointment_id=appointment_id,
+                    user_id=user.user_id,
+                    comments=comments,
+                ),
+            },
         )
         .mappings()
         .fetchone()
     )
 
-    slots_booked = record.get("slots_booked")
-    capacity = record.get("capacity")
-    appointment_confirmation_code = record.get("confirmation_code")
-
-    # Conflict error code is used here since if this error occurs it is likely that others fully booked the
-    # appointment before this request was processed, leading to slots_booked being at/exceeding capacity
-    if slots_booked >= capacity:
-        return Response(response="Appointment already full", status=409)
+    if record is None:
+        db.session.rollback()
+        return Response(response="Appointment does not exist", status=409)
 
-    # Conflict error code is used here since if this error occurs it is likely that the other people who
-    # booked this appointment cancelled it, leading to slots_booked being 0
-    if slots_booked == 0:
-        return Response(
-            response="Appointment is empty; new appointment should be booked",
-            status=409,
-        )
+    if not record.get("booked"):
+        db.session.rollback()
+        slots_booked = record.get("slots_booked")
+        capacity = record.get("capacity")
+        appointment_confirmation_code = record.get("confirmation_code")
+
+        # Conflict error code is used here since if this error occurs it is likely that others fully booked the
+        # appointment before this request was processed, leading to slots_booked being at/exceeding capacity
+        if slots_booked >= capacity:
+            return Response(response="Appointment already full", status=409)
+
+        # Conflict error code is used here since if this error occurs it is likely that the other people who
+        # booked this appointment cancelled it, leading to slots_booked being 0
+        if slots_booked == 0:
+            return Response(
+                response="Appointment is empty; new appointment should be booked",
+                status=409,
+            )
 
-    # If the confirmation codes don't match, don't book the appointment
-    if appointment_confirmation_code is not None:
-        if confirmation_code != appointment_confirmation_code:
-            db.session.rollback()
+        # If the confirmation codes don't match, don't book the appointment
+        if (
+            appointment_confirmation_code is not None
+            and confirmation_code != appointment_confirmation_code
+        ):
             return Response(response="Incorrect confirmation code", status=401)
 
-    record = (
-        db.session.execute(
-            text(
-                """
-                SELECT COUNT(*) > 0 AS already_booked
-                FROM Bookings b
-                WHERE b.appointmentID = :appointment_id
-                    AND b.userID = :user_id;
-                """
-            ),
-            {"appointment_id": appointment_id, "user_id": user.user_id},
-        )
-        .mappings()
-        .fetchone()
-    )
-
-    # If the user has already booked the appointment, don't book another slot
-    if record != None and record.get("already_booked"):
-        db.session.rollback()
+        # Otherwise the insert hit the unique index, so the user has already booked the appointment
         return Response("Already booked this appointment", status=409)
 
-    # Now that we know there's enough slots, reserve it
-    db.session.execute(
-        text(
-            """
-            INSERT INTO Bookings
-            (appointmentID, userID, bookingTimestamp, comments, pending)
-            VALUES
-            (:appointment_id, :user_id, CURRENT_TIMESTAMP, :comments, TRUE);
-            """
-        ),
-        {
-            "appointment_id": appointment_id,
-            "user_id": user.user_id,
-            "comments": comments,
-        },
-    )
+    appointment_date = record.get("date")
 
     db.session.commit()
-
-    with procrastinate_app.open():
-        book_new_appointment_task.defer(appointment_id=appointment_id, user_id=user.user_id, comments=comments)
+    availability_cache.invalidate(appointment_date)
 
     return jsonify({"message": "Successfully booked appointment"})
 
@@ -431,17 +597,32 @@ def cancel_appointment():
             status=400,
         )
 
-    tries = 0
+    # The booking itself is removed by the task, this only checks it exists and records the task in the outbox
     record = (
         db.session.execute(
             text(
                 """
-                SELECT *
-                FROM Bookings
-                WHERE userID = :user_id AND appointmentID = :appointment_id;
+                WITH Booking AS (
+                    SELECT appointmentID
+                    FROM Bookings
+                    WHERE userID = :user_id AND appointmentID = :appointment_id
+                ), Queued AS (
+                    INSERT INTO Outbox
+                    (taskName, args)
+                    SELECT :task_name, CAST(:task_args AS JSONB)
+                    FROM Booking
+                )
+                SELECT appointmentID AS appointment_id
+                FROM Booking;
                 """
             ),
-            {"user_id": user.user_id, "appointment_id": appointment_id},
+            {
+                "user_id": user.user_id,
+                "appointment_id": appointment_id,
+                **outbox_params(
+                    cancel_appointment_task, appointment_id=appointment_id, user_id=user.user_id
+                ),
+            },
         )
         .mappings()
         .fetchone()
@@ -456,7 +637,4 @@ def cancel_appointment():
 
     db.session.commit()
 
-    with procrastinate_app.open():
-        cancel_appointment_task.defer(appointment_id=appointment_id, user_id=user.user_id)
-
     return jsonify({"message": "Successfully cancelled appointment"})
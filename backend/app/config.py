@@ -1,4 +1,5 @@
 from configparser import ConfigParser
+from .pool import MonitoredQueuePool
 import os
 
 dirname = os.path.dirname(__file__)
@@ -17,14 +18,142 @@ class Config:
     DB_HOST = config["credentials.database"]["host"]
     DB_PORT = config["credentials.database"]["port"]
     DB_NAME = config["credentials.database"]["name"]
+    # Connections per worker process; a request waiting longer than the pool timeout for one fails instead
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 5
+    DB_POOL_TIMEOUT_SECONDS = 10
+    DB_POOL_RECYCLE_SECONDS = 1800
+    DB_POOL_PRE_PING = True
+    # Any single statement running longer than this is cancelled by Postgres
+    DB_STATEMENT_TIMEOUT_MS = 10000
+    # Connections held longer than this are counted as leaks in the db_pool metrics
+    DB_CONNECTION_LEAK_SECONDS = 60
+    # Transactions that hit a serialization failure or deadlock get this many attempts in all, with jittered backoff
+    # doubling from the first value up to the second between them, as long as each can start before the deadline
+    TRANSACTION_RETRY_ATTEMPTS = 3
+    TRANSACTION_RETRY_BACKOFF_SECONDS = 0.05
+    TRANSACTION_RETRY_MAX_BACKOFF_SECONDS = 1.0
+    TRANSACTION_RETRY_DEADLINE_SECONDS = 2.0
+    MIGRATE_ON_STARTUP = True
+    # Availability is cached per day; "memory" keeps it in each process, "none" disables caching
+    AVAILABILITY_CACHE_BACKEND = "memory"
+    AVAILABILITY_CACHE_MAX_SIZE = 1024
+    AVAILABILITY_CACHE_TTL_SECONDS = 300
+    AVAILABILITY_CACHE_MAX_DAYS = 62
+    # Users and their roles looked up from access tokens. Each request still checks the user's token version, so
+    # role changes and deleted accounts reject older tokens right away
+    IDENTITY_CACHE_BACKEND = "memory"
+    IDENTITY_CACHE_MAX_SIZE = 4096
+    IDENTITY_CACHE_TTL_SECONDS = 60
+    # bcrypt cost for new hashes; passwords stored with a different cost are rehashed on their next login
+    PASSWORD_HASH_ROUNDS = 12
+    # Processes per worker for hashing (0 hashes inline), how many more hashes may wait before returning 503, and
+    # how long a request waits for its hash before giving up with a 503
+    PASSWORD_HASH_POOL_SIZE = 2
+    PASSWORD_HASH_MAX_PENDING = 8
+    PASSWORD_HASH_TIMEOUT_SECONDS = 3.0
+    # gunicorn or uvicorn worker processes, and threads per gunicorn worker, as passed to -w or --workers and to
+    # --threads in the Dockerfile
+    WEB_PROCESSES = 4
+    WSGI_THREADS = 32
+    # Server-sent availability changes per process. Under uvicorn an open feed only costs a coroutine, but under
+    # gunicorn each holds one of the worker's threads until it closes, so those feeds have a lower cap that leaves
+    # most of the threads to every other route
+    AVAILABILITY_FEED_ENABLED = True
+    AVAILABILITY_FEED_MAX_SUBSCRIBERS = 100
+    AVAILABILITY_FEED_QUEUE_SIZE = 256
+    AVAILABILITY_FEED_HEARTBEAT_SECONDS = 15
+    # "postgres" shares login attempt counts between every worker, "memory" keeps them per process
+    LOGIN_RATE_LIMIT_STORE = "postgres"
+    LOGIN_RATE_LIMIT_PER_IP = 30
+    LOGIN_RATE_LIMIT_PER_IP_WINDOW_SECONDS = 60
+    LOGIN_RATE_LIMIT_PER_EMAIL = 10
+    LOGIN_RATE_LIMIT_PER_EMAIL_WINDOW_SECONDS = 300
+    # Most time slots one add_appointment_time_slots request may create, roughly a semester of hourly slots
+    ADMIN_MAX_BULK_TIME_SLOTS = 5000
+    # Most hour ranges one recurrence may list; more than 24 can only repeat hours
+    ADMIN_MAX_RECURRENCE_HOUR_RANGES = 24
+    # "orjson" encodes responses with orjson when it's installed, "stdlib" always uses the json module
+    JSON_PROVIDER = "orjson"
+    # "postgres" has appointment listings built as JSON by the database, "python" groups their rows in Python
+    APPOINTMENT_LISTING_AGGREGATION = "postgres"
+    # Largest page get_all_appointments returns when asked to paginate
+    ADMIN_APPOINTMENTS_MAX_PAGE_SIZE = 1000
+    # Used by the asyncio entry point in asgi.py: its engine's pool, and the threads running every other route
+    ASYNC_DB_POOL_SIZE = 10
+    ASYNC_DB_MAX_OVERFLOW = 10
+    ASGI_WSGI_THREADS = 32
+    # Task worker processes, and how many jobs of each queue one process runs at once. Queues missing here aren't
+    # worked on. Every running job holds a connection from the process' DB pool, so the total has to fit in it
+    WORKER_PROCESSES = 2
+    WORKER_QUEUE_CONCURRENCY = {"bookings": 4, "maintenance": 1}
+    # How long a stopping worker waits for its running jobs
+    WORKER_SHUTDOWN_GRACE_SECONDS = 20
+    # How often each worker process logs the throughput of its queues
+    WORKER_STATS_INTERVAL_SECONDS = 60
+    # Connections each worker process keeps for fetching jobs, including one listening for new ones per queue
+    WORKER_DB_POOL_SIZE = 6
+    # Outbox rows the worker's relay turns into jobs per transaction, and how often it checks without being notified
+    OUTBOX_RELAY_BATCH_SIZE = 500
+    OUTBOX_RELAY_POLL_SECONDS = 5
+    # "resend" sends emails through the Resend batch API, "fake" only keeps them in memory
+    EMAIL_TRANSPORT = "resend"
+    # Pending emails the worker's sender sends per batch request, and how often it checks without being notified
+    EMAIL_BATCH_SIZE = 100
+    EMAIL_SENDER_POLL_SECONDS = 5
+    # How long a claimed batch is left to its sender before another may take it, in case the sender died mid-send
+    EMAIL_CLAIM_SECONDS = 60
+    # Attempts per email before it is given up on, with jittered backoff doubling from the first value up to the
+    # second between the attempts of a batch whose request failed
+    EMAIL_SEND_ATTEMPTS = 8
+    EMAIL_RETRY_BACKOFF_SECONDS = 1.0
+    EMAIL_RETRY_MAX_BACKOFF_SECONDS = 300.0
+    # Number of reverse proxies in front of the app whose X-Forwarded-For should be trusted for client IPs
+    PROXY_FIX_X_FOR = 0
 
     @property
     def SQLALCHEMY_DATABASE_URI(self):
         return f"postgresql+psycopg://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
 
+    # A quarter of the threads, for the feeds that hold one
+    @property
+    def AVAILABILITY_FEED_MAX_THREAD_SUBSCRIBERS(self):
+        return self.WSGI_THREADS // 4
+
+    # For connecting with psycopg directly, which doesn't understand SQLAlchemy's driver suffix
+    @property
+    def DB_CONNINFO(self):
+        return f"postgresql://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
+
+    @property
+    def SQLALCHEMY_ENGINE_OPTIONS(self):
+        return {
+            "poolclass": MonitoredQueuePool,
+            "pool_size": self.DB_POOL_SIZE,
+            "max_overflow": self.DB_MAX_OVERFLOW,
+            "pool_timeout": self.DB_POOL_TIMEOUT_SECONDS,
+            "pool_recycle": self.DB_POOL_RECYCLE_SECONDS,
+            "pool_pre_ping": self.DB_POOL_PRE_PING,
+            "connect_args": {"options": f"-c statement_timeout={self.DB_STATEMENT_TIMEOUT_MS}"},
+        }
 
+
+# Postgres' default max_connections is 100, 3 of which are kept for superusers. Each of the WEB_PROCESSES uses up
+# to DB_POOL_SIZE + DB_MAX_OVERFLOW connections and 1 for its availability feed listener, and under uvicorn another
+# ASYNC_DB_POOL_SIZE + ASYNC_DB_MAX_OVERFLOW for its async engine: 4 * 13 = 52 under gunicorn, 4 * 18 = 72 under
+# uvicorn. The task worker's process uses 5 connections for running jobs and 6 for procrastinate, and the
+# supervisor's outbox relay and email sender 2 each, which is 15 more and leaves room for psql and migrations either
+# way
 class ProductionConfig(Config):
     JWT_COOKIE_SECURE = True
+    DB_POOL_SIZE = 8
+    DB_MAX_OVERFLOW = 4
+    DB_STATEMENT_TIMEOUT_MS = 5000
+    ASYNC_DB_POOL_SIZE = 4
+    ASYNC_DB_MAX_OVERFLOW = 1
+    WORKER_PROCESSES = 1
+    # Caddy
+    PROXY_FIX_X_FOR = 1
 
 
 class DevelopmentConfig(Config):
@@ -34,3 +163,24 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     DB_NAME = config["credentials.test_database"]["name"]
+    # Tests recreate the tables from data.sql, so conftest applies migrations after loading it
+    MIGRATE_ON_STARTUP = False
+    PASSWORD_HASH_ROUNDS = 4
+    PASSWORD_HASH_POOL_SIZE = 0
+    LOGIN_RATE_LIMIT_STORE = "memory"
+    EMAIL_TRANSPORT = "fake"
+    AVAILABILITY_FEED_HEARTBEAT_SECONDS = 1
+    # Fail fast on a leaked connection instead of hanging the suite
+    DB_POOL_TIMEOUT_SECONDS = 5
+
+
+configs = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+}
+
+
+# The config named by FLASK_ENV, for the entry points that aren't started through the flask CLI: gunicorn, uvicorn
+# and the task worker
+def config_from_env() -> Config:
+    return configs.get(os.environ.get("FLASK_ENV", "development"), DevelopmentConfig)()
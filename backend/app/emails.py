@@ -1,39 +1,375 @@
 import resend
+from abc import ABC, abstractmethod
+from resend.exceptions import ApplicationError, RateLimitError, ResendError
+from sqlalchemy import text
+from threading import Event, Lock, Thread
 from .config import config
+from .db import db
+from .metrics import register_metrics
+import hashlib
+import json
+import psycopg
+import random
+import time
 
 resend.api_key = config["credentials.email"]["api_key"]
 
+# Resend takes at most this many emails per batch request
+RESEND_MAX_BATCH_SIZE = 100
 
-def send_book_appointment_confirmation_email(email_address: str, name: str, appointment_date: str, appointment_time: str):
-    try:
-        resend.Emails.send({
-            "from": "noreply <noreply@tutoring.existingeevee.org>",
-            "to": email_address,
-            "template": {
-                "id": "booking-confirmation",
-                "variables": {
-                    "NAME": name,
-                    "APPOINTMENT_DATE": appointment_date,
-                    "APPOINTMENT_TIME": appointment_time
-                }
+CHANNEL = "emails"
+
+
+def template_email(template_id: str, email_address: str, name: str, appointment_date: str, appointment_time: str) -> dict:
+    return {
+        "from": "noreply <noreply@tutoring.existingeevee.org>",
+        "to": email_address,
+        "template": {
+            "id": template_id,
+            "variables": {
+                "NAME": name,
+                "APPOINTMENT_DATE": appointment_date,
+                "APPOINTMENT_TIME": appointment_time
+            }
+        }
+    }
+
+
+def book_appointment_confirmation_email(email_address: str, name: str, appointment_date: str, appointment_time: str) -> dict:
+    return template_email("booking-confirmation", email_address, name, appointment_date, appointment_time)
+
+
+def cancel_appointment_confirmation_email(email_address: str, name: str, appointment_date: str, appointment_time: str) -> dict:
+    return template_email("cancellation-confirmation", email_address, name, appointment_date, appointment_time)
+
+
+class EmailTransport(ABC):
+    # Sends the emails in one request, returning why the API rejected each one it did, by its index, and sending the
+    # rest. Raises if the request as a whole failed. The idempotency key is the same for every attempt at one batch
+    @abstractmethod
+    def send_batch(self, emails: list[dict], idempotency_key: str) -> dict[int, str]:
+        pass
+
+    # Whether a failed request is worth trying again
+    @abstractmethod
+    def is_retryable(self, e: Exception) -> bool:
+        pass
+
+
+class ResendTransport(EmailTransport):
+    def send_batch(self, emails: list[dict], idempotency_key: str) -> dict[int, str]:
+        # Permissive validation sends every valid email in the batch and reports the invalid ones, instead of
+        # rejecting all of them for one bad address
+        response = resend.Batch.send(
+            emails, {"idempotency_key": idempotency_key, "batch_validation": "permissive"}
+        )
+        return {error["index"]: error["message"] for error in response.get("errors", [])}
+
+    def is_retryable(self, e: Exception) -> bool:
+        # Anything the API rejected outright, like a malformed email or a bad API key, fails the same way every time
+        return isinstance(e, (RateLimitError, ApplicationError)) or not isinstance(e, ResendError)
+
+
+# Keeps what would have been sent, for tests and local development. Emails to the rejected addresses are reported as
+# invalid, and the next fail_next requests raise failure
+class FakeTransport(EmailTransport):
+    def __init__(self):
+        self.batches: list[list[dict]] = []
+        self.rejected_addresses: set[str] = set()
+        self.fail_next = 0
+        self.failure: Exception = ConnectionError("Fake transport failure")
+        self._lock = Lock()
+
+    def send_batch(self, emails: list[dict], idempotency_key: str) -> dict[int, str]:
+        with self._lock:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                raise self.failure
+
+            rejected = {
+                index: f"Invalid `to` field: {email['to']}"
+                for index, email in enumerate(emails)
+                if email["to"] in self.rejected_addresses
             }
-        })
-    except Exception as e:
-        print(e)
-
-def send_cancel_appointment_confirmation_email(email_address: str, name: str, appointment_date: str, appointment_time: str):
-    try:
-        resend.Emails.send({
-            "from": "noreply <noreply@tutoring.existingeevee.org>",
-            "to": email_address,
-            "template": {
-                "id": "cancellation-confirmation",
-                "variables": {
-                    "NAME": name,
-                    "APPOINTMENT_DATE": appointment_date,
-                    "APPOINTMENT_TIME": appointment_time
-                }
+            self.batches.append([email for index, email in enumerate(emails) if index not in rejected])
+            return rejected
+
+    def is_retryable(self, e: Exception) -> bool:
+        return isinstance(e, ConnectionError)
+
+    @property
+    def sent(self) -> list[dict]:
+        with self._lock:
+            return [email for batch in self.batches for email in batch]
+
+
+def create_email_transport(backend: str) -> EmailTransport:
+    if backend == "resend":
+        return ResendTransport()
+    if backend == "fake":
+        return FakeTransport()
+
+    raise ValueError(f"Unknown email transport: {backend}")
+
+
+# Records the emails to be sent once the caller's transaction commits, alongside the change they tell users about.
+# They are sent by the email sender of whichever worker is running then, so a job or process dying afterwards
+# can't lose them
+def queue_emails(emails: list[dict]):
+    db.session.execute(
+        text(
+            """
+            INSERT INTO PendingEmails
+            (email)
+            SELECT value
+            FROM jsonb_array_elements(CAST(:emails AS JSONB));
+            """
+        ),
+        {"emails": json.dumps(emails)},
+    )
+
+
+# Sends the emails in PendingEmails in batches, in a thread of the task worker, whenever some are added and every
+# poll interval in case a notification was missed. A batch is claimed in one short transaction, sent outside of any,
+# and settled in a second one, so no connection or row lock is held while waiting on the email API. Sent emails are
+# deleted, and ones the API rejected are kept with the reason. A request failing as a whole releases its emails to
+# be sent again after a jittered backoff that doubles with each attempt, under the same idempotency key, until they
+# run out of attempts. Claims of a sender that died mid-send expire, and the emails are sent again
+class EmailSender:
+    def __init__(self):
+        self.app = None
+        self.conninfo = ""
+        self.transport: EmailTransport = FakeTransport()
+        self.batch_size = RESEND_MAX_BATCH_SIZE
+        self.poll_seconds = 5
+        self.claim_seconds = 60
+        self.max_attempts = 4
+        self.backoff_seconds = 0.5
+        self.max_backoff_seconds = 60.0
+        self._thread: Thread | None = None
+        self._stopping = Event()
+        self._lock = Lock()
+        self.sent = 0
+        self.rejected = 0
+        self.batches = 0
+        self.retries = 0
+        self.errors = 0
+        self.send_seconds = 0.0
+        self.max_send_seconds = 0.0
+
+    def init_app(self, app):
+        self.app = app
+        self.conninfo = app.config["DB_CONNINFO"]
+        self.transport = create_email_transport(app.config["EMAIL_TRANSPORT"])
+        self.batch_size = min(app.config["EMAIL_BATCH_SIZE"], RESEND_MAX_BATCH_SIZE)
+        self.poll_seconds = app.config["EMAIL_SENDER_POLL_SECONDS"]
+        self.claim_seconds = app.config["EMAIL_CLAIM_SECONDS"]
+        self.max_attempts = app.config["EMAIL_SEND_ATTEMPTS"]
+        self.backoff_seconds = app.config["EMAIL_RETRY_BACKOFF_SECONDS"]
+        self.max_backoff_seconds = app.config["EMAIL_RETRY_MAX_BACKOFF_SECONDS"]
+        register_metrics("emails", self.stats)
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, name="email-sender", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    # Claims up to batch_size pending emails that are due, oldest first. SKIP LOCKED keeps senders in other workers
+    # from waiting on each other, and the claim keeps them off these emails once this transaction commits
+    def _claim(self) -> list:
+        records = (
+            db.session.execute(
+                text(
+                    """
+                    UPDATE PendingEmails
+                    SET claimedAt = LOCALTIMESTAMP, attempts = attempts + 1
+                    WHERE emailID IN (
+                        SELECT emailID
+                        FROM PendingEmails
+                        WHERE failedReason IS NULL
+                          AND nextAttemptAt <= LOCALTIMESTAMP
+                          AND (claimedAt IS NULL OR claimedAt < LOCALTIMESTAMP - make_interval(secs => :claim_seconds))
+                        ORDER BY emailID ASC
+                        LIMIT :batch_size
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING emailID AS email_id, email, attempts;
+                    """
+                ),
+                {"batch_size": self.batch_size, "claim_seconds": self.claim_seconds},
+            )
+            .mappings()
+            .fetchall()
+        )
+        db.session.commit()
+
+        return sorted(records, key=lambda record: record.get("email_id"))
+
+    # Sends up to batch_size pending emails and returns how many were claimed
+    def send_batch(self) -> int:
+        records = self._claim()
+        if len(records) == 0:
+            return 0
+
+        email_ids = [record.get("email_id") for record in records]
+        start = time.perf_counter()
+        try:
+            rejected = self._send([record.get("email") for record in records], email_ids)
+        except Exception as e:
+            print(e)
+            self._release(email_ids, max(record.get("attempts") for record in records), str(e))
+            return len(records)
+        elapsed = time.perf_counter() - start
+
+        db.session.execute(
+            text(
+                """
+                DELETE FROM PendingEmails
+                WHERE emailID = ANY(:email_ids);
+                """
+            ),
+            {"email_ids": [email_id for index, email_id in enumerate(email_ids) if index not in rejected]},
+        )
+        if len(rejected) > 0:
+            db.session.execute(
+                text(
+                    """
+                    UPDATE PendingEmails p
+                    SET failedReason = r.reason, claimedAt = NULL
+                    FROM UNNEST(CAST(:email_ids AS BIGINT[]), CAST(:reasons AS TEXT[])) AS r(emailID, reason)
+                    WHERE p.emailID = r.emailID;
+                    """
+                ),
+                {
+                    "email_ids": [email_ids[index] for index in rejected],
+                    "reasons": list(rejected.values()),
+                },
+            )
+        db.session.commit()
+
+        for index, reason in rejected.items():
+            print(f"Email {email_ids[index]} was rejected: {reason}")
+        with self._lock:
+            self.sent += len(records) - len(rejected)
+            self.rejected += len(rejected)
+            self.batches += 1
+            self.send_seconds += elapsed
+            self.max_send_seconds = max(self.max_send_seconds, elapsed)
+        return len(records)
+
+    # Hands a batch whose request failed back to be sent again after a backoff, or gives up on the emails that have
+    # had all their attempts
+    def _release(self, email_ids: list[int], attempts: int, reason: str):
+        backoff = random.uniform(0, min(self.backoff_seconds * 2 ** (attempts - 1), self.max_backoff_seconds))
+        db.session.execute(
+            text(
+                """
+                UPDATE PendingEmails
+                SET claimedAt = NULL,
+                    nextAttemptAt = LOCALTIMESTAMP + make_interval(secs => :backoff_seconds),
+                    failedReason = CASE WHEN attempts >= :max_attempts THEN :reason ELSE NULL END
+                WHERE emailID = ANY(:email_ids);
+                """
+            ),
+            {
+                "email_ids": email_ids,
+                "backoff_seconds": backoff,
+                "max_attempts": self.max_attempts,
+                "reason": reason,
+            },
+        )
+        db.session.commit()
+
+        with self._lock:
+            self.retries += 1
+
+    # The same emails get the same idempotency key however many times they are sent
+    def _send(self, emails: list[dict], email_ids: list[int]) -> dict[int, str]:
+        idempotency_key = "emails-" + hashlib.sha256(",".join(map(str, email_ids)).encode()).hexdigest()
+        try:
+            return self.transport.send_batch(emails, idempotency_key)
+        except Exception as e:
+            if self.transport.is_retryable(e):
+                raise
+            if len(emails) == 1:
+                return {0: str(e)}
+
+            # Something in the batch made the API refuse the whole request, so each email is sent on its own to
+            # find out which
+            print(e)
+            rejected = {}
+            for index, email in enumerate(emails):
+                reasons = self._send([email], [email_ids[index]])
+                if len(reasons) > 0:
+                    rejected[index] = reasons[0]
+            return rejected
+
+    def send_all(self) -> int:
+        sent = 0
+        with self.app.app_context():
+            while True:
+                count = self.send_batch()
+                sent += count
+
+                if count < self.batch_size:
+                    return sent
+
+    def _run(self):
+        retry_seconds = 1
+        while not self._stopping.is_set():
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as connection:
+                    connection.execute(f"LISTEN {CHANNEL};")
+
+                    while not self._stopping.is_set():
+                        # Listening first means nothing committed from here on goes unnoticed
+                        self.send_all()
+                        retry_seconds = 1
+                        for _ in connection.notifies(timeout=self.poll_seconds, stop_after=1):
+                            pass
+            except Exception as e:
+                print(e)
+                with self._lock:
+                    self.errors += 1
+
+            self._stopping.wait(retry_seconds)
+            retry_seconds = min(2 * retry_seconds, 60)
+
+    def stats(self) -> dict:
+        # Counted from the table, so that every process reports the emails waiting on whichever worker sends them
+        record = (
+            db.session.execute(
+                text(
+                    """
+                    SELECT COUNT(*) FILTER (WHERE failedReason IS NULL) AS pending,
+                           COUNT(*) FILTER (WHERE failedReason IS NOT NULL) AS failed
+                    FROM PendingEmails;
+                    """
+                )
+            )
+            .mappings()
+            .fetchone()
+        )
+
+        with self._lock:
+            return {
+                "pending": record.get("pending"),
+                "failed": record.get("failed"),
+                "sent": self.sent,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "retries": self.retries,
+                "errors": self.errors,
+                "average_send_milliseconds": (
+                    1000 * self.send_seconds / self.batches if self.batches > 0 else 0.0
+                ),
+                "max_send_milliseconds": 1000 * self.max_send_seconds,
             }
-        })
-    except Exception as e:
-        print(e)
+
+
+email_sender = EmailSender()
@@ -0,0 +1,88 @@
+from flask import request, Response
+from sqlalchemy import text
+from .db import db
+import hashlib
+
+
+def make_etag(*parts) -> str:
+    return ":".join(str(part) for part in parts)
+
+
+def not_modified(etag: str, private: bool = False) -> Response | None:
+    if not request.if_none_match.contains(etag):
+        return None
+
+    return with_etag(Response(status=304), etag, private)
+
+
+def with_etag(response: Response, etag: str, private: bool = False) -> Response:
+    response.set_etag(etag)
+    # Browsers keep the response but must revalidate it, which is what sends If-None-Match back to us
+    response.headers["Cache-Control"] = "private, no-cache" if private else "no-cache"
+    return response
+
+
+# A digest of every stamp a response depends on, keyed by what each one stamps. Stamps are handed out when a
+# statement runs rather than when its transaction commits, so an older stamp can become visible after a newer one
+# already is. The MAX of the stamps would miss that change, but the set of them can't, since a row never gets a
+# stamp it had before
+def digest_versions(versions: dict) -> str:
+    pairs = ",".join(f"{key}={versions[key]}" for key in sorted(versions))
+    return hashlib.sha256(pairs.encode("utf-8")).hexdigest()[:32]
+
+
+def get_availability_version(start_date: str, end_date: str) -> str:
+    return digest_versions(get_availability_versions(start_date, end_date))
+
+
+AVAILABILITY_VERSIONS_SQL = text(
+    """
+    SELECT date AS date, version AS version
+    FROM AvailabilityVersions
+    WHERE date >= :start_date
+      AND date < :end_date;
+    """
+)
+
+
+def get_availability_versions(start_date: str, end_date: str) -> dict[str, int]:
+    records = (
+        db.session.execute(
+            AVAILABILITY_VERSIONS_SQL,
+            {"start_date": start_date, "end_date": end_date},
+        )
+        .mappings()
+        .fetchall()
+    )
+
+    return format_availability_versions(records)
+
+
+def format_availability_versions(records) -> dict[str, int]:
+    return {str(record.get("date")): record.get("version") for record in records}
+
+
+# The user's own stamp and the stamp of every slot they booked
+def get_scheduled_appointments_version(user_id: int) -> str:
+    records = (
+        db.session.execute(
+            text(
+                """
+                SELECT 'user' AS key, u.version AS version
+                FROM Users u
+                WHERE u.userID = :user_id
+                UNION ALL
+                SELECT CAST(ats.appointmentID AS TEXT) AS key, ats.version AS version
+                FROM Bookings b
+                INNER JOIN AppointmentTimeSlots ats
+                    ON b.appointmentID = ats.appointmentID
+                WHERE b.userID = :user_id;
+                """
+            ),
+            {"user_id": user_id},
+        )
+        .mappings()
+        .fetchall()
+    )
+
+    return digest_versions({record.get("key"): record.get("version") for record in records})
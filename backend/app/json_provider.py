@@ -0,0 +1,97 @@
+from datetime import date
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+from typing import Any
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# JSON that has already been encoded, e.g. by Postgres, and should be written into a response as-is
+class JSONFragment:
+    def __init__(self, raw: str | bytes):
+        self.raw = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+
+
+def encode_default(o: Any) -> Any:
+    # Dates go out as ISO 8601, which is what the frontend parses, instead of Flask's HTTP date format
+    if isinstance(o, date):
+        return o.isoformat()
+
+    return DefaultJSONProvider.default(o)
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        # The json module can't write raw JSON, so fragments are encoded as a marker string unique to this call
+        # followed by their index, then swapped for their raw JSON afterwards
+        fragment_marker = f"json-fragment-{uuid.uuid4().hex}-"
+        fragments: list[str] = []
+
+        def default_with_fragments(o: Any) -> Any:
+            if isinstance(o, JSONFragment):
+                fragments.append(o.raw)
+                return f"{fragment_marker}{len(fragments) - 1}"
+
+            return encode_default(o)
+
+        kwargs.setdefault("default", default_with_fragments)
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        kwargs.setdefault("separators", (",", ":"))
+        encoded = json.dumps(obj, **kwargs)
+
+        for index, raw in enumerate(fragments):
+            encoded = encoded.replace(
+                json.dumps(f"{fragment_marker}{index}", ensure_ascii=kwargs["ensure_ascii"]),
+                raw,
+                1,
+            )
+
+        return encoded
+
+
+class OrjsonJSONProvider(JSONProvider):
+    mimetype = "application/json"
+    # Keys come out sorted like they do from Flask's default provider. Fragments are written as they are, so keys
+    # inside JSON built by Postgres keep the order the query gives them with either provider
+    sort_keys = True
+
+    @staticmethod
+    def default(o: Any) -> Any:
+        if isinstance(o, JSONFragment):
+            return orjson.Fragment(o.raw)
+
+        return encode_default(o)
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return self.dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        # orjson already produces bytes, so they go into the response without a round trip through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+
+def create_json_provider(app, backend: str) -> JSONProvider:
+    if backend == "orjson":
+        # orjson is optional; without it responses come out the same, just encoded more slowly
+        if orjson is not None:
+            return OrjsonJSONProvider(app)
+        return StdlibJSONProvider(app)
+    if backend == "stdlib":
+        return StdlibJSONProvider(app)
+
+    raise ValueError(f"Unknown JSON provider: {backend}")
@@ -1,29 +1,86 @@
 from flask_jwt_extended import JWTManager
 from sqlalchemy import text
+from .cache import Cache, NullCache, create_cache
+from .metrics import register_metrics
 from .user import User
 from .db import db
 
 jwt = JWTManager()
 
 
-@jwt.user_identity_loader
-def user_identity_lookup(user):
-    return str(user.user_id)
+# Keeps the user (and their roles) loaded for a token across requests, keyed by the user and the token version their
+# roles were loaded at. A role change bumps the token version, so entries from before it are never used again
+class IdentityCache:
+    def __init__(self):
+        self.cache: Cache = NullCache()
 
+    def init_app(self, app):
+        self.cache = create_cache(
+            app.config["IDENTITY_CACHE_BACKEND"],
+            app.config["IDENTITY_CACHE_MAX_SIZE"],
+            app.config["IDENTITY_CACHE_TTL_SECONDS"],
+        )
+        register_metrics("identity_cache", self.stats)
 
-@jwt.user_lookup_loader
-def user_lookup_callback(_jwt_header, jwt_data):
-    identity = jwt_data["sub"]
+    def _key(self, user_id: str, token_version: int) -> str:
+        return f"{user_id}:{token_version}"
+
+    def get(self, user_id: str, token_version: int) -> User | None:
+        return self.cache.get(self._key(user_id, token_version))
+
+    def set(self, user_id: str, token_version: int, user: User):
+        self.cache.set(self._key(user_id, token_version), user)
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        return {
+            **stats,
+            "hit_ratio": stats.get("hits", 0) / lookups if lookups > 0 else 0.0,
+        }
+
+
+identity_cache = IdentityCache()
+
+
+def load_token_version(user_id: int | str) -> int | None:
     record = (
         db.session.execute(
             text(
                 """
-                SELECT *
+                SELECT tokenVersion AS token_version
                 FROM Users
                 WHERE userID = :user_id;
                 """
             ),
-            {"user_id": identity},
+            {"user_id": user_id},
+        )
+        .mappings()
+        .fetchone()
+    )
+
+    if record is None:
+        return None
+
+    return record.get("token_version")
+
+
+def load_user(user_id: int | str) -> User | None:
+    record = (
+        db.session.execute(
+            text(
+                """
+                SELECT u.userID AS user_id, u.name AS name, u.email AS email, u.version AS version,
+                       u.tokenVersion AS token_version,
+                       COALESCE(array_agg(ur.userRole) FILTER (WHERE ur.userRole IS NOT NULL), '{}') AS roles
+                FROM Users u
+                LEFT OUTER JOIN UserRoles ur
+                    ON u.userID = ur.userID
+                WHERE u.userID = :user_id
+                GROUP BY u.userID;
+                """
+            ),
+            {"user_id": user_id},
         )
         .mappings()
         .fetchone()
@@ -33,7 +90,42 @@ def user_lookup_callback(_jwt_header, jwt_data):
         return None
 
     return User(
-        user_id=record.get("userid"),
+        user_id=record.get("user_id"),
         name=record.get("name"),
         email=record.get("email"),
+        version=record.get("version"),
+        roles=record.get("roles"),
+        token_version=record.get("token_version"),
     )
+
+
+@jwt.user_identity_loader
+def user_identity_lookup(user):
+    return str(user.user_id)
+
+
+@jwt.additional_claims_loader
+def add_claims_to_access_token(user):
+    return {"roles": user.roles, "token_version": user.token_version}
+
+
+@jwt.user_lookup_loader
+def user_lookup_callback(_jwt_header, jwt_data):
+    identity = jwt_data["sub"]
+    token_version = jwt_data.get("token_version", 0)
+
+    # Checked against the database on every request, with one primary key lookup, so a role change or a deleted
+    # account rejects older tokens in every process at once. The roles in the token are stale once the user's token
+    # version moves on, so they have to log in again
+    if load_token_version(identity) != token_version:
+        return None
+
+    user = identity_cache.get(identity, token_version)
+    if user is None:
+        user = load_user(identity)
+        # Changed again since the check above
+        if user is None or user.token_version != token_version:
+            return None
+        identity_cache.set(identity, token_version, user)
+
+    return user
@@ -0,0 +1,11 @@
+from typing import Callable
+
+_metrics_providers: dict[str, Callable[[], dict]] = dict()
+
+
+def register_metrics(name: str, provider: Callable[[], dict]):
+    _metrics_providers[name] = provider
+
+
+def collect_metrics() -> dict[str, dict]:
+    return {name: provider() for name, provider in _metrics_providers.items()}
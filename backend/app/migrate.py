@@ -0,0 +1,104 @@
+import click
+import os
+import re
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from .db import db
+from .tasks import apply_job_schema
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+MIGRATION_FILENAME_PATTERN = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+# Every process that calls create_app() tries to migrate, so they serialize on this advisory lock key
+MIGRATION_LOCK_KEY = 7_291_104
+
+
+class Migration:
+    def __init__(self, version: int, name: str, sql: str):
+        self.version = version
+        self.name = name
+        self.sql = sql
+
+    def __repr__(self):
+        return f"Migration: <version: {self.version}, name: {self.name}>"
+
+
+def get_migrations() -> list[Migration]:
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILENAME_PATTERN.match(filename)
+        if match is None:
+            continue
+
+        with open(os.path.join(MIGRATIONS_DIR, filename), "rb") as f:
+            sql = f.read().decode("utf8")
+
+        migrations.append(Migration(int(match.group(1)), match.group(2), sql))
+
+    return migrations
+
+
+def apply_migrations() -> list[Migration]:
+    # Waiting on another process' migrations and rebuilding indexes can both outlast the usual statement timeout
+    db.session.execute(text("SET LOCAL statement_timeout = 0;"))
+    db.session.execute(
+        text("SELECT pg_advisory_xact_lock(:lock_key);"),
+        {"lock_key": MIGRATION_LOCK_KEY},
+    )
+    db.session.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS SchemaMigrations (
+                version INT PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                appliedTimestamp TIMESTAMP NOT NULL
+            );
+            """
+        )
+    )
+
+    records = (
+        db.session.execute(text("SELECT version FROM SchemaMigrations;"))
+        .mappings()
+        .fetchall()
+    )
+    applied_versions = {record.get("version") for record in records}
+
+    applied = []
+    for migration in get_migrations():
+        if migration.version in applied_versions:
+            continue
+
+        # Migration files are run as-is, so they go straight to the driver instead of through text(), which
+        # would treat anything that looks like :name as a bind parameter
+        db.session.connection().exec_driver_sql(migration.sql)
+        db.session.execute(
+            text(
+                """
+                INSERT INTO SchemaMigrations
+                (version, name, appliedTimestamp)
+                VALUES
+                (:version, :name, CURRENT_TIMESTAMP);
+                """
+            ),
+            {"version": migration.version, "name": migration.name},
+        )
+        applied.append(migration)
+
+    apply_job_schema()
+
+    # All pending migrations are applied in one transaction, so a failure leaves the schema untouched
+    db.session.commit()
+    return applied
+
+
+@click.command("migrate")
+@with_appcontext
+def migrate_command():
+    applied = apply_migrations()
+    if len(applied) == 0:
+        click.echo("Database schema is up to date")
+        return
+
+    for migration in applied:
+        click.echo(f"Applied migration {migration.version:04d}_{migration.name}")
@@ -0,0 +1,14 @@
+CREATE INDEX IF NOT EXISTS bookings_appointment_id_user_id_idx
+    ON Bookings (appointmentID, userID);
+
+CREATE INDEX IF NOT EXISTS bookings_user_id_idx
+    ON Bookings (userID);
+
+CREATE INDEX IF NOT EXISTS appointment_time_slots_date_hour24_idx
+    ON AppointmentTimeSlots (date, hour24);
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_lower_email_idx
+    ON Users (lower(email));
+
+CREATE INDEX IF NOT EXISTS user_roles_user_id_user_role_idx
+    ON UserRoles (userID, userRole);
@@ -0,0 +1,35 @@
+ALTER TABLE AppointmentTimeSlots
+    ADD COLUMN IF NOT EXISTS slotsBooked INT NOT NULL DEFAULT 0;
+
+UPDATE AppointmentTimeSlots ats
+SET slotsBooked = counts.slots_booked
+FROM (
+    SELECT appointmentID, COUNT(*) AS slots_booked
+    FROM Bookings
+    GROUP BY appointmentID
+) counts
+WHERE ats.appointmentID = counts.appointmentID;
+
+-- Keeps AppointmentTimeSlots.slotsBooked equal to the number of Bookings rows for the slot, in the same
+-- transaction as whatever inserted or deleted the booking
+CREATE OR REPLACE FUNCTION update_slots_booked() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE AppointmentTimeSlots
+        SET slotsBooked = slotsBooked - 1
+        WHERE appointmentID = OLD.appointmentID;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE AppointmentTimeSlots
+        SET slotsBooked = slotsBooked + 1
+        WHERE appointmentID = NEW.appointmentID;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookings_update_slots_booked
+AFTER INSERT OR DELETE OR UPDATE OF appointmentID ON Bookings
+FOR EACH ROW EXECUTE FUNCTION update_slots_booked();
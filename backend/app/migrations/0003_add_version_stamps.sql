@@ -0,0 +1,93 @@
+-- Version stamps for conditional GETs. Every stamp comes from one sequence, so a changed row never gets a stamp it
+-- had before, and the set of stamps a response depends on changes whenever the response would
+CREATE SEQUENCE IF NOT EXISTS change_version_seq;
+
+ALTER TABLE AppointmentTimeSlots
+    ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('change_version_seq');
+
+ALTER TABLE Users
+    ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('change_version_seq');
+
+CREATE TABLE IF NOT EXISTS AvailabilityVersions (
+    date DATE PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+INSERT INTO AvailabilityVersions
+(date, version)
+SELECT date, MAX(version)
+FROM AppointmentTimeSlots
+GROUP BY date
+ON CONFLICT (date) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION set_row_version() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.version := nextval('change_version_seq');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER appointment_time_slots_set_version
+BEFORE UPDATE ON AppointmentTimeSlots
+FOR EACH ROW EXECUTE FUNCTION set_row_version();
+
+CREATE TRIGGER users_set_version
+BEFORE UPDATE ON Users
+FOR EACH ROW EXECUTE FUNCTION set_row_version();
+
+-- Days are stamped separately so a deleted slot still leaves a newer stamp behind on its day
+CREATE OR REPLACE FUNCTION bump_availability_version() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO AvailabilityVersions
+        (date, version)
+        VALUES
+        (OLD.date, nextval('change_version_seq'))
+        ON CONFLICT (date) DO UPDATE SET version = EXCLUDED.version;
+    END IF;
+
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.date <> OLD.date) THEN
+        INSERT INTO AvailabilityVersions
+        (date, version)
+        VALUES
+        (NEW.date, nextval('change_version_seq'))
+        ON CONFLICT (date) DO UPDATE SET version = EXCLUDED.version;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER appointment_time_slots_bump_availability_version
+AFTER INSERT OR UPDATE OR DELETE ON AppointmentTimeSlots
+FOR EACH ROW EXECUTE FUNCTION bump_availability_version();
+
+-- Inserts and deletes already touch the slot through update_slots_booked(). Other booking updates (comments,
+-- pending) touch it here, and users are stamped whenever the set of slots they booked changes
+CREATE OR REPLACE FUNCTION bump_booking_versions() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        UPDATE AppointmentTimeSlots
+        SET version = nextval('change_version_seq')
+        WHERE appointmentID = NEW.appointmentID;
+    END IF;
+
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND NEW.userID IS DISTINCT FROM OLD.userID) THEN
+        UPDATE Users
+        SET version = nextval('change_version_seq')
+        WHERE userID = OLD.userID;
+    END IF;
+
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.userID IS DISTINCT FROM OLD.userID) THEN
+        UPDATE Users
+        SET version = nextval('change_version_seq')
+        WHERE userID = NEW.userID;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookings_bump_versions
+AFTER INSERT OR UPDATE OR DELETE ON Bookings
+FOR EACH ROW EXECUTE FUNCTION bump_booking_versions();
@@ -0,0 +1,26 @@
+-- Access tokens carry the user's roles and this version as claims. Any role change bumps it, which makes the
+-- JWT user lookup reject tokens issued before the change
+ALTER TABLE Users
+    ADD COLUMN IF NOT EXISTS tokenVersion INT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION bump_token_version() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE Users
+        SET tokenVersion = tokenVersion + 1
+        WHERE userID = OLD.userID;
+    END IF;
+
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.userID IS DISTINCT FROM OLD.userID) THEN
+        UPDATE Users
+        SET tokenVersion = tokenVersion + 1
+        WHERE userID = NEW.userID;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER user_roles_bump_token_version
+AFTER INSERT OR UPDATE OR DELETE ON UserRoles
+FOR EACH ROW EXECUTE FUNCTION bump_token_version();
@@ -0,0 +1,10 @@
+-- Sliding window log for rate limiters shared between processes. Losing it in a crash only resets the limits, so
+-- it skips the WAL
+CREATE UNLOGGED TABLE IF NOT EXISTS RateLimitHits (
+    limiterName VARCHAR(64) NOT NULL,
+    limitKey VARCHAR(320) NOT NULL,
+    hitTimestamp TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS rate_limit_hits_limiter_name_limit_key_hit_timestamp_idx
+    ON RateLimitHits (limiterName, limitKey, hitTimestamp);
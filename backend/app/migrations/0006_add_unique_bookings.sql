@@ -0,0 +1,12 @@
+-- Bookings are inserted with ON CONFLICT (appointmentID, userID), so a user can hold at most one booking per
+-- appointment. Any duplicates left behind by the old check-then-insert race keep their earliest booking
+DELETE FROM Bookings b
+USING Bookings earlier
+WHERE b.appointmentID = earlier.appointmentID
+  AND b.userID = earlier.userID
+  AND (b.bookingTimestamp, b.ctid) > (earlier.bookingTimestamp, earlier.ctid);
+
+CREATE UNIQUE INDEX IF NOT EXISTS bookings_appointment_id_user_id_key
+    ON Bookings (appointmentID, userID);
+
+DROP INDEX IF EXISTS bookings_appointment_id_user_id_idx;
@@ -0,0 +1,14 @@
+-- Time slots are inserted with ON CONFLICT (date, hour24), so there can be at most one slot per hour. Duplicate
+-- slots nobody has booked are dropped, keeping the oldest; booked duplicates are left for an admin to resolve and
+-- will make this migration fail until they are
+DELETE FROM AppointmentTimeSlots a
+USING AppointmentTimeSlots earlier
+WHERE a.date = earlier.date
+  AND a.hour24 = earlier.hour24
+  AND a.appointmentID > earlier.appointmentID
+  AND NOT EXISTS (SELECT 1 FROM Bookings b WHERE b.appointmentID = a.appointmentID);
+
+CREATE UNIQUE INDEX IF NOT EXISTS appointment_time_slots_date_hour24_key
+    ON AppointmentTimeSlots (date, hour24);
+
+DROP INDEX IF EXISTS appointment_time_slots_date_hour24_idx;
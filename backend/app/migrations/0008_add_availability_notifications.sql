@@ -0,0 +1,40 @@
+-- Every change to a slot's availability is published on the availability_changes channel, which the availability
+-- feed in each web process listens on. Notifications are only delivered once the transaction commits
+CREATE OR REPLACE FUNCTION notify_availability_change() RETURNS TRIGGER AS $$
+DECLARE
+    slot AppointmentTimeSlots;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        slot := OLD;
+    ELSE
+        slot := NEW;
+    END IF;
+
+    IF TG_OP = 'UPDATE'
+       AND NEW.date = OLD.date
+       AND NEW.hour24 = OLD.hour24
+       AND NEW.capacity = OLD.capacity
+       AND NEW.slotsBooked = OLD.slotsBooked THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM pg_notify(
+        'availability_changes',
+        json_build_object(
+            'appointment_id', slot.appointmentID,
+            'date', slot.date,
+            'hour_24', slot.hour24,
+            'capacity', slot.capacity,
+            'slots_booked', slot.slotsBooked,
+            'deleted', TG_OP = 'DELETE',
+            'previous_date', CASE WHEN TG_OP = 'UPDATE' AND NEW.date <> OLD.date THEN OLD.date END
+        )::TEXT
+    );
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER appointment_time_slots_notify_availability_change
+AFTER INSERT OR UPDATE OR DELETE ON AppointmentTimeSlots
+FOR EACH ROW EXECUTE FUNCTION notify_availability_change();
@@ -0,0 +1,20 @@
+-- Side effects of bookings and cancellations are recorded here in the same transaction as the change itself, and
+-- the outbox relay in the task worker turns them into procrastinate jobs
+CREATE TABLE IF NOT EXISTS Outbox (
+    outboxID BIGSERIAL PRIMARY KEY,
+    taskName VARCHAR(255) NOT NULL,
+    args JSONB NOT NULL,
+    createdTimestamp TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP
+);
+
+-- Wakes the relay up once the inserting transaction commits, rather than it waiting for its next poll
+CREATE OR REPLACE FUNCTION notify_outbox() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('outbox', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER outbox_notify
+AFTER INSERT ON Outbox
+FOR EACH STATEMENT EXECUTE FUNCTION notify_outbox();
@@ -0,0 +1,25 @@
+-- Emails are recorded here in the same transaction as the booking, cancellation or removal they tell users about,
+-- and the email sender in the task worker sends them. Sent emails are deleted, and ones the email API rejected are
+-- kept with the reason
+CREATE TABLE IF NOT EXISTS PendingEmails (
+    emailID BIGSERIAL PRIMARY KEY,
+    email JSONB NOT NULL,
+    failedReason TEXT,
+    createdTimestamp TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS pending_emails_unsent_idx
+    ON PendingEmails (emailID)
+    WHERE failedReason IS NULL;
+
+-- Wakes the sender up once the inserting transaction commits, rather than it waiting for its next poll
+CREATE OR REPLACE FUNCTION notify_emails() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('emails', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER pending_emails_notify
+AFTER INSERT ON PendingEmails
+FOR EACH STATEMENT EXECUTE FUNCTION notify_emails();
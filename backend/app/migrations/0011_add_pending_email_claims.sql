@@ -0,0 +1,6 @@
+-- The email sender claims a batch of pending emails in one transaction and settles it in another, rather than
+-- keeping them locked while it waits on the email API. Emails whose request failed wait until nextAttemptAt
+ALTER TABLE PendingEmails
+    ADD COLUMN IF NOT EXISTS claimedAt TIMESTAMP,
+    ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS nextAttemptAt TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP;
@@ -0,0 +1,155 @@
+from procrastinate.manager import JobManager
+from procrastinate.tasks import Task
+from sqlalchemy import text
+from threading import Event, Lock, Thread
+from .db import db
+from .metrics import register_metrics
+from .tasks import job_lock, procrastinate_app, session_connector
+import json
+import psycopg
+
+CHANNEL = "outbox"
+
+# Defers relayed jobs through db.session whichever connector procrastinate_app has, so deleting outbox rows and
+# enqueueing their jobs always commit together
+relay_job_manager = JobManager(connector=session_connector)
+
+
+# Bind parameters for an INSERT INTO Outbox (taskName, args) VALUES (:task_name, CAST(:task_args AS JSONB)), which
+# callers can write into the same statement as the change the task follows up on
+def outbox_params(task: Task, **task_kwargs) -> dict:
+    return {"task_name": task.name, "task_args": json.dumps(task_kwargs)}
+
+
+# Records that task should run with task_kwargs once the caller's transaction commits
+def enqueue(task: Task, **task_kwargs):
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Outbox
+            (taskName, args)
+            VALUES
+            (:task_name, CAST(:task_args AS JSONB));
+            """
+        ),
+        outbox_params(task, **task_kwargs),
+    )
+
+
+# Moves up to batch_size outbox rows, oldest first, into procrastinate jobs with one batched defer. The rows are
+# deleted and their jobs deferred in the same transaction, so every row becomes exactly one job. SKIP LOCKED lets
+# relays in several workers share the outbox, and rows for tasks this process doesn't know are left for one that does.
+# Jobs get their ids in outbox order, which is the order jobs sharing a lock run in
+def relay_outbox(batch_size: int) -> int:
+    records = (
+        db.session.execute(
+            text(
+                """
+                DELETE FROM Outbox
+                WHERE outboxID IN (
+                    SELECT outboxID
+                    FROM Outbox
+                    WHERE taskName = ANY(:task_names)
+                    ORDER BY outboxID ASC
+                    LIMIT :batch_size
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING outboxID AS outbox_id, taskName AS task_name, args AS args;
+                """
+            ),
+            {"task_names": list(procrastinate_app.tasks), "batch_size": batch_size},
+        )
+        .mappings()
+        .fetchall()
+    )
+
+    if len(records) == 0:
+        db.session.commit()
+        return 0
+
+    jobs = []
+    for record in sorted(records, key=lambda record: record.get("outbox_id")):
+        task = procrastinate_app.tasks[record.get("task_name")]
+        jobs.append(task.configure(lock=job_lock(task, record.get("args"))).make_new_job(**record.get("args")))
+    relay_job_manager.batch_defer_jobs(jobs)
+    db.session.commit()
+    return len(records)
+
+
+# Runs relay_outbox in a thread of the task worker whenever something is added to the outbox, and every poll
+# interval in case a notification was missed while reconnecting
+class OutboxRelay:
+    def __init__(self):
+        self.app = None
+        self.conninfo = ""
+        self.batch_size = 500
+        self.poll_seconds = 5
+        self._thread: Thread | None = None
+        self._stopping = Event()
+        self._lock = Lock()
+        self.relayed = 0
+        self.batches = 0
+        self.errors = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.conninfo = app.config["DB_CONNINFO"]
+        self.batch_size = app.config["OUTBOX_RELAY_BATCH_SIZE"]
+        self.poll_seconds = app.config["OUTBOX_RELAY_POLL_SECONDS"]
+        register_metrics("outbox_relay", self.stats)
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, name="outbox-relay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def relay_all(self) -> int:
+        relayed = 0
+        with self.app.app_context():
+            while True:
+                count = relay_outbox(self.batch_size)
+                with self._lock:
+                    self.relayed += count
+                    if count > 0:
+                        self.batches += 1
+                relayed += count
+
+                if count < self.batch_size:
+                    return relayed
+
+    def _run(self):
+        retry_seconds = 1
+        while not self._stopping.is_set():
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as connection:
+                    connection.execute(f"LISTEN {CHANNEL};")
+                    retry_seconds = 1
+
+                    while not self._stopping.is_set():
+                        # Listening first means nothing committed from here on goes unnoticed
+                        self.relay_all()
+                        for _ in connection.notifies(timeout=self.poll_seconds, stop_after=1):
+                            pass
+            except Exception as e:
+                print(e)
+                with self._lock:
+                    self.errors += 1
+
+            self._stopping.wait(retry_seconds)
+            retry_seconds = min(2 * retry_seconds, 30)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "relayed": self.relayed,
+                "batches": self.batches,
+                "errors": self.errors,
+            }
+
+
+outbox_relay = OutboxRelay()
@@ -0,0 +1,129 @@
+from bcrypt import checkpw, hashpw, gensalt
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Any, Callable
+from .metrics import register_metrics
+import multiprocessing
+import time
+
+
+class PasswordHasherSaturated(Exception):
+    pass
+
+
+# Runs bcrypt on a process pool sized separately from the web workers, so hashes run in parallel outside the GIL
+# instead of one at a time holding it. The request thread still waits for its hash, so this frees no web worker
+# threads; what keeps a burst of logins from tying them all up is the cap on how many hashes can be running or
+# waiting at once, and the timeout on waiting, either of which gets the request a 503 instead
+class PasswordHasher:
+    def __init__(self):
+        self.rounds = 12
+        self.pool_size = 0
+        self.max_pending = 0
+        self.timeout_seconds = 3.0
+        self._slots = BoundedSemaphore(1)
+        self._executor: ProcessPoolExecutor | None = None
+        self._executor_lock = Lock()
+        self._stats_lock = Lock()
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.rehashed = 0
+        self.total_seconds = 0.0
+
+    def init_app(self, app):
+        self.rounds = app.config["PASSWORD_HASH_ROUNDS"]
+        self.pool_size = app.config["PASSWORD_HASH_POOL_SIZE"]
+        self.max_pending = app.config["PASSWORD_HASH_MAX_PENDING"]
+        self.timeout_seconds = app.config["PASSWORD_HASH_TIMEOUT_SECONDS"]
+        self._slots = BoundedSemaphore(max(self.pool_size, 1) + self.max_pending)
+        register_metrics("password_hasher", self.stats)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Created on first use rather than in init_app so that each gunicorn worker gets its own pool after forking
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.pool_size,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+            return self._executor
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+    def _finish(self, start: float):
+        self._slots.release()
+        with self._stats_lock:
+            self.completed += 1
+            self.total_seconds += time.perf_counter() - start
+
+    def _run(self, fn: Callable, *args) -> Any:
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self.rejected += 1
+            raise PasswordHasherSaturated()
+
+        start = time.perf_counter()
+        if self.pool_size == 0:
+            try:
+                return fn(*args)
+            finally:
+                self._finish(start)
+
+        # The slot is given back once the hash finishes or is cancelled rather than when the request stops waiting,
+        # so hashes that timed out still count against the cap while they run
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._finish(start)
+            raise
+        future.add_done_callback(lambda _: self._finish(start))
+
+        try:
+            return future.result(timeout=self.timeout_seconds)
+        except TimeoutError:
+            future.cancel()
+            with self._stats_lock:
+                self.timed_out += 1
+            raise PasswordHasherSaturated()
+
+    def hash_password(self, password: str) -> bytes:
+        return self._run(hashpw, bytes(password, "utf-8"), gensalt(self.rounds))
+
+    def check_password(self, password: str, password_hashed: bytes) -> bool:
+        return self._run(checkpw, bytes(password, "utf-8"), password_hashed)
+
+    def needs_rehash(self, password_hashed: bytes) -> bool:
+        # bcrypt hashes look like $2b$12$<salt and hash>, where 12 is the cost they were made with
+        try:
+            return int(password_hashed.split(b"$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def record_rehash(self):
+        with self._stats_lock:
+            self.rehashed += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "rounds": self.rounds,
+                "pool_size": self.pool_size,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "rehashed": self.rehashed,
+                "average_milliseconds": (
+                    1000 * self.total_seconds / self.completed
+                    if self.completed > 0
+                    else 0.0
+                ),
+            }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,112 @@
+from bisect import bisect_left
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from threading import Lock, current_thread
+from .metrics import register_metrics
+import time
+
+# Upper bounds in seconds of the checkout wait histogram's buckets, the last of which takes everything longer
+CHECKOUT_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+# Tracks how long requests wait for a database connection and how long they hold one. Connections held for longer
+# than the leak threshold are reported with the request that checked them out, which is usually a session that
+# was never closed or a response that streams while holding its connection
+class PoolMonitor:
+    def __init__(self):
+        self.engine = None
+        self.leak_seconds = 60.0
+        self._lock = Lock()
+        self._checked_out: dict[int, tuple[float, str]] = {}
+        self.wait_buckets = [0] * (len(CHECKOUT_WAIT_BUCKETS) + 1)
+        self.wait_seconds = 0.0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.leaks = 0
+
+    def init_app(self, app, engine):
+        self.engine = engine
+        self.leak_seconds = app.config["DB_CONNECTION_LEAK_SECONDS"]
+        register_metrics("db_pool", self.stats)
+
+    def observe_wait(self, seconds: float):
+        with self._lock:
+            self.wait_buckets[bisect_left(CHECKOUT_WAIT_BUCKETS, seconds)] += 1
+            self.wait_seconds += seconds
+            self.checkouts += 1
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        owner = request.path if has_request_context() else current_thread().name
+        with self._lock:
+            self._checked_out[id(connection_record)] = (time.monotonic(), owner)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            checked_out = self._checked_out.pop(id(connection_record), None)
+        if checked_out is None:
+            return
+
+        checked_out_at, owner = checked_out
+        held_seconds = time.monotonic() - checked_out_at
+        if held_seconds > self.leak_seconds:
+            with self._lock:
+                self.leaks += 1
+            print(f"Database connection checked out by {owner} was held for {held_seconds:.1f}s")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            held_too_long = [
+                owner
+                for checked_out_at, owner in self._checked_out.values()
+                if now - checked_out_at > self.leak_seconds
+            ]
+            stats = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds,
+                "wait_seconds_buckets": {
+                    **{
+                        str(bound): count
+                        for bound, count in zip(CHECKOUT_WAIT_BUCKETS, self.wait_buckets)
+                    },
+                    "inf": self.wait_buckets[-1],
+                },
+                "leaks": self.leaks,
+                "held_too_long": held_too_long,
+            }
+
+        if self.engine is not None:
+            pool = self.engine.pool
+            stats["size"] = pool.size()
+            stats["checked_out"] = pool.checkedout()
+            stats["overflow"] = pool.overflow()
+
+        return stats
+
+
+pool_monitor = PoolMonitor()
+
+
+# QueuePool that times every checkout for pool_monitor, including the ones that give up waiting
+class MonitoredQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection_record = super()._do_get()
+        except PoolTimeoutError:
+            pool_monitor.observe_timeout()
+            raise
+
+        pool_monitor.observe_wait(time.perf_counter() - start)
+        return connection_record
+
+
+event.listen(MonitoredQueuePool, "checkout", pool_monitor.on_checkout)
+event.listen(MonitoredQueuePool, "checkin", pool_monitor.on_checkin)
@@ -0,0 +1,172 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from sqlalchemy import text
+from threading import Lock
+from .db import db
+from .metrics import register_metrics
+import hashlib
+import time
+
+
+class SlidingWindowStore(ABC):
+    # Records a hit and returns True if fewer than limit hits were recorded for the key in the last window_seconds,
+    # otherwise records nothing and returns False
+    @abstractmethod
+    def hit(self, limiter_name: str, key: str, limit: int, window_seconds: int) -> bool:
+        pass
+
+
+class MemorySlidingWindowStore(SlidingWindowStore):
+    # Keys whose hits have all aged out are swept after this many hits
+    SWEEP_INTERVAL = 1000
+
+    def __init__(self):
+        self._hits: dict[tuple[str, str], deque[float]] = dict()
+        self._lock = Lock()
+        self._hits_since_sweep = 0
+
+    def hit(self, limiter_name: str, key: str, limit: int, window_seconds: int) -> bool:
+        now = time.monotonic()
+        cutoff = now - window_seconds
+
+        with self._lock:
+            self._hits_since_sweep += 1
+            if self._hits_since_sweep >= self.SWEEP_INTERVAL:
+                self._sweep(cutoff)
+
+            hits = self._hits.setdefault((limiter_name, key), deque())
+            while len(hits) > 0 and hits[0] <= cutoff:
+                hits.popleft()
+
+            if len(hits) >= limit:
+                return False
+
+            hits.append(now)
+            return True
+
+    def _sweep(self, cutoff: float):
+        self._hits_since_sweep = 0
+        for hits_key in [
+            hits_key
+            for hits_key, hits in self._hits.items()
+            if len(hits) == 0 or hits[-1] <= cutoff
+        ]:
+            del self._hits[hits_key]
+
+
+# Shared by every gunicorn worker through the RateLimitHits table. Each hit is one statement on its own connection,
+# so it is committed even when the request's own transaction is rolled back. Attempts racing each other can each
+# see the same count, so a burst may get through a few more hits than the limit
+class PostgresSlidingWindowStore(SlidingWindowStore):
+    def hit(self, limiter_name: str, key: str, limit: int, window_seconds: int) -> bool:
+        with db.engine.begin() as connection:
+            record = connection.execute(
+                text(
+                    """
+                    WITH Pruned AS (
+                        DELETE FROM RateLimitHits
+                        WHERE limiterName = :limiter_name
+                          AND limitKey = :key
+                          AND hitTimestamp <= LOCALTIMESTAMP - make_interval(secs => :window_seconds)
+                    ), Counted AS (
+                        SELECT COUNT(*) AS hits
+                        FROM RateLimitHits
+                        WHERE limiterName = :limiter_name
+                          AND limitKey = :key
+                          AND hitTimestamp > LOCALTIMESTAMP - make_interval(secs => :window_seconds)
+                    )
+                    INSERT INTO RateLimitHits
+                    (limiterName, limitKey, hitTimestamp)
+                    SELECT :limiter_name, :key, LOCALTIMESTAMP
+                    FROM Counted
+                    WHERE hits < :limit
+                    RETURNING limiterName AS limiter_name;
+                    """
+                ),
+                {
+                    "limiter_name": limiter_name,
+                    "key": key,
+                    "limit": limit,
+                    "window_seconds": window_seconds,
+                },
+            ).fetchone()
+
+        return record is not None
+
+
+def create_sliding_window_store(backend: str) -> SlidingWindowStore:
+    if backend == "memory":
+        return MemorySlidingWindowStore()
+    if backend == "postgres":
+        return PostgresSlidingWindowStore()
+
+    raise ValueError(f"Unknown rate limit store: {backend}")
+
+
+class RateLimiter:
+    def __init__(self, name: str, limit: int, window_seconds: int, store: SlidingWindowStore):
+        self.name = name
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.store = store
+        self._stats_lock = Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def hit(self, key: str) -> bool:
+        allowed = self.store.hit(self.name, key, self.limit, self.window_seconds)
+        with self._stats_lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.rejected += 1
+
+        return allowed
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "limit": self.limit,
+                "window_seconds": self.window_seconds,
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+            }
+
+
+# Throttles login attempts per client IP and per account email before any user lookup or bcrypt work happens
+class LoginRateLimiter:
+    def __init__(self):
+        self.ip_limiter: RateLimiter | None = None
+        self.email_limiter: RateLimiter | None = None
+
+    def init_app(self, app):
+        store = create_sliding_window_store(app.config["LOGIN_RATE_LIMIT_STORE"])
+        self.ip_limiter = RateLimiter(
+            "login_ip",
+            app.config["LOGIN_RATE_LIMIT_PER_IP"],
+            app.config["LOGIN_RATE_LIMIT_PER_IP_WINDOW_SECONDS"],
+            store,
+        )
+        self.email_limiter = RateLimiter(
+            "login_email",
+            app.config["LOGIN_RATE_LIMIT_PER_EMAIL"],
+            app.config["LOGIN_RATE_LIMIT_PER_EMAIL_WINDOW_SECONDS"],
+            store,
+        )
+        register_metrics("login_rate_limit", self.stats)
+
+    # Returns how many seconds the client should wait before retrying, or None if the attempt is allowed. Emails
+    # haven't been validated yet, so they are keyed by a hash that fits the store's keys however long they are
+    def check(self, ip_address: str | None, email: str) -> int | None:
+        if not self.ip_limiter.hit(ip_address or "unknown"):
+            return self.ip_limiter.window_seconds
+        if not self.email_limiter.hit(hashlib.sha256(email.lower().encode("utf-8")).hexdigest()):
+            return self.email_limiter.window_seconds
+
+        return None
+
+    def stats(self) -> dict:
+        return {"ip": self.ip_limiter.stats(), "email": self.email_limiter.stats()}
+
+
+login_rate_limiter = LoginRateLimiter()
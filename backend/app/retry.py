@@ -0,0 +1,78 @@
+from sqlalchemy.exc import DBAPIError
+from threading import Lock
+from typing import Callable, TypeVar
+from .db import db
+from .metrics import register_metrics
+import random
+import time
+
+T = TypeVar("T")
+
+# serialization_failure and deadlock_detected: the transaction only lost a race, so running it again should work
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+
+
+def is_retryable(e: Exception) -> bool:
+    return isinstance(e, DBAPIError) and getattr(e.orig, "sqlstate", None) in RETRYABLE_SQLSTATES
+
+
+# Runs a transaction again when it loses a race with another one, sleeping a random time up to an exponentially
+# growing bound between attempts so that the transactions that collided don't collide again. It gives up, raising
+# the last error, after max_attempts or once the next attempt couldn't start before the deadline, so a caller is
+# never held up for long. Attempts, retries and give-ups are counted per call site
+class TransactionRetrier:
+    def __init__(self):
+        self.max_attempts = 3
+        self.backoff_seconds = 0.05
+        self.max_backoff_seconds = 1.0
+        self.deadline_seconds = 2.0
+        self._lock = Lock()
+        self._call_sites: dict[str, dict] = {}
+
+    def init_app(self, app):
+        self.max_attempts = app.config["TRANSACTION_RETRY_ATTEMPTS"]
+        self.backoff_seconds = app.config["TRANSACTION_RETRY_BACKOFF_SECONDS"]
+        self.max_backoff_seconds = app.config["TRANSACTION_RETRY_MAX_BACKOFF_SECONDS"]
+        self.deadline_seconds = app.config["TRANSACTION_RETRY_DEADLINE_SECONDS"]
+        register_metrics("transaction_retries", self.stats)
+
+    def _count(self, call_site: str, **counts):
+        with self._lock:
+            stats = self._call_sites.setdefault(
+                call_site,
+                {"calls": 0, "attempts": 0, "retries": 0, "aborts": 0, "retry_wait_seconds": 0.0},
+            )
+            for name, count in counts.items():
+                stats[name] += count
+
+    # Calls work, which runs and commits one transaction on db.session, until it succeeds or gives up. Anything
+    # work started is rolled back before it is run again or the error is raised
+    def run(self, call_site: str, work: Callable[[], T], deadline_seconds: float | None = None) -> T:
+        deadline = time.monotonic() + (deadline_seconds if deadline_seconds is not None else self.deadline_seconds)
+        self._count(call_site, calls=1)
+
+        attempt = 1
+        while True:
+            self._count(call_site, attempts=1)
+            try:
+                return work()
+            except Exception as e:
+                db.session.rollback()
+                if not is_retryable(e):
+                    raise
+
+                backoff = random.uniform(0, min(self.backoff_seconds * 2 ** (attempt - 1), self.max_backoff_seconds))
+                if attempt >= self.max_attempts or time.monotonic() + backoff >= deadline:
+                    self._count(call_site, aborts=1)
+                    raise
+
+                self._count(call_site, retries=1, retry_wait_seconds=backoff)
+                time.sleep(backoff)
+                attempt += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {call_site: dict(stats) for call_site, stats in self._call_sites.items()}
+
+
+transaction_retrier = TransactionRetrier()
@@ -1,137 +1,189 @@
 import procrastinate 
-from configparser import ConfigParser
+from procrastinate.sync_psycopg_connector import wrap_exceptions
+from procrastinate.tasks import Task
 from .db import db
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import contextlib
 import random
-from psycopg.errors import SerializationFailure
-import time
-from .emails import send_book_appointment_confirmation_email, send_cancel_appointment_confirmation_email
+from psycopg.rows import dict_row
+from datetime import date
+from .emails import book_appointment_confirmation_email, cancel_appointment_confirmation_email, queue_emails
+from .availability import availability_cache
+from .metrics import register_metrics
+from .retry import transaction_retrier
 
 TRANSACTION_RETRY_AMOUNT = 3
 
-config = ConfigParser()
-config.read("/run/secrets/backend_config")
-
-procrastinate_app = procrastinate.App(
-    connector=procrastinate.PsycopgConnector(
-        kwargs={
-            "user": config["credentials.database"]["user"],
-            "host": config["credentials.database"]["host"],
-            "password": config["credentials.database"]["password"],
-            "dbname": config["credentials.database"]["name"],
-            "port": config["credentials.database"]["port"],
-        }
-    )
+# Booking jobs whose transaction transaction_retrier gave up on, or that lost their connection, are rescheduled to
+# run again 2, 4 and then 8 seconds later, rather than sleeping on a worker thread between attempts. SQLAlchemy
+# raises all of those as OperationalError
+BOOKING_RETRY = procrastinate.RetryStrategy(
+    max_attempts=TRANSACTION_RETRY_AMOUNT, exponential_wait=2, retry_exceptions={OperationalError}
 )
 
-def generate_confirmation_code():
-    return "".join([str(random.randint(0, 9)) for _ in range(6)])
 
+# Runs procrastinate's queries on db.session's connection instead of a pool of its own, so deferring a job takes no
+# connection setup and happens in the caller's transaction: the job is enqueued exactly when the caller commits.
+# The worker process swaps this for a PsycopgConnector, see worker.py
+class SessionConnector(procrastinate.SyncPsycopgConnector):
+    def open(self, pool=None):
+        pass
 
-def get_details_for_email(appointment_id: int, user_id: int) -> tuple[str, str, str, str]:
-    record = (
-        db.session.execute(
-            text(
-                """
-                SELECT name, email
-                FROM Users
-                WHERE userID = :user_id;
-                """
-            ),
-            {
-                "user_id": user_id
-            }
-        )
-        .mappings()
-        .fetchone()
-    )
-    name = record.get("name")
-    email = record.get("email")
+    def close(self):
+        pass
 
+    @contextlib.contextmanager
+    def _get_cursor(self):
+        connection = db.session.connection().connection.driver_connection
+        with connection.cursor(row_factory=dict_row) as cursor:
+            yield cursor
+
+    @wrap_exceptions()
+    def execute_query(self, query, **arguments):
+        with self._get_cursor() as cursor:
+            cursor.execute(query, self._wrap_json(arguments))
+
+
+session_connector = SessionConnector()
+procrastinate_app = procrastinate.App(connector=session_connector)
+
+
+# Deferring needs procrastinate's tables in whichever database the app uses, the test one included, so migrations
+# create them where they are missing
+def apply_job_schema() -> bool:
     record = (
-        db.session.execute(
-            text(
-                """
-                SELECT date, hour24
-                FROM AppointmentTimeSlots
-                WHERE appointmentID = :appointment_id;
-                """
-            ),
-            {
-                "appointment_id": appointment_id
-            }
-        )
+        db.session.execute(text("SELECT to_regclass('procrastinate_jobs') IS NULL AS missing;"))
         .mappings()
         .fetchone()
     )
-    appointment_date = record.get("date")
-    appointment_time = f"{record.get("hour24")}:00"
+    if not record.get("missing"):
+        return False
 
-    return email, name, appointment_date, appointment_time
-    
+    procrastinate_app.schema_manager.apply_schema()
+    return True
 
-@procrastinate_app.task(queue="bookings")
-def book_new_appointment_task(appointment_id: int, user_id: int, comments: str, subject: str, location: str):
-    tries = 0
-    while tries < TRANSACTION_RETRY_AMOUNT:
-        try:
-            # Now that we know there is a clear appointment, book it
+
+# Each queue's backlog as the database sees it, so the web app's metrics cover every worker process: jobs waiting
+# and running, and how long the longest waiting job has been due, which is how far behind the workers are
+class JobQueueMonitor:
+    def init_app(self, app):
+        register_metrics("job_queues", self.stats)
+
+    def stats(self) -> dict:
+        records = (
             db.session.execute(
                 text(
                     """
-                    UPDATE Bookings
-                    SET comments = :comments, pending = FALSE
-                    WHERE appointmentID = :appointment_id
-                      AND userID = :user_id;
+                    SELECT j.queue_name AS queue_name,
+                           COUNT(*) FILTER (WHERE j.status = 'todo') AS queued,
+                           COUNT(*) FILTER (WHERE j.status = 'doing') AS running,
+                           COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(GREATEST(e.at, j.scheduled_at))
+                               FILTER (WHERE j.status = 'todo')), 0) AS lag_seconds
+                    FROM procrastinate_jobs j
+                    LEFT OUTER JOIN procrastinate_events e
+                        ON e.job_id = j.id
+                       AND e.type = 'deferred'
+                    WHERE j.status IN ('todo', 'doing')
+                      AND (j.scheduled_at IS NULL OR j.scheduled_at <= NOW())
+                    GROUP BY j.queue_name;
                     """
-                ),
-                {
-                    "appointment_id": appointment_id,
-                    "user_id": user_id,
-                    "comments": comments,
-                },
+                )
             )
+            .mappings()
+            .fetchall()
+        )
+
+        return {
+            record.get("queue_name"): {
+                "queued": record.get("queued"),
+                "running": record.get("running"),
+                "lag_seconds": float(record.get("lag_seconds")),
+            }
+            for record in records
+        }
+
 
-            # Assign the user as the current leader, and set the subject and location
+job_queue_monitor = JobQueueMonitor()
+
+
+def generate_confirmation_code():
+    return "".join([str(random.randint(0, 9)) for _ in range(6)])
+
+
+# The email address, name, date and time a booking email is sent with, from a record with those columns
+def email_details(record) -> tuple[str, str, str, str]:
+    return record.get("email"), record.get("name"), str(record.get("date")), f"{record.get('hour_24')}:00"
+
+
+@procrastinate_app.task(queue="bookings", retry=BOOKING_RETRY)
+def book_new_appointment_task(appointment_id: int, user_id: int, comments: str, subject: str, location: str):
+    def confirm():
+        # Confirms the booking and makes the user the leader, setting the subject and location, in one statement
+        # that also returns what the confirmation email needs
+        record = (
             db.session.execute(
                 text(
                     """
-                    UPDATE AppointmentTimeSlots
-                    SET leaderUserID = :leader_user_id, confirmationCode = :confirmation_code,
-                        subject = :subject, location = :location
-                    WHERE appointmentID = :appointment_id;
+                    WITH Booked AS (
+                        UPDATE Bookings
+                        SET comments = :comments, pending = FALSE
+                        WHERE appointmentID = :appointment_id
+                          AND userID = :user_id
+                    ), Slot AS (
+                        UPDATE AppointmentTimeSlots
+                        SET leaderUserID = :user_id, confirmationCode = :confirmation_code,
+                            subject = :subject, location = :location
+                        WHERE appointmentID = :appointment_id
+                        RETURNING date, hour24
+                    )
+                    SELECT u.email AS email, u.name AS name, s.date AS date, s.hour24 AS hour_24
+                    FROM Slot s
+                    CROSS JOIN Users u
+                    WHERE u.userID = :user_id;
                     """
                 ),
                 {
-                    "leader_user_id": user_id,
+                    "appointment_id": appointment_id,
+                    "user_id": user_id,
+                    "comments": comments,
                     "confirmation_code": generate_confirmation_code(),
                     "subject": subject,
                     "location": location,
-                    "appointment_id": appointment_id,
                 },
             )
+            .mappings()
+            .fetchone()
+        )
+        # The slot was removed before the job ran, and its removal email covers the booking. Otherwise the email is
+        # queued in the same transaction, so it is sent exactly when the booking is confirmed
+        if record is not None:
+            queue_emails([book_appointment_confirmation_email(*email_details(record))])
+        db.session.commit()
 
-            email_address, name, appointment_date, appointment_time = get_details_for_email(appointment_id, user_id)
-            send_book_appointment_confirmation_email(email_address, name, appointment_date, appointment_time)
-            db.session.commit()
-            return
-        except SerializationFailure:
-            db.session.rollback()
-            tries += 1
-            time.sleep(2 * tries)
+    transaction_retrier.run("book_new_appointment_task", confirm)
 
-@procrastinate_app.task(queue="bookings")
+@procrastinate_app.task(queue="bookings", retry=BOOKING_RETRY)
 def book_existing_appointment_task(appointment_id: int, user_id: int, comments: str):
-    tries = 0
-    while tries < TRANSACTION_RETRY_AMOUNT:
-        try:
+    def confirm():
+        # The booking was already reserved as pending by the request, so it only needs confirming
+        record = (
             db.session.execute(
                 text(
                     """
-                    INSERT INTO Bookings
-                    (appointmentID, userID, bookingTimestamp, comments)
-                    VALUES
-                    (:appointment_id, :user_id, CURRENT_TIMESTAMP, :comments);
+                    WITH Booked AS (
+                        UPDATE Bookings
+                        SET comments = :comments, pending = FALSE
+                        WHERE appointmentID = :appointment_id
+                          AND userID = :user_id
+                        RETURNING appointmentID, userID
+                    )
+                    SELECT u.email AS email, u.name AS name, a.date AS date, a.hour24 AS hour_24
+                    FROM Booked b
+                    INNER JOIN Users u
+                        ON b.userID = u.userID
+                    INNER JOIN AppointmentTimeSlots a
+                        ON b.appointmentID = a.appointmentID;
                     """
                 ),
                 {
@@ -140,113 +192,182 @@ def book_existing_appointment_task(appointment_id: int, user_id: int, comments:
                     "comments": comments,
                 },
             )
+            .mappings()
+            .fetchone()
+        )
+        if record is not None:
+            queue_emails([book_appointment_confirmation_email(*email_details(record))])
+        db.session.commit()
 
-            email_address, name, appointment_date, appointment_time = get_details_for_email(appointment_id, user_id)
-            send_book_appointment_confirmation_email(email_address, name, appointment_date, appointment_time)
-            db.session.commit()
-            return
-        except SerializationFailure:
-            db.session.rollback()
-            tries += 1
-            time.sleep(2 * tries)
+    transaction_retrier.run("book_existing_appointment_task", confirm)
 
 @procrastinate_app.task(queue="bookings")
+def send_time_slot_removed_emails_task(recipients: list[list[str]]):
+    # Sent for every booking on time slots an admin removed, which are already gone from the database
+    queue_emails([cancel_appointment_confirmation_email(*recipient) for recipient in recipients])
+    db.session.commit()
+
+@procrastinate_app.task(queue="bookings", retry=BOOKING_RETRY)
 def cancel_appointment_task(appointment_id: int, user_id: int):
-    tries = 0
-    while tries < TRANSACTION_RETRY_AMOUNT:
-        try:
+    # Two different codes, so whichever one the slot doesn't already have can replace its old one
+    confirmation_codes = [generate_confirmation_code()]
+    while len(confirmation_codes) < 2:
+        confirmation_code = generate_confirmation_code()
+        if confirmation_code != confirmation_codes[0]:
+            confirmation_codes.append(confirmation_code)
+
+    def cancel() -> date | None:
+        # Deletes the booking and, if the user was the leader, hands the slot to whoever booked it earliest with a
+        # new confirmation code, or clears its details if nobody else has. Every part of the statement sees the
+        # bookings from before the delete, so the user's own booking is left out of the choice explicitly. Nothing is
+        # returned, and so no email sent, when there was no booking to cancel, e.g. for a job that ran twice
+        record = (
             db.session.execute(
                 text(
                     """
-                    DELETE FROM Bookings
-                    WHERE userID = :user_id AND appointmentID = :appointment_id;
-                    """,
+                    WITH Cancelled AS (
+                        DELETE FROM Bookings
+                        WHERE userID = :user_id
+                          AND appointmentID = :appointment_id
+                        RETURNING 1
+                    ), NextLeader AS (
+                        SELECT userID
+                        FROM Bookings
+                        WHERE appointmentID = :appointment_id
+                          AND userID <> :user_id
+                        ORDER BY bookingTimestamp ASC, userID ASC
+                        LIMIT 1
+                    ), Slot AS (
+                        UPDATE AppointmentTimeSlots a
+                        SET leaderUserID = (SELECT userID FROM NextLeader),
+                            confirmationCode = CASE
+                                WHEN NOT EXISTS (SELECT 1 FROM NextLeader) THEN NULL
+                                WHEN a.confirmationCode = :confirmation_code THEN :other_confirmation_code
+                                ELSE :confirmation_code
+                            END,
+                            subject = CASE WHEN EXISTS (SELECT 1 FROM NextLeader) THEN a.subject ELSE NULL END,
+                            location = CASE WHEN EXISTS (SELECT 1 FROM NextLeader) THEN a.location ELSE NULL END
+                        WHERE a.appointmentID = :appointment_id
+                          AND a.leaderUserID = :user_id
+                    )
+                    SELECT u.email AS email, u.name AS name, a.date AS date, a.hour24 AS hour_24
+                    FROM AppointmentTimeSlots a
+                    CROSS JOIN Users u
+                    WHERE a.appointmentID = :appointment_id
+                      AND u.userID = :user_id
+                      AND EXISTS (SELECT 1 FROM Cancelled);
+                    """
                 ),
-                {"user_id": user_id, "appointment_id": appointment_id},
+                {
+                    "user_id": user_id,
+                    "appointment_id": appointment_id,
+                    "confirmation_code": confirmation_codes[0],
+                    "other_confirmation_code": confirmation_codes[1],
+                },
             )
+            .mappings()
+            .fetchone()
+        )
+        if record is None:
+            db.session.commit()
+            return None
 
-            record = (
-                db.session.execute(
-                    text(
-                        """
-                        SELECT leaderUserID, confirmationCode
-                        FROM AppointmentTimeSlots
-                        WHERE appointmentID = :appointment_id;
-                        """
-                    ),
-                    {"appointment_id": appointment_id},
-                )
-                .mappings()
-                .fetchone()
-            )
+        queue_emails([cancel_appointment_confirmation_email(*email_details(record))])
+        db.session.commit()
+        return record.get("date")
 
-            leader_user_id = record.get("leaderuserid")
-            old_confirmation_code = record.get("confirmationcode")
+    appointment_date = transaction_retrier.run("cancel_appointment_task", cancel)
+    if appointment_date is not None:
+        availability_cache.invalidate(appointment_date)
 
-            # If the user was not the leader, we can just return
-            if leader_user_id != user_id:
-                db.session.commit()
 
-            # Otherwise, we need to set a new leader based on who booked the appointment the earliest
-            record = (
-                db.session.execute(
-                    text(
-                        """
-                        SELECT userID AS user_id
-                        FROM Bookings
-                        WHERE appointmentID = :appointment_id
-                          AND bookingTimestamp = (
-                                SELECT MIN(bookingTimestamp)
-                                FROM Bookings
-                                WHERE appointmentID = :appointment_id
-                            )
-                        LIMIT 1;
-                        """
-                    ),
-                    {"appointment_id": appointment_id},
+# Jobs of these tasks for the same appointment run one at a time, in the order they were deferred, so they never
+# race each other on the slot's bookings, leader and confirmation code. Jobs for different appointments still run
+# in parallel
+APPOINTMENT_TASKS = (book_new_appointment_task, book_existing_appointment_task, cancel_appointment_task)
+
+
+def appointment_lock(appointment_id: int) -> str:
+    return f"appointment-{appointment_id}"
+
+
+# The procrastinate lock a job of task should be deferred with, if any
+def job_lock(task: Task, task_kwargs: dict) -> str | None:
+    if task in APPOINTMENT_TASKS:
+        return appointment_lock(task_kwargs["appointment_id"])
+
+    return None
+
+
+def reconcile_slots_booked() -> list[int]:
+    # Lock the drifted slots first; the recount below then runs with a fresh snapshot, and any booking committed
+    # after it has to wait on these locks before its trigger can touch the counter
+    records = (
+        db.session.execute(
+            text(
+                """
+                SELECT ats.appointmentID AS appointment_id
+                FROM AppointmentTimeSlots ats
+                WHERE ats.slotsBooked <> (
+                    SELECT COUNT(*)
+                    FROM Bookings b
+                    WHERE b.appointmentID = ats.appointmentID
                 )
-                .mappings()
-                .fetchone()
+                FOR UPDATE;
+                """
             )
+        )
+        .mappings()
+        .fetchall()
+    )
+    appointment_ids = [record.get("appointment_id") for record in records]
 
-            if record is None:
-                # The leader was the last person to have booked that appointment, so NULL out the details fields
-                db.session.execute(
-                    text(
-                        """
-                        UPDATE AppointmentTimeSlots
-                        SET leaderUserID = NULL, confirmationCode = NULL, subject = NULL, location = NULL
-                        WHERE appointmentID = :appointment_id; 
-                        """
-                    ),
-                    {"appointment_id": appointment_id},
-                )
-            else:
-                # Set a new leader and confirmation code
-                new_confirmation_code = generate_confirmation_code()
-                while new_confirmation_code == old_confirmation_code:
-                    new_confirmation_code = generate_confirmation_code()
-
-                db.session.execute(
-                    text(
-                        """
-                        UPDATE AppointmentTimeSlots
-                        SET leaderUserID = :leader_user_id, confirmationCode = :confirmation_code
-                        WHERE appointmentID = :appointment_id; 
-                        """
-                    ),
-                    {
-                        "leader_user_id": record.get("user_id"),
-                        "confirmation_code": new_confirmation_code,
-                        "appointment_id": appointment_id,
-                    },
+    if len(appointment_ids) == 0:
+        db.session.commit()
+        return []
+
+    records = (
+        db.session.execute(
+            text(
+                """
+                UPDATE AppointmentTimeSlots ats
+                SET slotsBooked = (
+                    SELECT COUNT(*)
+                    FROM Bookings b
+                    WHERE b.appointmentID = ats.appointmentID
                 )
+                WHERE ats.appointmentID = ANY(:appointment_ids)
+                RETURNING ats.appointmentID AS appointment_id;
+                """
+            ),
+            {"appointment_ids": appointment_ids},
+        )
+        .mappings()
+        .fetchall()
+    )
+    db.session.commit()
 
-            email_address, name, appointment_date, appointment_time = get_details_for_email(appointment_id, user_id)
-            send_cancel_appointment_confirmation_email(email_address, name, appointment_date, appointment_time)
-            db.session.commit()
-            return
-        except SerializationFailure:
-            db.session.rollback()
-            tries += 1
-            time.sleep(2 * tries)
+    repaired = [record.get("appointment_id") for record in records]
+    print(f"Repaired slotsBooked drift for appointments {repaired}")
+    return repaired
+
+
+@procrastinate_app.periodic(cron="0 * * * *")
+@procrastinate_app.task(queue="maintenance")
+def reconcile_slots_booked_task(timestamp: int):
+    reconcile_slots_booked()
+
+
+@procrastinate_app.periodic(cron="30 * * * *")
+@procrastinate_app.task(queue="maintenance")
+def prune_rate_limit_hits_task(timestamp: int):
+    # Limiters prune their own keys as they're hit, this clears out keys that stopped being hit
+    db.session.execute(
+        text(
+            """
+            DELETE FROM RateLimitHits
+            WHERE hitTimestamp < LOCALTIMESTAMP - INTERVAL '1' DAY;
+            """
+        )
+    )
+    db.session.commit()
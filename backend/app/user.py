@@ -1,8 +1,19 @@
 class User:
-    def __init__(self, user_id: int, name: str, email: str):
+    def __init__(
+        self,
+        user_id: int,
+        name: str,
+        email: str,
+        version: int = 0,
+        roles: list[str] | None = None,
+        token_version: int = 0,
+    ):
         self.user_id = user_id
         self.name = name
         self.email = email
+        self.version = version
+        self.roles = roles if roles is not None else []
+        self.token_version = token_version
 
     def format_to_dict_for_sending(self):
         return {"name": self.name, "email": self.email}
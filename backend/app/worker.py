@@ -1,27 +1,213 @@
+import asyncio
+import functools
+import inspect
+import multiprocessing
+import os
+import procrastinate
+import signal
 import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
 from .tasks import procrastinate_app
+from .outbox import outbox_relay
+from .emails import email_sender
 from app import create_app
-import os
-from .config import DevelopmentConfig, ProductionConfig
+from .config import Config, config_from_env
 
-# Get config from environment variable
-configs = {
-    "development": DevelopmentConfig,
-    "production": ProductionConfig,
-}
-env_name = os.environ.get("FLASK_ENV", "development")
-config_class = configs.get(env_name, DevelopmentConfig)
 
-app = create_app(config_class())
+# Jobs finished by one worker process per queue since they were last taken, for logging throughput
+class JobStats:
+    def __init__(self):
+        self._lock = Lock()
+        self._queues: dict[str, dict] = {}
+        self._since = time.monotonic()
 
-def start_worker():
-    while True:
+    def observe(self, queue: str, seconds: float, failed: bool):
+        with self._lock:
+            stats = self._queues.setdefault(queue, {"succeeded": 0, "failed": 0, "seconds": 0.0})
+            stats["failed" if failed else "succeeded"] += 1
+            stats["seconds"] += seconds
+
+    def take(self) -> tuple[dict[str, dict], float]:
+        with self._lock:
+            queues, self._queues = self._queues, {}
+            now = time.monotonic()
+            elapsed, self._since = now - self._since, now
+
+        return queues, elapsed
+
+
+def print_job_stats(job_stats: JobStats):
+    queues, elapsed = job_stats.take()
+    for queue, stats in sorted(queues.items()):
+        jobs = stats["succeeded"] + stats["failed"]
+        print(
+            f"Worker {os.getpid()} {queue}: {jobs / elapsed:.1f} jobs/s, {stats['failed']} failed, "
+            f"{1000 * stats['seconds'] / jobs:.0f}ms average"
+        )
+
+
+# Jobs of sync tasks each run on a thread of their own, so each needs its own app context, and with it its own
+# db.session, instead of sharing the one the worker was started in
+def run_in_app_context(app, func, queue: str, job_stats: JobStats):
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        start = time.perf_counter()
+        failed = True
         try:
             with app.app_context():
-                procrastinate_app.run_worker(queues=None)
-        except Exception as e:
-            print(e)
-            time.sleep(5)
+                result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            job_stats.observe(queue, time.perf_counter() - start, failed)
+
+    return run
+
+
+async def report_job_stats(job_stats: JobStats, interval_seconds: float):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        print_job_stats(job_stats)
+
+
+# Runs a procrastinate worker per queue, each with that queue's concurrency, until SIGTERM or SIGINT asks them to
+# finish their running jobs and stop. Any one of them failing stops the rest too, so the supervisor restarts the
+# whole process. With wait False, each stops on its own once its queue is empty
+async def run_queues(app, job_stats: JobStats, wait: bool):
+    queue_concurrency = app.config["WORKER_QUEUE_CONCURRENCY"]
+
+    loop = asyncio.get_running_loop()
+    # procrastinate runs sync tasks on the loop's default executor, which needs a thread for every job at once
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=sum(queue_concurrency.values()), thread_name_prefix="job")
+    )
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    async with procrastinate_app.open_async():
+        workers = [
+            asyncio.create_task(
+                procrastinate_app.run_worker_async(
+                    queues=[queue],
+                    name=queue,
+                    concurrency=concurrency,
+                    wait=wait,
+                    shutdown_graceful_timeout=app.config["WORKER_SHUTDOWN_GRACE_SECONDS"],
+                    install_signal_handlers=False,
+                )
+            )
+            for queue, concurrency in queue_concurrency.items()
+        ]
+        reporter = asyncio.create_task(
+            report_job_stats(job_stats, app.config["WORKER_STATS_INTERVAL_SECONDS"])
+        )
+        stop_requested = asyncio.create_task(stopping.wait())
+
+        pending = {stop_requested, *workers}
+        while stop_requested in pending and len(pending) > 1:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            failed = [
+                task for task in done
+                if task is not stop_requested and not task.cancelled() and task.exception() is not None
+            ]
+            if len(failed) > 0:
+                break
+
+        # Cancelling a worker lets its running jobs finish, for up to the shutdown grace period
+        for worker in workers:
+            worker.cancel()
+        results = await asyncio.gather(*workers, return_exceptions=True)
+        reporter.cancel()
+        stop_requested.cancel()
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+def run_worker_process(config: Config, wait: bool):
+    app = create_app(config)
+
+    job_stats = JobStats()
+    # Tasks are registered under their aliases too, so each one is wrapped only once
+    for task in {id(task): task for task in procrastinate_app.tasks.values()}.values():
+        if not inspect.iscoroutinefunction(task.func):
+            task.func = run_in_app_context(app, task.func, task.queue, job_stats)
+
+    # The web app defers jobs through db.session, but fetching them and listening for new ones needs a pool of its
+    # own, with a listening connection held by each queue's worker
+    worker_connector = procrastinate.PsycopgConnector(
+        conninfo=app.config["DB_CONNINFO"],
+        min_size=1,
+        max_size=app.config["WORKER_DB_POOL_SIZE"],
+    )
+    try:
+        with procrastinate_app.replace_connector(worker_connector):
+            asyncio.run(run_queues(app, job_stats, wait))
+    finally:
+        print_job_stats(job_stats)
+
+
+# Runs the worker processes, starting any that die again, along with the outbox relay and the email sender. SIGTERM
+# or SIGINT stops those and has every process finish its running jobs before the supervisor exits
+class WorkerSupervisor:
+    def __init__(self, app, config: Config, wait: bool = True):
+        self.app = app
+        self.config = config
+        self.wait = wait
+        # Spawned rather than forked, so no process inherits another's connections or threads
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = Event()
+
+    def _start_process(self, index: int):
+        process = self._context.Process(
+            target=run_worker_process, args=(self.config, self.wait), name=f"worker-{index}"
+        )
+        process.start()
+        return process
+
+    def stop(self, *args):
+        self._stopping.set()
+
+    def run(self):
+        queues = {task.queue for task in procrastinate_app.tasks.values()} - {"builtin"}
+        for queue in sorted(queues - set(self.app.config["WORKER_QUEUE_CONCURRENCY"])):
+            print(f"No concurrency is configured for queue {queue}, so its jobs won't run")
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        processes = [self._start_process(index) for index in range(self.app.config["WORKER_PROCESSES"])]
+        outbox_relay.start()
+        email_sender.start()
+        try:
+            while not self._stopping.is_set():
+                if not self.wait and all(process.exitcode == 0 for process in processes):
+                    return
+
+                for index, process in enumerate(processes):
+                    if process.exitcode is not None and (self.wait or process.exitcode != 0):
+                        print(f"{process.name} exited with code {process.exitcode}, restarting it")
+                        processes[index] = self._start_process(index)
+
+                self._stopping.wait(5)
+        finally:
+            outbox_relay.stop()
+            email_sender.stop()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+            # Each process waits out the grace period for its jobs
+            for process in processes:
+                process.join(self.app.config["WORKER_SHUTDOWN_GRACE_SECONDS"] + 5)
+                if process.is_alive():
+                    print(f"{process.name} didn't stop in time, killing it")
+                    process.kill()
+
 
 if __name__ == "__main__":
-    start_worker()
\ No newline at end of file
+    config = config_from_env()
+    WorkerSupervisor(create_app(config), config).run()
@@ -0,0 +1,93 @@
+# Creates the same schedule of time slots against a running backend twice, once with one add_appointment_time_slot
+# request per slot and once with a single add_appointment_time_slots request, and reports how long each took.
+# Slots are created in the year given by --year so they don't collide with real ones, e.g.
+#
+#   python benchmarks/bench_add_time_slots.py --url http://localhost:5001 --weeks 15
+from datetime import date, timedelta
+import argparse
+import requests
+import time
+
+
+def login(url: str, email: str, password: str) -> requests.Session:
+    session = requests.Session()
+    response = session.post(
+        f"{url}/api/auth/login", json={"email": email, "password": password}
+    )
+    response.raise_for_status()
+    return session
+
+
+def csrf_headers(session: requests.Session) -> dict[str, str]:
+    return {"X-CSRF-TOKEN": session.cookies.get("csrf_access_token")}
+
+
+def recurrence(start_date: date, weeks: int, capacity: int) -> dict:
+    return {
+        "start_date": str(start_date),
+        "end_date": str(start_date + timedelta(weeks=weeks)),
+        "weekdays": [0, 1, 2, 3, 4],
+        "hour_ranges": [[9, 12], [13, 18]],
+        "capacity": capacity,
+    }
+
+
+def add_one_at_a_time(url: str, session: requests.Session, schedule: dict) -> int:
+    start_date = date.fromisoformat(schedule["start_date"])
+    end_date = date.fromisoformat(schedule["end_date"])
+    created = 0
+    day = start_date
+    while day < end_date:
+        if day.weekday() in schedule["weekdays"]:
+            for start_hour, end_hour in schedule["hour_ranges"]:
+                for hour_24 in range(start_hour, end_hour):
+                    response = session.post(
+                        f"{url}/api/admin/add_appointment_time_slot",
+                        json={
+                            "date": str(day),
+                            "hour_24": hour_24,
+                            "capacity": schedule["capacity"],
+                        },
+                        headers=csrf_headers(session),
+                    )
+                    if response.status_code == 200:
+                        created += 1
+        day += timedelta(days=1)
+
+    return created
+
+
+def add_in_bulk(url: str, session: requests.Session, schedule: dict) -> int:
+    response = session.post(
+        f"{url}/api/admin/add_appointment_time_slots",
+        json={"recurrence": schedule},
+        headers=csrf_headers(session),
+    )
+    response.raise_for_status()
+    return response.json()["created"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--email", default="testadmin@gmail.com")
+    parser.add_argument("--password", default="password7")
+    parser.add_argument("--weeks", type=int, default=15)
+    parser.add_argument("--year", type=int, default=2099)
+    args = parser.parse_args()
+
+    session = login(args.url, args.email, args.password)
+
+    # Each run gets its own half of the year so neither skips slots the other created
+    for name, start_date, add in (
+        ("per slot", date(args.year, 1, 1), add_one_at_a_time),
+        ("bulk", date(args.year, 7, 1), add_in_bulk),
+    ):
+        start = time.perf_counter()
+        created = add(args.url, session, recurrence(start_date, args.weeks, 4))
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {created} slots in {elapsed:.2f}s ({created / elapsed:.0f} slots/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Times the admin appointment listing for windows of different lengths as the seeded history grows a year at a
+# time, to show its latency follows the size of the requested window and not the number of slots in the table.
+# Runs against the database in the backend config, seeding hourly slots with bookings from 2090 onwards in a
+# transaction that is rolled back afterwards, e.g.
+#
+#   python benchmarks/bench_admin_listing_window.py --years 5 --windows 1 7 30 365
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import create_app
+from app.admin import iter_all_appointments, load_all_appointments_json
+from app.config import DevelopmentConfig
+from app.db import db
+from datetime import date, timedelta
+from sqlalchemy import text
+import argparse
+import time
+
+START_DATE = date(2090, 1, 1)
+
+
+def seed_users(bookings_per_appointment: int):
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Users
+            (name, email, passwordSaltedHashed)
+            SELECT 'Bench ' || n, 'bench' || n || '@example.com', '\\x00'
+            FROM generate_series(1, :users) AS n;
+            """
+        ),
+        {"users": bookings_per_appointment},
+    )
+
+
+# Adds a slot for every hour from first_hour to last_hour on each day of [start_date, end_date), each booked by
+# every benchmark user
+def seed_slots(start_date: date, end_date: date, first_hour: int, last_hour: int, bookings_per_appointment: int):
+    db.session.execute(
+        text(
+            """
+            INSERT INTO AppointmentTimeSlots
+            (date, hour24, capacity)
+            SELECT d, h, :capacity
+            FROM generate_series(CAST(:start_date AS DATE), CAST(:end_date AS DATE) - 1, INTERVAL '1 day') AS d
+            CROSS JOIN generate_series(:first_hour, :last_hour) AS h;
+            """
+        ),
+        {
+            "start_date": start_date,
+            "end_date": end_date,
+            "first_hour": first_hour,
+            "last_hour": last_hour,
+            "capacity": bookings_per_appointment,
+        },
+    )
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Bookings
+            (appointmentID, userID, bookingTimestamp, comments, pending)
+            SELECT a.appointmentID, u.userID, CURRENT_TIMESTAMP, 'Benchmark booking', FALSE
+            FROM AppointmentTimeSlots a
+            CROSS JOIN Users u
+            WHERE a.date >= :start_date
+              AND a.date < :end_date
+              AND u.email LIKE 'bench%@example.com';
+            """
+        ),
+        {"start_date": start_date, "end_date": end_date},
+    )
+    # Keep the planner's estimates in step with the table, as autovacuum would between real requests
+    db.session.execute(text("ANALYZE AppointmentTimeSlots, Bookings, Users;"))
+
+
+def best_of(repeat: int, build) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 7, 30, 365])
+    parser.add_argument("--first-hour", type=int, default=8)
+    parser.add_argument("--last-hour", type=int, default=19)
+    parser.add_argument("--bookings-per-appointment", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app(DevelopmentConfig())
+    with app.app_context():
+        seed_users(args.bookings_per_appointment)
+        try:
+            for year in range(1, args.years + 1):
+                seed_slots(
+                    START_DATE.replace(year=START_DATE.year + year - 1),
+                    START_DATE.replace(year=START_DATE.year + year),
+                    args.first_hour,
+                    args.last_hour,
+                    args.bookings_per_appointment,
+                )
+
+                # The same windows every time, starting in the middle of the first year, so only the history
+                # around them changes between rounds
+                for days in args.windows:
+                    start_date = str(START_DATE + timedelta(days=182 - days // 2))
+                    end_date = str(START_DATE + timedelta(days=182 - days // 2 + days))
+
+                    appointment_count = 0
+                    for _ in iter_all_appointments(start_date, end_date, None, None):
+                        appointment_count += 1
+
+                    python_seconds = best_of(
+                        args.repeat,
+                        lambda: list(iter_all_appointments(start_date, end_date, None, None)),
+                    )
+                    postgres_seconds = best_of(
+                        args.repeat,
+                        lambda: load_all_appointments_json(start_date, end_date, None, None),
+                    )
+                    print(
+                        f"{year} year(s) of slots, {days} day window, {appointment_count} appointments: "
+                        f"python grouping {1000 * python_seconds:.1f}ms, "
+                        f"postgres json_agg {1000 * postgres_seconds:.1f}ms, "
+                        f"{1e6 * postgres_seconds / max(appointment_count, 1):.0f}us per appointment"
+                    )
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
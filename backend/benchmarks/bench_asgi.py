@@ -0,0 +1,78 @@
+# Load tests get_available_appointments on one or more running backends and reports requests/s and latency
+# percentiles for each, for comparing the gunicorn production image with the uvicorn one from app/asgi.py, e.g.
+#
+#   docker build --target production -t booking-backend-sync backend
+#   docker build --target production-asgi -t booking-backend-asgi backend
+#   python benchmarks/bench_asgi.py --url http://localhost:5001 --url http://localhost:5002 --concurrency 64
+#
+# Half the requests repeat the previous request's ETag, as a calendar revisiting a week would
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import argparse
+import random
+import requests
+import statistics
+import threading
+import time
+
+
+def run_client(url: str, weeks: int, deadline: float) -> tuple[list[float], int]:
+    session = requests.Session()
+    etags: dict[str, str] = {}
+    latencies = []
+    errors = 0
+
+    while time.perf_counter() < deadline:
+        start_date = date(2025, 8, 4) + timedelta(weeks=random.randrange(weeks))
+        params = {"start_date": str(start_date), "end_date": str(start_date + timedelta(days=7))}
+        headers = {}
+        if str(start_date) in etags and random.random() < 0.5:
+            headers["If-None-Match"] = etags[str(start_date)]
+
+        start = time.perf_counter()
+        response = session.get(f"{url}/api/book/get_available_appointments", params=params, headers=headers)
+        latencies.append(time.perf_counter() - start)
+
+        if response.status_code == 200:
+            etags[str(start_date)] = response.headers.get("ETag", "")
+        elif response.status_code != 304:
+            errors += 1
+
+    return latencies, errors
+
+
+def load_test(url: str, concurrency: int, seconds: float, weeks: int) -> tuple[list[float], int]:
+    # Every client starts together, after each has set up its session
+    barrier = threading.Barrier(concurrency)
+
+    def client() -> tuple[list[float], int]:
+        barrier.wait()
+        return run_client(url, weeks, time.perf_counter() + seconds)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: client(), range(concurrency)))
+
+    latencies = [latency for client_latencies, _ in results for latency in client_latencies]
+    errors = sum(client_errors for _, client_errors in results)
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", action="append", default=[])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--weeks", type=int, default=8)
+    args = parser.parse_args()
+
+    for url in args.url or ["http://localhost:5001"]:
+        latencies, errors = load_test(url, args.concurrency, args.seconds, args.weeks)
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"{url}: {len(latencies) / args.seconds:.0f} req/s, "
+            f"p50 {1000 * percentiles[49]:.1f}ms, p99 {1000 * percentiles[98]:.1f}ms, {errors} errors"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# Compares jobs/s of the booking tasks' database work as separate statements, the way the tasks used to do it, against
+# the single statements they use now, running new booking confirmations and then leader cancellations one after
+# another in this process. Both queue their emails in the same transaction. Runs against the database in the backend
+# config, seeding pending bookings on slots from 2090 onwards and deleting them and their emails afterwards, without
+# sending anything. The gap grows with the round trip
+# time to the database, so point it at one across a network to see what the worker sees, e.g.
+#
+#   python benchmarks/bench_booking_tasks.py --appointments 2000
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import create_app
+from app.config import DevelopmentConfig
+from app.db import db
+from app.emails import book_appointment_confirmation_email, queue_emails
+from app.tasks import book_new_appointment_task, cancel_appointment_task, generate_confirmation_code
+from sqlalchemy import text
+import argparse
+import time
+
+START_DATE = "2090-01-01"
+# Each slot is booked by this many users, the first of whom leads it
+USERS = 2
+
+
+class BenchConfig(DevelopmentConfig):
+    EMAIL_TRANSPORT = "fake"
+
+
+def seed(appointments: int) -> list[int]:
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Users
+            (name, email, passwordSaltedHashed)
+            SELECT 'Bench ' || n, 'bench' || n || '@example.com', '\\x00'
+            FROM generate_series(1, :users) AS n;
+            """
+        ),
+        {"users": USERS},
+    )
+    db.session.execute(
+        text(
+            """
+            INSERT INTO AppointmentTimeSlots
+            (date, hour24, capacity)
+            SELECT CAST(:start_date AS DATE) + n / 24, n % 24, :users
+            FROM generate_series(0, :appointments - 1) AS n;
+            """
+        ),
+        {"start_date": START_DATE, "appointments": appointments, "users": USERS},
+    )
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Bookings
+            (appointmentID, userID, bookingTimestamp, comments, pending)
+            SELECT a.appointmentID, u.userID, CURRENT_TIMESTAMP + u.userID * INTERVAL '1 second', '', TRUE
+            FROM AppointmentTimeSlots a
+            CROSS JOIN Users u
+            WHERE a.date >= :start_date
+              AND u.email LIKE 'bench%@example.com';
+            """
+        ),
+        {"start_date": START_DATE},
+    )
+    db.session.commit()
+
+    records = db.session.execute(
+        text("SELECT userID FROM Users WHERE email LIKE 'bench%@example.com' ORDER BY userID;")
+    ).fetchall()
+    return [record[0] for record in records]
+
+
+def appointment_ids() -> list[int]:
+    records = db.session.execute(
+        text("SELECT appointmentID FROM AppointmentTimeSlots WHERE date >= :start_date ORDER BY appointmentID;"),
+        {"start_date": START_DATE},
+    ).fetchall()
+    return [record[0] for record in records]
+
+
+def clean_up():
+    db.session.execute(
+        text(
+            """
+            DELETE FROM Bookings
+            WHERE appointmentID IN (SELECT appointmentID FROM AppointmentTimeSlots WHERE date >= :start_date);
+            """
+        ),
+        {"start_date": START_DATE},
+    )
+    db.session.execute(
+        text("DELETE FROM AppointmentTimeSlots WHERE date >= :start_date;"),
+        {"start_date": START_DATE},
+    )
+    db.session.execute(text("DELETE FROM Users WHERE email LIKE 'bench%@example.com';"))
+    db.session.execute(text("DELETE FROM PendingEmails WHERE email->>'to' LIKE 'bench%@example.com';"))
+    db.session.commit()
+
+
+def select_email_details(appointment_id: int, user_id: int):
+    db.session.execute(text("SELECT name, email FROM Users WHERE userID = :user_id;"), {"user_id": user_id})
+    db.session.execute(
+        text("SELECT date, hour24 FROM AppointmentTimeSlots WHERE appointmentID = :appointment_id;"),
+        {"appointment_id": appointment_id},
+    )
+    queue_emails([book_appointment_confirmation_email("bench1@example.com", "Bench 1", START_DATE, "0:00")])
+
+
+# The statements book_new_appointment_task ran before they were combined
+def book_new_separately(appointment_id: int, user_id: int):
+    db.session.execute(
+        text(
+            """
+            UPDATE Bookings
+            SET comments = :comments, pending = FALSE
+            WHERE appointmentID = :appointment_id
+              AND userID = :user_id;
+            """
+        ),
+        {"appointment_id": appointment_id, "user_id": user_id, "comments": "Benchmark"},
+    )
+    db.session.execute(
+        text(
+            """
+            UPDATE AppointmentTimeSlots
+            SET leaderUserID = :leader_user_id, confirmationCode = :confirmation_code,
+                subject = :subject, location = :location
+            WHERE appointmentID = :appointment_id;
+            """
+        ),
+        {
+            "leader_user_id": user_id,
+            "confirmation_code": generate_confirmation_code(),
+            "subject": "Math",
+            "location": "Building A",
+            "appointment_id": appointment_id,
+        },
+    )
+    select_email_details(appointment_id, user_id)
+    db.session.commit()
+
+
+# The statements cancel_appointment_task ran before they were combined, for a leader who isn't the last booking
+def cancel_separately(appointment_id: int, user_id: int):
+    db.session.execute(
+        text("DELETE FROM Bookings WHERE userID = :user_id AND appointmentID = :appointment_id;"),
+        {"user_id": user_id, "appointment_id": appointment_id},
+    )
+    db.session.execute(
+        text("SELECT leaderUserID, confirmationCode FROM AppointmentTimeSlots WHERE appointmentID = :appointment_id;"),
+        {"appointment_id": appointment_id},
+    )
+    record = db.session.execute(
+        text(
+            """
+            SELECT userID AS user_id
+            FROM Bookings
+            WHERE appointmentID = :appointment_id
+              AND bookingTimestamp = (
+                    SELECT MIN(bookingTimestamp)
+                    FROM Bookings
+                    WHERE appointmentID = :appointment_id
+                )
+            LIMIT 1;
+            """
+        ),
+        {"appointment_id": appointment_id},
+    ).fetchone()
+    db.session.execute(
+        text(
+            """
+            UPDATE AppointmentTimeSlots
+            SET leaderUserID = :leader_user_id, confirmationCode = :confirmation_code
+            WHERE appointmentID = :appointment_id;
+            """
+        ),
+        {
+            "leader_user_id": record[0],
+            "confirmation_code": generate_confirmation_code(),
+            "appointment_id": appointment_id,
+        },
+    )
+    select_email_details(appointment_id, user_id)
+    db.session.commit()
+
+
+def book_new_combined(appointment_id: int, user_id: int):
+    book_new_appointment_task(
+        appointment_id=appointment_id, user_id=user_id, comments="Benchmark", subject="Math", location="Building A"
+    )
+
+
+def cancel_combined(appointment_id: int, user_id: int):
+    cancel_appointment_task(appointment_id=appointment_id, user_id=user_id)
+
+
+def jobs_per_second(job, appointments: list[int], user_id: int) -> float:
+    start = time.perf_counter()
+    for appointment_id in appointments:
+        job(appointment_id, user_id)
+    return len(appointments) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--appointments", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_app(BenchConfig())
+    with app.app_context():
+        for name, book_new, cancel in (
+            ("separate statements", book_new_separately, cancel_separately),
+            ("combined statements", book_new_combined, cancel_combined),
+        ):
+            leader_user_id = seed(args.appointments)[0]
+            try:
+                appointments = appointment_ids()
+                book_new_rate = jobs_per_second(book_new, appointments, leader_user_id)
+                cancel_rate = jobs_per_second(cancel, appointments, leader_user_id)
+                print(
+                    f"{name}: book_new_appointment_task {book_new_rate:.0f} jobs/s, "
+                    f"cancel_appointment_task {cancel_rate:.0f} jobs/s"
+                )
+            finally:
+                clean_up()
+
+
+if __name__ == "__main__":
+    main()
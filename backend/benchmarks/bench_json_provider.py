@@ -0,0 +1,109 @@
+# Times encoding get_available_appointments and get_all_appointments sized payloads with Flask's default JSON
+# provider and with ours, both on the json module and on orjson, e.g.
+#
+#   python benchmarks/bench_json_provider.py --appointments 10000
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.json_provider import (
+    JSONFragment,
+    StdlibJSONProvider,
+    OrjsonJSONProvider,
+    orjson,
+)
+from datetime import date, timedelta
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import argparse
+import time
+
+
+def available_appointments(count: int) -> dict:
+    return {
+        "appointments": [
+            {
+                "appointment_id": n,
+                "date": str(date(2025, 1, 1) + timedelta(days=n // 24)),
+                "hour_24": n % 24,
+                "capacity": 4,
+                "slots_booked": n % 4,
+            }
+            for n in range(count)
+        ]
+    }
+
+
+def all_appointments(count: int) -> dict:
+    return {
+        "appointments": [
+            {
+                "appointment_id": n,
+                "date": str(date(2025, 1, 1) + timedelta(days=n // 24)),
+                "hour_24": n % 24,
+                "capacity": 4,
+                "slots_booked": 3,
+                "leader_name": f"Leader {n}",
+                "subject": "Math",
+                "location": "Building A",
+                "confirmation_code": "123456",
+                "bookings": [
+                    {
+                        "name": f"Student {n} {booking}",
+                        "email": f"student{n}.{booking}@gmail.com",
+                        "comments": "Cover matrix multiplication",
+                    }
+                    for booking in range(3)
+                ],
+            }
+            for n in range(count)
+        ]
+    }
+
+
+def best_of(repeat: int, encode) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--appointments", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    providers = [
+        ("flask default", DefaultJSONProvider(app)),
+        ("stdlib", StdlibJSONProvider(app)),
+    ]
+    if orjson is not None:
+        providers.append(("orjson", OrjsonJSONProvider(app)))
+    else:
+        print("orjson is not installed, skipping it")
+
+    for payload_name, payload in (
+        ("get_available_appointments", available_appointments(args.appointments)),
+        ("get_all_appointments", all_appointments(args.appointments)),
+    ):
+        # The same array already encoded, as the Postgres aggregation path hands it over
+        fragment_payload = {
+            "appointments": JSONFragment(StdlibJSONProvider(app).dumps(payload["appointments"]))
+        }
+        print(f"{payload_name}, {args.appointments} appointments:")
+        for provider_name, provider in providers:
+            elapsed = best_of(args.repeat, lambda: provider.dumps(payload))
+            print(f"  {provider_name}: {1000 * elapsed:.1f}ms")
+        for provider_name, provider in providers[1:]:
+            elapsed = best_of(args.repeat, lambda: provider.dumps(fragment_payload))
+            print(f"  {provider_name} with pre-encoded fragment: {1000 * elapsed:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Compares building the admin appointment listing by grouping rows in Python against having Postgres aggregate it
+# into JSON, reporting time and peak Python memory for each. Runs against the database in the backend config,
+# seeding slots and bookings from 2090 onwards in a transaction that is rolled back afterwards, e.g.
+#
+#   python benchmarks/bench_listing_aggregation.py --appointments 10000 --bookings-per-appointment 3
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import create_app
+from app.admin import iter_all_appointments, load_all_appointments_json
+from app.config import DevelopmentConfig
+from app.db import db
+from flask import current_app
+from sqlalchemy import text
+import argparse
+import time
+import tracemalloc
+
+START_DATE = "2090-01-01"
+END_DATE = "2100-01-01"
+
+
+def seed(appointments: int, bookings_per_appointment: int):
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Users
+            (name, email, passwordSaltedHashed)
+            SELECT 'Bench ' || n, 'bench' || n || '@example.com', '\\x00'
+            FROM generate_series(1, :users) AS n;
+            """
+        ),
+        {"users": bookings_per_appointment},
+    )
+    db.session.execute(
+        text(
+            """
+            INSERT INTO AppointmentTimeSlots
+            (date, hour24, capacity)
+            SELECT CAST(:start_date AS DATE) + n / 24, n % 24, :capacity
+            FROM generate_series(0, :appointments - 1) AS n;
+            """
+        ),
+        {
+            "start_date": START_DATE,
+            "appointments": appointments,
+            "capacity": bookings_per_appointment,
+        },
+    )
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Bookings
+            (appointmentID, userID, bookingTimestamp, comments, pending)
+            SELECT a.appointmentID, u.userID, CURRENT_TIMESTAMP, 'Benchmark booking', FALSE
+            FROM AppointmentTimeSlots a
+            CROSS JOIN Users u
+            WHERE a.date >= :start_date
+              AND u.email LIKE 'bench%@example.com';
+            """
+        ),
+        {"start_date": START_DATE},
+    )
+
+
+def group_in_python() -> str:
+    appointments = list(iter_all_appointments(START_DATE, END_DATE, None, None))
+    return current_app.json.dumps({"appointments": appointments})
+
+
+def aggregate_in_postgres() -> str:
+    appointments_json, _, _ = load_all_appointments_json(START_DATE, END_DATE, None, None)
+    return '{"appointments": ' + appointments_json + "}"
+
+
+def measure(build) -> tuple[float, int, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    body = build()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--appointments", type=int, default=10000)
+    parser.add_argument("--bookings-per-appointment", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app(DevelopmentConfig())
+    with app.app_context():
+        seed(args.appointments, args.bookings_per_appointment)
+        try:
+            for name, build in (
+                ("python grouping", group_in_python),
+                ("postgres json_agg", aggregate_in_postgres),
+            ):
+                results = [measure(build) for _ in range(args.repeat)]
+                best_elapsed = min(elapsed for elapsed, _, _ in results)
+                max_peak = max(peak for _, peak, _ in results)
+                print(
+                    f"{name}: best {1000 * best_elapsed:.0f}ms, "
+                    f"peak {max_peak / (1024 * 1024):.1f}MiB, {results[0][2]} bytes"
+                )
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Fires concurrent logins at a running backend and reports throughput, latency and how many were turned away
+# with 429s. Compare runs with different PASSWORD_HASH_POOL_SIZE / PASSWORD_HASH_MAX_PENDING settings, e.g.
+#
+#   python benchmarks/bench_login.py --url http://localhost:5001 --concurrency 32 --requests 500
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import argparse
+import requests
+import statistics
+import time
+
+
+def login(url: str, email: str, password: str) -> tuple[int, float]:
+    start = time.perf_counter()
+    response = requests.post(
+        f"{url}/api/auth/login", json={"email": email, "password": password}
+    )
+    return response.status_code, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--email", default="tester@gmail.com")
+    parser.add_argument("--password", default="password6")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda _: login(args.url, args.email, args.password),
+                range(args.requests),
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for status, latency in results if status == 200)
+
+    print(f"{args.requests} logins, {args.concurrency} concurrent, {elapsed:.2f}s")
+    print(f"statuses: {dict(statuses)}")
+    print(f"successful logins/s: {statuses[200] / elapsed:.1f}")
+    if len(latencies) > 0:
+        print(
+            f"latency p50: {1000 * statistics.median(latencies):.0f}ms, "
+            f"p99: {1000 * latencies[int(0.99 * (len(latencies) - 1))]:.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
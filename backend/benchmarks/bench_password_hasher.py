@@ -0,0 +1,79 @@
+# Fires a burst of concurrent password checks at the password hasher in this process, without a database or web
+# server, and reports throughput, latency and how many were turned away, i.e. got a 503 from login. Compare pool
+# sizes against hashing inline (--pool-size 0), e.g.
+#
+#   python benchmarks/bench_password_hasher.py --pool-size 2 --max-pending 8 --concurrency 32 --checks 200
+#
+# bench_login.py measures the same through a running backend, including the threads waiting on the hasher
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.passwords import PasswordHasher, PasswordHasherSaturated
+from bcrypt import gensalt, hashpw
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+import argparse
+import statistics
+import time
+
+
+def check(password_hasher: PasswordHasher, password_hashed: bytes) -> tuple[bool, float]:
+    start = time.perf_counter()
+    try:
+        password_hasher.check_password("password", password_hashed)
+    except PasswordHasherSaturated:
+        return False, time.perf_counter() - start
+
+    return True, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--pool-size", type=int, default=2)
+    parser.add_argument("--max-pending", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=3.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--checks", type=int, default=200)
+    args = parser.parse_args()
+
+    password_hasher = PasswordHasher()
+    password_hasher.pool_size = args.pool_size
+    password_hasher.max_pending = args.max_pending
+    password_hasher.timeout_seconds = args.timeout
+    password_hasher._slots = BoundedSemaphore(max(args.pool_size, 1) + args.max_pending)
+    password_hashed = hashpw(b"password", gensalt(args.rounds))
+
+    try:
+        # Starts the pool's processes before timing
+        if args.pool_size > 0:
+            password_hasher._get_executor().submit(time.sleep, 0).result()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda _: check(password_hasher, password_hashed), range(args.checks)))
+        elapsed = time.perf_counter() - start
+    finally:
+        password_hasher.shutdown()
+
+    latencies = sorted(latency for checked, latency in results if checked)
+    stats = password_hasher.stats()
+    print(
+        f"pool size {args.pool_size}, max pending {args.max_pending}: {args.checks} checks, "
+        f"{args.concurrency} concurrent, {elapsed:.2f}s"
+    )
+    print(
+        f"checked/s: {len(latencies) / elapsed:.1f}, turned away: {stats['rejected']} when full, "
+        f"{stats['timed_out']} timed out"
+    )
+    if len(latencies) > 0:
+        print(
+            f"latency p50: {1000 * statistics.median(latencies):.0f}ms, "
+            f"p99: {1000 * latencies[int(0.99 * (len(latencies) - 1))]:.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
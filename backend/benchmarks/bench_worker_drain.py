@@ -0,0 +1,164 @@
+# Times the worker supervisor draining a backlog of booking confirmation jobs, reporting jobs/s, for comparing
+# process counts and per-queue concurrency against the old single job at a time worker. Runs against the database
+# in the backend config with emails going to the fake transport, seeding pending bookings on slots from 2090
+# onwards and deleting them, their jobs and any emails left unsent afterwards, e.g.
+#
+#   python benchmarks/bench_worker_drain.py --jobs 10000 --processes 1 --concurrency 1
+#   python benchmarks/bench_worker_drain.py --jobs 10000 --processes 2 --concurrency 4
+#
+# Jobs already waiting in the bookings queue are drained along with the seeded ones, so run it against an idle
+# database with no other worker running
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import create_app
+from app.config import DevelopmentConfig
+from app.db import db
+from app.outbox import relay_job_manager
+from app.tasks import book_existing_appointment_task
+from app.worker import WorkerSupervisor
+from sqlalchemy import text
+import argparse
+import time
+
+START_DATE = "2090-01-01"
+USERS = 10
+
+
+class BenchConfig(DevelopmentConfig):
+    EMAIL_TRANSPORT = "fake"
+
+
+def seed(jobs: int) -> int:
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Users
+            (name, email, passwordSaltedHashed)
+            SELECT 'Bench ' || n, 'bench' || n || '@example.com', '\\x00'
+            FROM generate_series(1, :users) AS n;
+            """
+        ),
+        {"users": USERS},
+    )
+    db.session.execute(
+        text(
+            """
+            INSERT INTO AppointmentTimeSlots
+            (date, hour24, capacity)
+            SELECT CAST(:start_date AS DATE) + n / 24, n % 24, :users
+            FROM generate_series(0, :appointments - 1) AS n;
+            """
+        ),
+        {"start_date": START_DATE, "appointments": (jobs + USERS - 1) // USERS, "users": USERS},
+    )
+    records = (
+        db.session.execute(
+            text(
+                """
+                INSERT INTO Bookings
+                (appointmentID, userID, bookingTimestamp, comments, pending)
+                SELECT a.appointmentID, u.userID, CURRENT_TIMESTAMP, '', TRUE
+                FROM AppointmentTimeSlots a
+                CROSS JOIN Users u
+                WHERE a.date >= :start_date
+                  AND u.email LIKE 'bench%@example.com'
+                ORDER BY a.appointmentID, u.userID
+                LIMIT :jobs
+                RETURNING appointmentID AS appointment_id, userID AS user_id;
+                """
+            ),
+            {"start_date": START_DATE, "jobs": jobs},
+        )
+        .mappings()
+        .fetchall()
+    )
+
+    relay_job_manager.batch_defer_jobs(
+        [
+            book_existing_appointment_task.configure().make_new_job(
+                appointment_id=record.get("appointment_id"),
+                user_id=record.get("user_id"),
+                comments="Benchmark booking",
+            )
+            for record in records
+        ]
+    )
+    db.session.commit()
+    return len(records)
+
+
+def clean_up():
+    db.session.execute(
+        text(
+            """
+            DELETE FROM procrastinate_jobs
+            WHERE task_name = :task_name
+              AND args->>'comments' = 'Benchmark booking';
+            """
+        ),
+        {"task_name": book_existing_appointment_task.name},
+    )
+    db.session.execute(
+        text(
+            """
+            DELETE FROM Bookings
+            WHERE appointmentID IN (SELECT appointmentID FROM AppointmentTimeSlots WHERE date >= :start_date);
+            """
+        ),
+        {"start_date": START_DATE},
+    )
+    db.session.execute(
+        text("DELETE FROM AppointmentTimeSlots WHERE date >= :start_date;"),
+        {"start_date": START_DATE},
+    )
+    db.session.execute(text("DELETE FROM Users WHERE email LIKE 'bench%@example.com';"))
+    db.session.execute(text("DELETE FROM PendingEmails WHERE email->>'to' LIKE 'bench%@example.com';"))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    # Set on the instance so they're pickled along with it into the worker processes
+    config = BenchConfig()
+    config.WORKER_PROCESSES = args.processes
+    config.WORKER_QUEUE_CONCURRENCY = {"bookings": args.concurrency}
+
+    app = create_app(config)
+    with app.app_context():
+        jobs = seed(args.jobs)
+        try:
+            start = time.perf_counter()
+            WorkerSupervisor(app, config, wait=False).run()
+            elapsed = time.perf_counter() - start
+
+            remaining = db.session.execute(
+                text(
+                    """
+                    SELECT COUNT(*)
+                    FROM procrastinate_jobs
+                    WHERE task_name = :task_name
+                      AND args->>'comments' = 'Benchmark booking'
+                      AND status <> 'succeeded';
+                    """
+                ),
+                {"task_name": book_existing_appointment_task.name},
+            ).fetchone()[0]
+            db.session.commit()
+            print(
+                f"{args.processes} process(es) x {args.concurrency} concurrent jobs: {jobs} jobs in {elapsed:.1f}s, "
+                f"{jobs / elapsed:.0f} jobs/s, {remaining} not succeeded"
+            )
+        finally:
+            clean_up()
+
+
+if __name__ == "__main__":
+    main()
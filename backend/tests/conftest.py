@@ -3,6 +3,7 @@ import os
 from app import create_app
 from app.config import TestingConfig
 from app.db import db as app_db
+from app.migrate import apply_migrations
 from sqlalchemy import text
 
 _data_sql: str
@@ -10,6 +11,22 @@ with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as f:
     _data_sql = f.read().decode("utf8")
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-slow", action="store_true", help="run tests that seed large datasets"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-slow"):
+        return
+
+    skip_slow = pytest.mark.skip(reason="needs --run-slow to run")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
+
+
 @pytest.fixture()
 def app():
     app = create_app(TestingConfig())
@@ -17,6 +34,7 @@ def app():
 
     with app.app_context():
         app_db.session.execute(text(_data_sql))
+        apply_migrations()
         yield app
 
 
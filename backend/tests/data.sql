@@ -1,3 +1,8 @@
+DROP TABLE IF EXISTS SchemaMigrations;
+DROP TABLE IF EXISTS PendingEmails;
+DROP TABLE IF EXISTS Outbox;
+DROP TABLE IF EXISTS AvailabilityVersions;
+DROP TABLE IF EXISTS RateLimitHits;
 DROP TABLE IF EXISTS Bookings;
 DROP TABLE IF EXISTS AppointmentTimeSlots;
 DROP TABLE IF EXISTS UserRoles;
@@ -30,7 +35,8 @@ CREATE TABLE Bookings (
     appointmentID INT REFERENCES AppointmentTimeSlots,
     userID INT REFERENCES Users,
     bookingTimestamp TIMESTAMP NOT NULL,
-    comments VARCHAR(512) NOT NULL
+    comments VARCHAR(512) NOT NULL,
+    pending BOOLEAN NOT NULL
 );
 
 INSERT INTO Users
@@ -64,8 +70,8 @@ VALUES
 ('2025-08-06', 8, 4, NULL, NULL, NULL, NULL);
 
 INSERT INTO Bookings
-(appointmentID, userID, bookingTimestamp, comments)
+(appointmentID, userID, bookingTimestamp, comments, pending)
 VALUES
-(6, 1, CURRENT_TIMESTAMP - INTERVAL '1' HOUR, 'No comment'),
-(6, 2, CURRENT_TIMESTAMP, 'Cover matrix multiplication'),
-(2, 3, CURRENT_TIMESTAMP, 'No notes');
\ No newline at end of file
+(6, 1, CURRENT_TIMESTAMP - INTERVAL '1' HOUR, 'No comment', FALSE),
+(6, 2, CURRENT_TIMESTAMP, 'Cover matrix multiplication', FALSE),
+(2, 3, CURRENT_TIMESTAMP, 'No notes', FALSE);
\ No newline at end of file
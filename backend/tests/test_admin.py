@@ -1,5 +1,8 @@
 from app.db import db
+from app.jwt import identity_cache
+from flask_jwt_extended import decode_token
 from sqlalchemy import text
+import json
 
 
 def test_invalid_access(client, auth):
@@ -264,3 +267,424 @@ def test_remove_appointment_time_slot(client, auth):
         {"appointment_id": appointment_id},
     ).fetchone()
     assert appointment_record is None
+
+
+def test_role_is_cached_with_user(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    for _ in range(2):
+        response = client.get(
+            "/api/admin/is_admin", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+        )
+        assert response.status_code == 200
+    assert identity_cache.stats()["hits"] == 1
+    assert identity_cache.stats()["hit_ratio"] == 0.5
+
+    # The cached user doesn't outlive a role change
+    db.session.execute(text("DELETE FROM UserRoles WHERE userID = 7;"))
+    response = client.get(
+        "/api/admin/is_admin", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+    )
+    assert response.status_code == 401
+
+
+def test_deleted_user_is_rejected_despite_cache(client, auth):
+    auth.login()
+    response = client.get(
+        "/api/auth/get_user_info", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+    )
+    assert response.status_code == 200
+
+    db.session.execute(text("DELETE FROM Users WHERE email = 'tester@gmail.com';"))
+    response = client.get(
+        "/api/auth/get_user_info", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+    )
+    assert response.status_code == 401
+
+
+def test_roles_are_access_token_claims(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+    claims = decode_token(client.get_cookie("access_token_cookie").value)
+    assert claims["roles"] == ["admin"]
+
+    auth.login("alice@gmail.com", "password1")
+    claims = decode_token(client.get_cookie("access_token_cookie").value)
+    assert claims["roles"] == []
+
+
+def test_role_change_rejects_older_tokens(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+    db.session.execute(text("DELETE FROM UserRoles WHERE userID = 7;"))
+
+    response = client.get(
+        "/api/admin/is_admin", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+    )
+    assert response.status_code == 401
+
+    auth.login("testadmin@gmail.com", "password7")
+    response = client.get(
+        "/api/admin/is_admin", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+    )
+    assert response.status_code == 401
+    response = client.get(
+        "/api/auth/get_user_info", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+    )
+    assert response.status_code == 200
+
+
+def test_add_appointment_time_slots_from_list(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    response = client.post(
+        "/api/admin/add_appointment_time_slots",
+        json={
+            "time_slots": [
+                {"date": "2025-09-12", "hour_24": 14, "capacity": 5},
+                {"date": "2025-09-12", "hour_24": 15, "capacity": 3},
+                {"date": "2025-08-01", "hour_24": 9, "capacity": 5},
+                {"date": "2025-09-12", "hour_24": 14, "capacity": 1},
+            ]
+        },
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+    assert response.json["created"] == 2
+    assert response.json["skipped"] == 2
+
+    records = (
+        db.session.execute(
+            text(
+                "SELECT hour24, capacity FROM AppointmentTimeSlots WHERE date = '2025-09-12' ORDER BY hour24;"
+            )
+        )
+        .mappings()
+        .fetchall()
+    )
+    assert [(record.get("hour24"), record.get("capacity")) for record in records] == [
+        (14, 5),
+        (15, 3),
+    ]
+
+
+def test_add_appointment_time_slots_from_recurrence(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    # Mondays and Wednesdays from 2025-09-01 up to 2025-09-15, 9 to 11 and 14 to 15
+    response = client.post(
+        "/api/admin/add_appointment_time_slots",
+        json={
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [0, 2],
+                "hour_ranges": [[9, 11], [14, 15]],
+                "capacity": 2,
+            }
+        },
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+    assert response.json["created"] == 12
+    assert response.json["skipped"] == 0
+
+    records = (
+        db.session.execute(
+            text(
+                """
+                SELECT date, COUNT(*) AS time_slots
+                FROM AppointmentTimeSlots
+                WHERE date >= '2025-09-01' AND date < '2025-09-15'
+                GROUP BY date
+                ORDER BY date;
+                """
+            )
+        )
+        .mappings()
+        .fetchall()
+    )
+    assert [(str(record.get("date")), record.get("time_slots")) for record in records] == [
+        ("2025-09-01", 3),
+        ("2025-09-03", 3),
+        ("2025-09-08", 3),
+        ("2025-09-10", 3),
+    ]
+
+    # Sending the same recurrence again creates nothing
+    response = client.post(
+        "/api/admin/add_appointment_time_slots",
+        json={
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [0, 2],
+                "hour_ranges": [[9, 11], [14, 15]],
+                "capacity": 2,
+            }
+        },
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.json["created"] == 0
+    assert response.json["skipped"] == 12
+
+
+def test_add_appointment_time_slots_with_invalid_input(client, auth, app):
+    auth.login("testadmin@gmail.com", "password7")
+
+    for json in (
+        {},
+        {"time_slots": [], "recurrence": {}},
+        {"time_slots": [{"date": "2025-09-12", "hour_24": 24, "capacity": 5}]},
+        {
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [7],
+                "hour_ranges": [[9, 11]],
+                "capacity": 2,
+            }
+        },
+        {
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [0],
+                "hour_ranges": [[11, 9]],
+                "capacity": 2,
+            }
+        },
+        {
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [True],
+                "hour_ranges": [[9, 11]],
+                "capacity": 2,
+            }
+        },
+        {
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [0],
+                "hour_ranges": [[False, 9]],
+                "capacity": 2,
+            }
+        },
+        {
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [0],
+                "hour_ranges": [[9, 10]] * 25,
+                "capacity": 2,
+            }
+        },
+    ):
+        response = client.post(
+            "/api/admin/add_appointment_time_slots",
+            json=json,
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        assert response.status_code == 400
+
+    # Turned away by counting, before any of its slots are built
+    response = client.post(
+        "/api/admin/add_appointment_time_slots",
+        json={
+            "recurrence": {
+                "start_date": "0001-01-01",
+                "end_date": "9999-12-31",
+                "weekdays": [0, 1, 2, 3, 4, 5, 6],
+                "hour_ranges": [[0, 24]] * 24,
+                "capacity": 2,
+            }
+        },
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 400
+    assert b"At most" in response.data
+
+    app.config["ADMIN_MAX_BULK_TIME_SLOTS"] = 10
+    response = client.post(
+        "/api/admin/add_appointment_time_slots",
+        json={
+            "recurrence": {
+                "start_date": "2025-09-01",
+                "end_date": "2025-09-15",
+                "weekdays": [0, 1, 2, 3, 4],
+                "hour_ranges": [[9, 17]],
+                "capacity": 2,
+            }
+        },
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 400
+
+
+def test_remove_appointment_time_slots_by_id(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    response = client.delete(
+        "/api/admin/remove_appointment_time_slots",
+        json={"appointment_ids": [2, 6, 1000]},
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+    assert response.json["removed_time_slots"] == 2
+    assert response.json["removed_bookings"] == 3
+
+    count = db.session.execute(
+        text(
+            "SELECT COUNT(*) FROM AppointmentTimeSlots WHERE appointmentID IN (2, 6);"
+        )
+    ).fetchone()[0]
+    assert count == 0
+    count = db.session.execute(text("SELECT COUNT(*) FROM Bookings;")).fetchone()[0]
+    assert count == 0
+
+
+def test_remove_appointment_time_slots_by_date_range(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    response = client.delete(
+        "/api/admin/remove_appointment_time_slots",
+        json={"start_date": "2025-08-01", "end_date": "2025-08-03"},
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+    assert response.json["removed_time_slots"] == 5
+    assert response.json["removed_bookings"] == 1
+
+    records = (
+        db.session.execute(
+            text("SELECT appointmentID FROM AppointmentTimeSlots ORDER BY appointmentID;")
+        )
+        .mappings()
+        .fetchall()
+    )
+    assert [record.get("appointmentid") for record in records] == [6, 7, 8, 9, 10]
+
+
+def test_remove_appointment_time_slots_with_invalid_input(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    for json in (
+        {},
+        {"appointment_ids": [1, "two"]},
+        {"appointment_ids": [True]},
+        {"start_date": "2025-08-01"},
+        {"start_date": "2025-08-01", "end_date": "2025-02-30"},
+    ):
+        response = client.delete(
+            "/api/admin/remove_appointment_time_slots",
+            json=json,
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        assert response.status_code == 400
+
+
+def test_get_all_appointments_paginated(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    appointment_ids = []
+    query_string = {"start_date": "2024-01-01", "end_date": "2026-01-01", "limit": 4}
+    for _ in range(3):
+        response = client.get(
+            "/api/admin/get_all_appointments",
+            query_string=query_string,
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        assert response.status_code == 200
+        appointment_ids.extend(
+            appointment["appointment_id"] for appointment in response.json["appointments"]
+        )
+        query_string["after"] = response.json["next_cursor"]
+
+    assert appointment_ids == [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert query_string["after"] is None
+
+    # A page that ends on a booked appointment still carries all of its bookings
+    response = client.get(
+        "/api/admin/get_all_appointments",
+        query_string={
+            "start_date": "2024-01-01",
+            "end_date": "2026-01-01",
+            "limit": 1,
+            "after": "2025-08-02_10_5",
+        },
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.json["appointments"][0]["appointment_id"] == 6
+    assert len(response.json["appointments"][0]["bookings"]) == 2
+    assert response.json["next_cursor"] == "2025-08-03_7_6"
+
+
+def test_get_all_appointments_ndjson(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    query_string = {"start_date": "2024-01-01", "end_date": "2026-01-01"}
+    response = client.get(
+        "/api/admin/get_all_appointments",
+        query_string=query_string,
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    appointments = response.json["appointments"]
+
+    response = client.get(
+        "/api/admin/get_all_appointments",
+        query_string={**query_string, "format": "ndjson"},
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == appointments
+
+    response = client.get(
+        "/api/admin/get_all_appointments",
+        query_string={**query_string, "format": "ndjson", "limit": 2},
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines[:-1]] == appointments[:2]
+    assert json.loads(lines[-1]) == {"next_cursor": "2025-08-01_14_2"}
+
+
+def test_get_all_appointments_with_invalid_pagination(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    for query_string in (
+        {"limit": 0},
+        {"limit": "many"},
+        {"after": "2025-08-01"},
+        {"format": "xml"},
+    ):
+        response = client.get(
+            "/api/admin/get_all_appointments",
+            query_string={"start_date": "2024-01-01", "end_date": "2026-01-01", **query_string},
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        assert response.status_code == 400
+
+
+def test_get_all_appointments_aggregation_matches(app, client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    for query_string in (
+        {"start_date": "2024-01-01", "end_date": "2026-01-01"},
+        {"start_date": "2024-01-01", "end_date": "2026-01-01", "limit": 3},
+        {"start_date": "2025-08-03", "end_date": "2025-08-05", "limit": 1, "after": "2025-08-03_7_6"},
+        {"start_date": "2030-01-01", "end_date": "2030-02-01"},
+    ):
+        responses = dict()
+        for aggregation in ("postgres", "python"):
+            app.config["APPOINTMENT_LISTING_AGGREGATION"] = aggregation
+            response = client.get(
+                "/api/admin/get_all_appointments",
+                query_string=query_string,
+                headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+            )
+            assert response.status_code == 200
+            responses[aggregation] = response.json
+
+        assert responses["postgres"] == responses["python"]
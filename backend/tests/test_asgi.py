@@ -0,0 +1,177 @@
+from app.asgi import AsyncApp
+from app.availability_feed import availability_feed
+import asyncio
+import httpx
+import json
+import pytest
+
+AVAILABLE_APPOINTMENTS_QUERY = {"start_date": "2025-08-01", "end_date": "2025-08-02"}
+
+
+# Each test runs on one event loop of its own, and the async engine's connections belong to it, so the engine is
+# disposed of before the loop closes
+def run_with_asgi_app(app, test):
+    async def run():
+        asgi_app = AsyncApp(app)
+        try:
+            return await test(asgi_app)
+        finally:
+            await asgi_app.engine.dispose()
+
+    return asyncio.run(run())
+
+
+def asgi_client(asgi_app: AsyncApp) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app), base_url="http://testserver")
+
+
+def test_asgi_available_appointments_match_wsgi(app, client):
+    async def get(asgi_app):
+        async with asgi_client(asgi_app) as asgi:
+            return await asgi.get("/api/book/get_available_appointments", params=AVAILABLE_APPOINTMENTS_QUERY)
+
+    response = run_with_asgi_app(app, get)
+    wsgi_response = client.get("/api/book/get_available_appointments", query_string=AVAILABLE_APPOINTMENTS_QUERY)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["access-control-allow-origin"] == "*"
+    assert response.json() == wsgi_response.json
+    assert len(response.json()["appointments"]) == 3
+    assert response.headers["etag"] == wsgi_response.headers["ETag"]
+
+
+def test_asgi_available_appointments_not_modified(app):
+    async def get_twice(asgi_app):
+        async with asgi_client(asgi_app) as asgi:
+            response = await asgi.get(
+                "/api/book/get_available_appointments", params=AVAILABLE_APPOINTMENTS_QUERY
+            )
+            not_modified = await asgi.get(
+                "/api/book/get_available_appointments",
+                params=AVAILABLE_APPOINTMENTS_QUERY,
+                headers={"If-None-Match": response.headers["etag"]},
+            )
+            other_etag = await asgi.get(
+                "/api/book/get_available_appointments",
+                params=AVAILABLE_APPOINTMENTS_QUERY,
+                headers={"If-None-Match": '"other"'},
+            )
+            return response, not_modified, other_etag
+
+    response, not_modified, other_etag = run_with_asgi_app(app, get_twice)
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["etag"] == response.headers["etag"]
+    assert other_etag.status_code == 200
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"start_date": "2025-08-01"},
+        {"start_date": "2025/08/01", "end_date": "2025-08-02"},
+        {"start_date": "2025-02-30", "end_date": "2025-03-01"},
+    ],
+)
+def test_asgi_available_appointments_invalid_dates(app, params):
+    async def get(asgi_app):
+        async with asgi_client(asgi_app) as asgi:
+            return await asgi.get("/api/book/get_available_appointments", params=params)
+
+    assert run_with_asgi_app(app, get).status_code == 400
+
+
+# Routes without an async version, and other methods on the ones with one, are served by the Flask app
+def test_asgi_falls_back_to_wsgi(app, client):
+    async def get(asgi_app):
+        async with asgi_client(asgi_app) as asgi:
+            user_info = await asgi.get("/api/auth/get_user_info")
+            login = await asgi.post(
+                "/api/auth/login", json={"email": "alice@gmail.com", "password": "password1"}
+            )
+            post_available = await asgi.post(
+                "/api/book/get_available_appointments", params=AVAILABLE_APPOINTMENTS_QUERY
+            )
+            return user_info, login, post_available
+
+    user_info, login, post_available = run_with_asgi_app(app, get)
+    assert user_info.status_code == 401
+    assert login.status_code == 200
+    assert "access_token_cookie" in login.cookies
+    assert post_available.status_code == 405
+
+
+def test_asgi_lifespan(app):
+    async def run_lifespan(asgi_app):
+        messages = asyncio.Queue()
+        for message_type in ("lifespan.startup", "lifespan.shutdown"):
+            await messages.put({"type": message_type})
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await asyncio.wait_for(asgi_app({"type": "lifespan"}, messages.get, send), 5)
+        return sent
+
+    assert run_with_asgi_app(app, run_lifespan) == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+
+def test_asgi_availability_feed(app):
+    async def stream_one_change(asgi_app):
+        received = asyncio.Queue()
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            await received.put(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/api/book/get_availability_feed",
+            "query_string": b"start_date=2025-08-01&end_date=2025-08-02",
+            "headers": [],
+        }
+        feed = asyncio.create_task(asgi_app(scope, receive, send))
+
+        start = await asyncio.wait_for(received.get(), 5)
+        retry = await asyncio.wait_for(received.get(), 5)
+        assert availability_feed.stats()["subscribers"] == 1
+        # Published from a thread, as the listener does; the second change is on a day outside the feed's range
+        await asyncio.to_thread(
+            availability_feed.publish, {"appointment_id": 4, "date": "2025-08-03", "slots_booked": 1}
+        )
+        await asyncio.to_thread(
+            availability_feed.publish, {"appointment_id": 1, "date": "2025-08-01", "slots_booked": 1}
+        )
+        event = await asyncio.wait_for(received.get(), 5)
+
+        disconnect.set()
+        await asyncio.wait_for(feed, 5)
+        return start, retry, event
+
+    start, retry, event = run_with_asgi_app(app, stream_one_change)
+    assert start["status"] == 200
+    assert (b"content-type", b"text/event-stream; charset=utf-8") in start["headers"]
+    assert retry["body"].startswith(b"retry:")
+    assert event["body"].startswith(b"event: slot\n")
+    change = json.loads(event["body"].decode("utf-8").split("data: ", 1)[1])
+    assert change["appointment_id"] == 1
+    # Unsubscribed once the client went away
+    assert availability_feed.stats()["subscribers"] == 0
+
+
+def test_asgi_availability_feed_subscriber_limit(app):
+    availability_feed.max_subscribers = 0
+
+    async def get(asgi_app):
+        async with asgi_client(asgi_app) as asgi:
+            return await asgi.get("/api/book/get_availability_feed", params=AVAILABLE_APPOINTMENTS_QUERY)
+
+    response = run_with_asgi_app(app, get)
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "30"
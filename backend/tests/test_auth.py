@@ -1,6 +1,7 @@
 from app.db import db
 from sqlalchemy import text
 from bcrypt import checkpw
+from app.passwords import password_hasher
 
 
 def test_register(client):
@@ -62,3 +63,76 @@ def test_get_user_info(client, auth):
     assert response.status_code == 200
     assert response.json["name"] == "Tester"
     assert response.json["email"] == "tester@gmail.com"
+
+
+def test_get_user_info_not_modified(client, auth):
+    auth.login()
+
+    response = client.get(
+        "/api/auth/get_user_info",
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        "/api/auth/get_user_info",
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token(), "If-None-Match": etag},
+    )
+    assert response.status_code == 304
+
+
+def test_login_rehashes_password_with_configured_cost(client):
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "alice@gmail.com", "password": "password1"},
+    )
+    assert response.status_code == 200
+
+    password_hashed = db.session.execute(
+        text("SELECT passwordSaltedHashed FROM Users WHERE email = 'alice@gmail.com';")
+    ).fetchone()[0]
+    assert password_hashed.startswith(b"$2b$04$")
+    assert checkpw(bytes("password1", "utf-8"), password_hashed)
+
+
+def test_login_when_password_hasher_saturated(client):
+    held = 0
+    while password_hasher._slots.acquire(blocking=False):
+        held += 1
+
+    try:
+        response = client.post(
+            "/api/auth/login",
+            json={"email": "alice@gmail.com", "password": "password1"},
+        )
+        assert response.status_code == 503
+        assert password_hasher.stats()["rejected"] == 1
+    finally:
+        for _ in range(held):
+            password_hasher._slots.release()
+
+
+def test_login_throttled_per_email(client, app):
+    limit = app.config["LOGIN_RATE_LIMIT_PER_EMAIL"]
+    for _ in range(limit):
+        response = client.post(
+            "/api/auth/login",
+            json={"email": "alice@gmail.com", "password": "wrong password"},
+        )
+        assert response.status_code == 400
+
+    # Rejected before the password is checked, so even the right password gets a 429
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "Alice@gmail.com", "password": "password1"},
+    )
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == str(
+        app.config["LOGIN_RATE_LIMIT_PER_EMAIL_WINDOW_SECONDS"]
+    )
+
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "bob@gmail.com", "password": "password2"},
+    )
+    assert response.status_code == 200
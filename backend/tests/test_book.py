@@ -1,5 +1,18 @@
 from app.db import db
+from app.availability import availability_cache
+from app.availability_feed import Subscription, availability_feed
+from app.outbox import relay_outbox
+from app.tasks import book_existing_appointment_task, cancel_appointment_task, procrastinate_app
+from app.user import User
+from concurrent.futures import ThreadPoolExecutor
+from flask_jwt_extended import create_access_token, get_csrf_token
+from queue import Empty
 from sqlalchemy import text
+from threading import Thread
+from werkzeug.serving import BaseWSGIServer
+import asyncio
+import json
+import requests
 
 
 def test_get_available_appointments_with_multiple_on_that_day(client):
@@ -95,6 +108,26 @@ def test_get_scheduled_appointments_with_no_appointments_scheduled_by_user(
     assert len(response.json["appointments"]) == 0
 
 
+# Runs the tasks the requests so far recorded in the outbox, in order, as the task worker does once they're relayed
+def run_outbox_tasks():
+    records = (
+        db.session.execute(
+            text(
+                """
+                DELETE FROM Outbox
+                RETURNING outboxID AS outbox_id, taskName AS task_name, args AS args;
+                """
+            )
+        )
+        .mappings()
+        .fetchall()
+    )
+    db.session.commit()
+
+    for record in sorted(records, key=lambda record: record.get("outbox_id")):
+        procrastinate_app.tasks[record.get("task_name")](**record.get("args"))
+
+
 def test_book_new_appointment(client, auth):
     auth.login()
 
@@ -116,6 +149,7 @@ def test_book_new_appointment(client, auth):
         headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
     )
     assert response.status_code == 200
+    run_outbox_tasks()
 
     count = db.session.execute(text("SELECT COUNT(*) FROM Bookings;")).fetchone()[0]
     assert count == old_count + 1
@@ -228,6 +262,7 @@ def test_cancel_appointment_with_user_being_leader_and_user_not_only_member(
         headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
     )
     assert response.status_code == 200
+    run_outbox_tasks()
 
     count = db.session.execute(text("SELECT COUNT(*) FROM Bookings;")).fetchone()[0]
     assert count == old_count - 1
@@ -271,6 +306,7 @@ def test_cancel_appointment_with_user_being_only_member(client, auth):
     )
     print(response.data)
     assert response.status_code == 200
+    run_outbox_tasks()
 
     count = db.session.execute(text("SELECT COUNT(*) FROM Bookings;")).fetchone()[0]
     assert count == old_count - 1
@@ -315,3 +351,575 @@ def test_cancel_appointment_that_is_not_booked_by_user(client, auth):
         headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
     )
     assert response.status_code == 400
+
+
+def test_get_available_appointments_is_cached(client):
+    query_string = {"start_date": "2025-08-01", "end_date": "2025-08-08"}
+    response = client.get(
+        "/api/book/get_available_appointments", query_string=query_string
+    )
+    assert response.status_code == 200
+
+    cached_response = client.get(
+        "/api/book/get_available_appointments", query_string=query_string
+    )
+    assert cached_response.json == response.json
+    assert availability_cache.stats()["hits"] == 7
+    assert availability_cache.stats()["misses"] == 7
+
+    # Any change to a slot gives its day a new version stamp, which the cached bucket no longer matches
+    db.session.execute(
+        text("UPDATE AppointmentTimeSlots SET capacity = 10 WHERE appointmentID = 1;")
+    )
+    response = client.get(
+        "/api/book/get_available_appointments", query_string=query_string
+    )
+    # Appointments are ordered by hour alone, so appointment 1 at 9:00 comes after the 8:00 one later in the week
+    capacities = {
+        appointment["appointment_id"]: appointment["capacity"] for appointment in response.json["appointments"]
+    }
+    assert capacities[1] == 10
+    assert availability_cache.stats()["stale"] == 1
+
+
+# A transaction can take its stamp before another one does and still commit after it, so the newest stamp is
+# already visible when the older one shows up
+def test_get_available_appointments_changes_committed_out_of_order(client):
+    query_string = {"start_date": "2025-08-01", "end_date": "2025-08-03"}
+
+    with db.engine.connect() as connection:
+        connection.execute(
+            text("UPDATE AppointmentTimeSlots SET capacity = 10 WHERE appointmentID = 1;")
+        )
+        db.session.execute(
+            text("UPDATE AppointmentTimeSlots SET capacity = 10 WHERE appointmentID = 4;")
+        )
+        db.session.commit()
+
+        response = client.get(
+            "/api/book/get_available_appointments", query_string=query_string
+        )
+        etag = response.headers["ETag"]
+        capacities = {
+            appointment["appointment_id"]: appointment["capacity"] for appointment in response.json["appointments"]
+        }
+        assert (capacities[1], capacities[4]) == (3, 10)
+
+        connection.commit()
+
+    response = client.get(
+        "/api/book/get_available_appointments",
+        query_string=query_string,
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    capacities = {
+        appointment["appointment_id"]: appointment["capacity"] for appointment in response.json["appointments"]
+    }
+    assert capacities[1] == 10
+
+
+def test_get_available_appointments_not_modified(client):
+    query_string = {"start_date": "2025-08-01", "end_date": "2025-08-08"}
+    response = client.get(
+        "/api/book/get_available_appointments", query_string=query_string
+    )
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        "/api/book/get_available_appointments",
+        query_string=query_string,
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.data == b""
+
+    db.session.execute(
+        text("UPDATE AppointmentTimeSlots SET capacity = 10 WHERE appointmentID = 1;")
+    )
+    response = client.get(
+        "/api/book/get_available_appointments",
+        query_string=query_string,
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    # Changes on days outside the requested range keep the same ETag
+    query_string = {"start_date": "2025-08-01", "end_date": "2025-08-06"}
+    response = client.get(
+        "/api/book/get_available_appointments", query_string=query_string
+    )
+    etag = response.headers["ETag"]
+    db.session.execute(
+        text("UPDATE AppointmentTimeSlots SET capacity = 10 WHERE appointmentID = 10;")
+    )
+    response = client.get(
+        "/api/book/get_available_appointments",
+        query_string=query_string,
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 304
+
+
+def test_get_scheduled_appointments_not_modified(client, auth):
+    auth.login("alice@gmail.com", "password1")
+    response = client.get(
+        "/api/book/get_scheduled_appointments",
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        "/api/book/get_scheduled_appointments",
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token(), "If-None-Match": etag},
+    )
+    assert response.status_code == 304
+
+    # Another user's booking changes comments on Alice's appointment
+    db.session.execute(
+        text(
+            "UPDATE Bookings SET comments = 'Changed' WHERE appointmentID = 6 AND userID = 2;"
+        )
+    )
+    response = client.get(
+        "/api/book/get_scheduled_appointments",
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token(), "If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.json["appointments"][0]["bookings"][1]["comments"] == "Changed"
+
+
+def test_book_new_appointment_invalidates_available_appointments(client, auth):
+    query_string = {"start_date": "2025-08-01", "end_date": "2025-08-02"}
+    response = client.get(
+        "/api/book/get_available_appointments", query_string=query_string
+    )
+    assert response.json["appointments"][0]["slots_booked"] == 0
+
+    auth.login()
+    response = client.post(
+        "/api/book/book_new_appointment",
+        json={
+            "appointment_id": 1,
+            "subject": "English",
+            "location": "Building Z",
+            "comments": "",
+        },
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+
+    response = client.get(
+        "/api/book/get_available_appointments", query_string=query_string
+    )
+    assert response.json["appointments"][0]["appointment_id"] == 1
+    assert response.json["appointments"][0]["slots_booked"] == 1
+
+
+def create_stress_users(count: int) -> list[User]:
+    records = (
+        db.session.execute(
+            text(
+                """
+                INSERT INTO Users
+                (name, email, passwordSaltedHashed)
+                SELECT 'Stress ' || n, 'stress' || n || '@gmail.com', '\\x00'
+                FROM generate_series(1, :count) AS n
+                RETURNING userID AS user_id, name AS name, email AS email;
+                """
+            ),
+            {"count": count},
+        )
+        .mappings()
+        .fetchall()
+    )
+    # Committed so the request threads, each on their own connection, can see them
+    db.session.commit()
+
+    return [
+        User(
+            user_id=record.get("user_id"),
+            name=record.get("name"),
+            email=record.get("email"),
+        )
+        for record in records
+    ]
+
+
+def book_concurrently(app, url: str, users: list[User], json: dict) -> list[int]:
+    # Decoding the tokens needs the app context, which the request threads don't have until they make a request
+    access_tokens = [create_access_token(identity=user) for user in users]
+    csrf_tokens = [get_csrf_token(access_token) for access_token in access_tokens]
+
+    def book(access_token: str, csrf_token: str) -> int:
+        client = app.test_client()
+        client.set_cookie("access_token_cookie", access_token)
+        response = client.post(url, json=json, headers={"X-CSRF-TOKEN": csrf_token})
+        return response.status_code
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(book, access_tokens, csrf_tokens))
+
+
+def get_slot_bookings(appointment_id: int) -> tuple[int, int, int]:
+    record = (
+        db.session.execute(
+            text(
+                """
+                SELECT a.capacity AS capacity, a.slotsBooked AS slots_booked,
+                       (SELECT COUNT(*) FROM Bookings b WHERE b.appointmentID = a.appointmentID) AS bookings
+                FROM AppointmentTimeSlots a
+                WHERE a.appointmentID = :appointment_id;
+                """
+            ),
+            {"appointment_id": appointment_id},
+        )
+        .mappings()
+        .fetchone()
+    )
+    db.session.commit()
+
+    return record.get("capacity"), record.get("slots_booked"), record.get("bookings")
+
+
+def test_book_new_appointment_concurrently(app):
+    appointment_id = 1
+    users = create_stress_users(200)
+
+    status_codes = book_concurrently(
+        app,
+        "/api/book/book_new_appointment",
+        users,
+        {
+            "appointment_id": appointment_id,
+            "subject": "English",
+            "location": "Building Z",
+            "comments": "",
+        },
+    )
+
+    assert status_codes.count(200) == 1
+    assert status_codes.count(409) == len(users) - 1
+    _, slots_booked, bookings = get_slot_bookings(appointment_id)
+    assert slots_booked == 1
+    assert bookings == 1
+
+
+def test_book_existing_appointment_concurrently(app):
+    appointment_id = 2
+    old_capacity, old_slots_booked, _ = get_slot_bookings(appointment_id)
+    users = create_stress_users(200)
+
+    status_codes = book_concurrently(
+        app,
+        "/api/book/book_existing_appointment",
+        users,
+        {"appointment_id": appointment_id, "comments": "", "confirmation_code": "841128"},
+    )
+
+    # Every request past the free slots is refused, whichever order they were served in
+    assert status_codes.count(409) == len(users) - (old_capacity - old_slots_booked)
+    capacity, slots_booked, bookings = get_slot_bookings(appointment_id)
+    assert slots_booked == capacity
+    assert bookings == capacity
+
+
+def test_book_existing_appointment_twice(client, auth):
+    auth.login()
+    json = {"appointment_id": 2, "comments": "", "confirmation_code": "841128"}
+
+    response = client.post(
+        "/api/book/book_existing_appointment",
+        json=json,
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+
+    response = client.post(
+        "/api/book/book_existing_appointment",
+        json=json,
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 409
+    assert response.data == b"Already booked this appointment"
+
+
+def count_outbox_entries(task_name: str) -> int:
+    return db.session.execute(
+        text("SELECT COUNT(*) FROM Outbox WHERE taskName = :task_name;"),
+        {"task_name": task_name},
+    ).fetchone()[0]
+
+
+def count_deferred_jobs(task_name: str) -> int:
+    return db.session.execute(
+        text("SELECT COUNT(*) FROM procrastinate_jobs WHERE task_name = :task_name;"),
+        {"task_name": task_name},
+    ).fetchone()[0]
+
+
+def test_book_existing_appointment_records_task_in_outbox(client, auth):
+    auth.login()
+    json = {"appointment_id": 2, "comments": "", "confirmation_code": "841128"}
+
+    response = client.post(
+        "/api/book/book_existing_appointment",
+        json=json,
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 200
+    assert count_outbox_entries(book_existing_appointment_task.name) == 1
+
+    # A refused booking leaves nothing in the outbox
+    response = client.post(
+        "/api/book/book_existing_appointment",
+        json=json,
+        headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+    )
+    assert response.status_code == 409
+    assert count_outbox_entries(book_existing_appointment_task.name) == 1
+
+
+def test_relay_outbox_defers_jobs(client, auth):
+    old_count = count_deferred_jobs(cancel_appointment_task.name)
+
+    # Alice and then Bob cancel their bookings of appointment 6
+    for email, password in (("alice@gmail.com", "password1"), ("bob@gmail.com", "password2")):
+        auth.login(email, password)
+        response = client.delete(
+            "/api/book/cancel_appointment",
+            json={"appointment_id": 6},
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        assert response.status_code == 200
+    assert count_outbox_entries(cancel_appointment_task.name) == 2
+
+    assert relay_outbox(1) == 1
+    assert relay_outbox(10) == 1
+    assert relay_outbox(10) == 0
+    assert count_outbox_entries(cancel_appointment_task.name) == 0
+    assert count_deferred_jobs(cancel_appointment_task.name) == old_count + 2
+
+    records = db.session.execute(
+        text(
+            """
+            SELECT args, lock
+            FROM procrastinate_jobs
+            WHERE task_name = :task_name
+            ORDER BY id DESC
+            LIMIT 2;
+            """
+        ),
+        {"task_name": cancel_appointment_task.name},
+    ).fetchall()
+    assert [record[0]["user_id"] for record in records] == [2, 1]
+    # Both cancellations are for appointment 6, so they run one after the other, in the order they were made
+    assert [record[1] for record in records] == ["appointment-6", "appointment-6"]
+
+
+def test_get_scheduled_appointments_aggregation_matches(app, client, auth):
+    auth.login("alice@gmail.com", "password1")
+
+    responses = dict()
+    for aggregation in ("postgres", "python"):
+        app.config["APPOINTMENT_LISTING_AGGREGATION"] = aggregation
+        response = client.get(
+            "/api/book/get_scheduled_appointments",
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        assert response.status_code == 200
+        responses[aggregation] = response.json
+
+    assert len(responses["postgres"]["appointments"]) == 1
+    assert responses["postgres"] == responses["python"]
+
+
+def read_feed_event(stream, event: str, max_chunks: int = 10) -> str | None:
+    for _ in range(max_chunks):
+        chunk = next(stream).decode("utf8")
+        if chunk.startswith(f"event: {event}\n"):
+            return chunk
+
+    return None
+
+
+def test_availability_feed_streams_slot_changes(client):
+    response = client.get(
+        "/api/book/get_availability_feed",
+        query_string={"start_date": "2025-08-01", "end_date": "2025-08-02"},
+        buffered=False,
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+
+    stream = iter(response.response)
+    assert next(stream) == b"retry: 5000\n\n"
+    assert availability_feed.wait_until_listening(5)
+
+    # A slot on another day, which the feed should skip, then a booking on the first slot
+    db.session.execute(
+        text("UPDATE AppointmentTimeSlots SET capacity = 6 WHERE appointmentID = 4;")
+    )
+    db.session.commit()
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Bookings
+            (appointmentID, userID, bookingTimestamp, comments, pending)
+            VALUES
+            (1, 6, CURRENT_TIMESTAMP, '', FALSE);
+            """
+        )
+    )
+    db.session.commit()
+
+    chunk = read_feed_event(stream, "slot")
+    assert chunk is not None
+    change = json.loads(chunk.split("data: ", 1)[1])
+    assert change["appointment_id"] == 1
+    assert change["date"] == "2025-08-01"
+    assert change["slots_booked"] == 1
+    assert change["capacity"] == 3
+    assert not change["deleted"]
+
+    response.close()
+    assert availability_feed.stats()["subscribers"] == 0
+
+
+def test_availability_feed_resyncs_slow_subscribers(app):
+    availability_feed.queue_size = 1
+    subscription = availability_feed.subscribe()
+    try:
+        change = {"appointment_id": 1, "date": "2025-08-01", "slots_booked": 1}
+        availability_feed.publish(change)
+        assert not subscription.resync
+        availability_feed.publish(change)
+        assert subscription.resync
+    finally:
+        availability_feed.unsubscribe(subscription)
+
+
+def test_availability_feed_delivers_to_event_loops(app):
+    async def receive_published_change():
+        subscription = availability_feed.subscribe(asyncio.get_running_loop())
+        try:
+            change = {"appointment_id": 1, "date": "2025-08-01", "slots_booked": 1}
+            # The listener thread publishes, so this does too
+            await asyncio.to_thread(availability_feed.publish, change)
+            return await asyncio.wait_for(subscription.changes.get(), 5)
+        finally:
+            availability_feed.unsubscribe(subscription)
+
+    assert asyncio.run(receive_published_change())["appointment_id"] == 1
+    assert availability_feed.stats()["subscribers"] == 0
+
+
+# A subscriber failing even while being told to resync shouldn't stop the listener for everyone else
+def test_availability_feed_survives_failing_subscribers(app):
+    class FailingSubscription(Subscription):
+        def __init__(self):
+            super().__init__(10, lambda: None)
+            self.failures = 2
+
+        def deliver(self, change: dict | None):
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError("Subscriber failed")
+            super().deliver(change)
+
+    subscription = availability_feed.subscribe()
+    failing = FailingSubscription()
+    with availability_feed._lock:
+        availability_feed._subscribers.add(failing)
+    try:
+        assert availability_feed.wait_until_listening(5)
+        reconnects = availability_feed.stats()["reconnects"]
+
+        db.session.execute(text("UPDATE AppointmentTimeSlots SET capacity = 6 WHERE appointmentID = 1;"))
+        db.session.commit()
+        # Changes made before the listener has reconnected are covered by telling everyone to resync, so keep making
+        # them until one is heard
+        heard = None
+        for capacity in range(7, 37):
+            db.session.execute(
+                text("UPDATE AppointmentTimeSlots SET capacity = :capacity WHERE appointmentID = 1;"),
+                {"capacity": capacity},
+            )
+            db.session.commit()
+            try:
+                while heard is None or heard["capacity"] != capacity:
+                    heard = subscription.changes.get(timeout=0.5)
+                break
+            except Empty:
+                pass
+
+        assert heard is not None and heard["capacity"] == capacity
+        assert availability_feed.stats()["reconnects"] > reconnects
+        assert subscription.resync
+    finally:
+        availability_feed.unsubscribe(failing)
+        availability_feed.unsubscribe(subscription)
+
+
+def test_availability_feed_subscriber_limit(client):
+    availability_feed.max_subscribers = 0
+
+    response = client.get(
+        "/api/book/get_availability_feed",
+        query_string={"start_date": "2025-08-01", "end_date": "2025-08-02"},
+    )
+    assert response.status_code == 503
+
+
+# Serves each connection on one of a fixed number of threads, like a gunicorn gthread worker
+class FixedThreadsServer(BaseWSGIServer):
+    def __init__(self, app, threads: int):
+        super().__init__("127.0.0.1", 0, app)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.handle_connection, request, client_address)
+
+    def handle_connection(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def test_availability_feeds_leave_threads_for_other_requests(app):
+    threads = app.config["WSGI_THREADS"]
+    server = FixedThreadsServer(app, threads)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.port}/api/book"
+
+    feeds = []
+    try:
+        # As many feeds as there are threads, which would take every one of them without the cap
+        for _ in range(threads):
+            feeds.append(
+                requests.get(
+                    f"{url}/get_availability_feed",
+                    params={"start_date": "2025-08-01", "end_date": "2025-08-02"},
+                    stream=True,
+                    timeout=5,
+                )
+            )
+        statuses = [feed.status_code for feed in feeds]
+        assert statuses.count(200) == app.config["AVAILABILITY_FEED_MAX_THREAD_SUBSCRIBERS"]
+        assert statuses.count(503) == threads - statuses.count(200)
+
+        response = requests.get(
+            f"{url}/get_available_appointments",
+            params={"start_date": "2025-08-01", "end_date": "2025-08-02"},
+            timeout=5,
+        )
+        assert response.status_code == 200
+    finally:
+        for feed in feeds:
+            feed.close()
+        server.shutdown()
+        server.executor.shutdown(wait=False, cancel_futures=True)
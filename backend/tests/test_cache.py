@@ -0,0 +1,85 @@
+from app.availability import AvailabilityCache
+from app.cache import Cache, MemoryCache
+from datetime import date
+import asyncio
+import pytest
+import time
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_cache_expires_entries():
+    cache = MemoryCache(max_size=2, ttl=0.05)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_memory_cache_delete():
+    cache = MemoryCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.delete("a")
+    cache.delete("a")
+    assert cache.get("a") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_cache_backend_missing_methods_fails_at_construction():
+    class GetOnlyCache(Cache):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyCache()
+
+
+def test_availability_cache_async_range_matches_sync():
+    appointments = [
+        {"appointment_id": 1, "date": "2025-08-01", "hour_24": 10},
+        {"appointment_id": 2, "date": "2025-08-03", "hour_24": 9},
+    ]
+    loads = []
+
+    def load_appointments(start_date: date, end_date: date) -> list[dict]:
+        loads.append((start_date, end_date))
+        return [
+            appointment
+            for appointment in appointments
+            if str(start_date) <= appointment["date"] < str(end_date)
+        ]
+
+    async def load_appointments_async(start_date: date, end_date: date) -> list[dict]:
+        return load_appointments(start_date, end_date)
+
+    sync_cache = AvailabilityCache()
+    sync_cache.cache = MemoryCache(max_size=16, ttl=60)
+    sync_cache.max_days = 7
+    async_cache = AvailabilityCache()
+    async_cache.cache = MemoryCache(max_size=16, ttl=60)
+    async_cache.max_days = 7
+
+    start = date(2025, 8, 1)
+    end = date(2025, 8, 4)
+    day_versions = {"2025-08-01": 3}
+    expected = sync_cache.get_range(start, end, day_versions, load_appointments)
+    actual = asyncio.run(async_cache.get_range_async(start, end, day_versions, load_appointments_async))
+    assert actual == expected
+    assert loads == [(start, end), (start, end)]
+
+    # Every day in the range is cached now, including the empty one
+    assert asyncio.run(async_cache.get_range_async(start, end, day_versions, load_appointments_async)) == expected
+    assert len(loads) == 2
@@ -0,0 +1,204 @@
+from app.db import db
+from app.emails import (
+    EmailTransport,
+    FakeTransport,
+    book_appointment_confirmation_email,
+    email_sender,
+    queue_emails,
+)
+from sqlalchemy import text
+import pytest
+
+
+def confirmation_emails(count: int) -> list[dict]:
+    return [
+        book_appointment_confirmation_email(f"user{n}@example.com", f"User {n}", "2025-08-01", "9:00")
+        for n in range(count)
+    ]
+
+
+def pending_emails() -> list[dict]:
+    return (
+        db.session.execute(
+            text(
+                """
+                SELECT email->>'to' AS address, failedReason AS failed_reason
+                FROM PendingEmails
+                ORDER BY emailID ASC;
+                """
+            )
+        )
+        .mappings()
+        .fetchall()
+    )
+
+
+def test_email_sender_sends_in_batches(app):
+    queue_emails(confirmation_emails(150))
+    db.session.commit()
+
+    assert email_sender.send_all() == 150
+
+    assert [len(batch) for batch in email_sender.transport.batches] == [100, 50]
+    assert len(email_sender.transport.sent) == 150
+    assert pending_emails() == []
+    stats = email_sender.stats()
+    assert stats["sent"] == 150
+    assert stats["batches"] == 2
+    assert stats["pending"] == 0
+
+
+# The emails are only there to send once the transaction that queued them commits
+def test_email_sender_skips_rolled_back_emails(app):
+    queue_emails(confirmation_emails(1))
+    db.session.rollback()
+
+    assert email_sender.send_all() == 0
+    assert email_sender.transport.sent == []
+
+
+def test_email_sender_keeps_rejected_emails(app):
+    email_sender.transport.rejected_addresses = {"user1@example.com"}
+    queue_emails(confirmation_emails(3))
+    db.session.commit()
+
+    assert email_sender.send_all() == 3
+
+    assert [email["to"] for email in email_sender.transport.sent] == ["user0@example.com", "user2@example.com"]
+    rejected = pending_emails()
+    assert [email["address"] for email in rejected] == ["user1@example.com"]
+    assert "user1@example.com" in rejected[0]["failed_reason"]
+    assert email_sender.stats()["failed"] == 1
+    # Rejected emails aren't tried again
+    assert email_sender.send_all() == 0
+
+
+def test_email_sender_keeps_emails_when_the_request_fails(app):
+    email_sender.backoff_seconds = 0
+    email_sender.transport.fail_next = 1
+    queue_emails(confirmation_emails(2))
+    db.session.commit()
+
+    assert email_sender.send_all() == 2
+    assert email_sender.transport.sent == []
+    assert [email["failed_reason"] for email in pending_emails()] == [None, None]
+    assert email_sender.stats()["retries"] == 1
+
+    assert email_sender.send_all() == 2
+    assert len(email_sender.transport.sent) == 2
+    assert pending_emails() == []
+
+
+def test_email_sender_backs_off_after_a_failed_request(app):
+    email_sender.transport.fail_next = 1
+    queue_emails(confirmation_emails(1))
+    db.session.commit()
+
+    email_sender.send_all()
+    next_attempt = db.session.execute(
+        text("SELECT nextAttemptAt > LOCALTIMESTAMP, claimedAt IS NULL FROM PendingEmails;")
+    ).fetchone()
+    assert tuple(next_attempt) == (True, True)
+    # Not due again yet
+    assert email_sender.send_all() == 0
+
+
+def test_email_sender_gives_up_after_max_attempts(app):
+    email_sender.backoff_seconds = 0
+    email_sender.max_attempts = 2
+    email_sender.transport.fail_next = 2
+    queue_emails(confirmation_emails(1))
+    db.session.commit()
+
+    email_sender.send_all()
+    email_sender.send_all()
+
+    assert [email["failed_reason"] for email in pending_emails()] == ["Fake transport failure"]
+    assert email_sender.send_all() == 0
+    assert email_sender.transport.sent == []
+
+
+# The batch is claimed and committed before the request, so nothing is locked while waiting on the email API
+def test_email_sender_sends_without_locking_rows(app):
+    locked = []
+
+    class LockCheckingTransport(FakeTransport):
+        def send_batch(self, emails: list[dict], idempotency_key: str) -> dict[int, str]:
+            with db.engine.connect() as connection:
+                records = connection.execute(
+                    text("SELECT claimedAt IS NOT NULL FROM PendingEmails FOR UPDATE NOWAIT;")
+                ).fetchall()
+                locked.append([record[0] for record in records])
+            return super().send_batch(emails, idempotency_key)
+
+    email_sender.transport = LockCheckingTransport()
+    queue_emails(confirmation_emails(2))
+    db.session.commit()
+
+    assert email_sender.send_all() == 2
+    assert locked == [[True, True]]
+
+
+# Emails claimed by a sender that died before settling them are sent once the claim runs out
+def test_email_sender_takes_over_expired_claims(app):
+    queue_emails(confirmation_emails(1))
+    db.session.execute(text("UPDATE PendingEmails SET claimedAt = LOCALTIMESTAMP, attempts = 1;"))
+    db.session.commit()
+    assert email_sender.send_all() == 0
+
+    db.session.execute(text("UPDATE PendingEmails SET claimedAt = LOCALTIMESTAMP - INTERVAL '1' HOUR;"))
+    db.session.commit()
+    assert email_sender.send_all() == 1
+    assert len(email_sender.transport.sent) == 1
+
+
+# A request refused as a whole for something wrong with one email is sent again one email at a time, so only that
+# one fails
+def test_email_sender_isolates_emails_that_fail_the_request(app):
+    class OneBadEmailTransport(FakeTransport):
+        def send_batch(self, emails: list[dict], idempotency_key: str) -> dict[int, str]:
+            if any(email["to"] == "user1@example.com" for email in emails):
+                raise ValueError("Invalid email")
+            return super().send_batch(emails, idempotency_key)
+
+    email_sender.transport = OneBadEmailTransport()
+    queue_emails(confirmation_emails(3))
+    db.session.commit()
+
+    assert email_sender.send_all() == 3
+
+    assert [email["to"] for email in email_sender.transport.sent] == ["user0@example.com", "user2@example.com"]
+    assert [dict(email) for email in pending_emails()] == [
+        {"address": "user1@example.com", "failed_reason": "Invalid email"}
+    ]
+
+
+def test_email_sender_reuses_idempotency_keys(app):
+    keys = []
+
+    class RecordingTransport(FakeTransport):
+        def send_batch(self, emails: list[dict], idempotency_key: str) -> dict[int, str]:
+            keys.append(idempotency_key)
+            return super().send_batch(emails, idempotency_key)
+
+    email_sender.transport = RecordingTransport()
+    email_sender.transport.fail_next = 1
+    email_sender.backoff_seconds = 0
+    queue_emails(confirmation_emails(2))
+    db.session.commit()
+
+    email_sender.send_all()
+    email_sender.send_all()
+
+    assert len(keys) == 2
+    assert keys[0] == keys[1]
+
+
+def test_email_transport_needs_every_method():
+    class PartialTransport(EmailTransport):
+        def send_batch(self, emails: list[dict], idempotency_key: str) -> dict[int, str]:
+            return {}
+
+    with pytest.raises(TypeError):
+        PartialTransport()
+
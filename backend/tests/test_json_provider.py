@@ -0,0 +1,69 @@
+from app.json_provider import (
+    JSONFragment,
+    StdlibJSONProvider,
+    OrjsonJSONProvider,
+    orjson,
+)
+from datetime import date, datetime
+from flask import Flask
+import json
+import pytest
+
+
+def json_providers():
+    # orjson is optional, so its provider is only tested where it's installed
+    if orjson is None:
+        return [StdlibJSONProvider]
+
+    return [StdlibJSONProvider, OrjsonJSONProvider]
+
+
+@pytest.mark.parametrize("provider_class", json_providers())
+def test_json_provider_encodes_dates_as_iso(provider_class):
+    provider = provider_class(Flask(__name__))
+
+    encoded = provider.dumps(
+        {"date": date(2025, 8, 1), "timestamp": datetime(2025, 8, 1, 9, 30)}
+    )
+    assert json.loads(encoded) == {
+        "date": "2025-08-01",
+        "timestamp": "2025-08-01T09:30:00",
+    }
+
+
+@pytest.mark.parametrize("provider_class", json_providers())
+def test_json_provider_writes_fragments_as_is(provider_class):
+    provider = provider_class(Flask(__name__))
+
+    encoded = provider.dumps(
+        {
+            "appointments": JSONFragment('[{"appointment_id": 1, "bookings": []}]'),
+            "next_cursor": JSONFragment(b"null"),
+            "note": "json-fragment-0",
+        }
+    )
+    assert json.loads(encoded) == {
+        "appointments": [{"appointment_id": 1, "bookings": []}],
+        "next_cursor": None,
+        "note": "json-fragment-0",
+    }
+
+
+@pytest.mark.parametrize("provider_class", json_providers())
+def test_json_provider_response(provider_class):
+    app = Flask(__name__)
+    app.json = provider_class(app)
+
+    with app.app_context():
+        response = app.json.response({"appointments": JSONFragment("[]")})
+
+    assert response.mimetype == "application/json"
+    assert app.json.loads(response.get_data()) == {"appointments": []}
+
+
+@pytest.mark.parametrize("provider_class", json_providers())
+def test_json_provider_sorts_keys_like_flask(provider_class):
+    provider = provider_class(Flask(__name__))
+
+    encoded = provider.dumps({"slots_booked": 1, "appointment_id": 2, "capacity": {"b": 1, "a": 2}})
+    assert encoded == '{"appointment_id":2,"capacity":{"a":2,"b":1},"slots_booked":1}'
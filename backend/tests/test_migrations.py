@@ -0,0 +1,118 @@
+import pytest
+from app.db import db
+from app.migrate import apply_migrations, get_migrations
+from sqlalchemy import event, text
+
+# Tables that grow with usage; small lookup tables like UserRoles are allowed to be sequentially scanned
+INDEXED_TABLES = {"users", "appointmenttimeslots", "bookings"}
+
+# 100k users and 100k time slots (one per hour starting in 2000) with 10 bookings each, for 1M bookings total
+_seed_sql = """
+INSERT INTO Users
+(name, email, passwordSaltedHashed)
+SELECT 'Seeded User ' || i, 'seeded' || i || '@example.com', (SELECT passwordSaltedHashed FROM Users WHERE userID = 6)
+FROM generate_series(0, 99999) AS i;
+
+INSERT INTO AppointmentTimeSlots
+(date, hour24, capacity)
+SELECT DATE '2000-01-01' + i / 24, i % 24, 20
+FROM generate_series(0, 99999) AS i;
+
+INSERT INTO Bookings
+(appointmentID, userID, bookingTimestamp, comments, pending)
+SELECT 11 + i / 10, 8 + (i * 7) % 100000, CURRENT_TIMESTAMP, '', FALSE
+FROM generate_series(0, 999999) AS i;
+
+ANALYZE;
+"""
+
+
+def find_seq_scans(plan: dict) -> list[str]:
+    seq_scans = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in INDEXED_TABLES:
+        seq_scans.append(plan.get("Relation Name"))
+    for subplan in plan.get("Plans", []):
+        seq_scans.extend(find_seq_scans(subplan))
+
+    return seq_scans
+
+
+def test_migrations_are_recorded(app):
+    versions = [
+        record[0]
+        for record in db.session.execute(
+            text("SELECT version FROM SchemaMigrations ORDER BY version ASC;")
+        ).fetchall()
+    ]
+    assert versions == [migration.version for migration in get_migrations()]
+
+
+def test_apply_migrations_twice(app):
+    assert apply_migrations() == []
+
+
+@pytest.mark.slow
+def test_endpoint_queries_do_not_seq_scan(app, client, auth):
+    db.session.execute(text(_seed_sql))
+    db.session.commit()
+
+    statements: list[tuple[str, dict]] = []
+
+    def capture_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", capture_statement)
+    try:
+        client.get(
+            "/api/book/get_available_appointments",
+            query_string={"start_date": "2005-06-06", "end_date": "2005-06-13"},
+        )
+        auth.login("alice@gmail.com", "password1")
+        client.get(
+            "/api/book/get_scheduled_appointments",
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        client.get(
+            "/api/auth/get_user_info",
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        client.post(
+            "/api/book/book_new_appointment",
+            json={
+                "appointment_id": 1,
+                "subject": "English",
+                "location": "Building Z",
+                "comments": "",
+            },
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        client.delete(
+            "/api/book/cancel_appointment",
+            json={"appointment_id": 6},
+            headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+        )
+        auth.login("testadmin@gmail.com", "password7")
+        for query_string in (
+            {"start_date": "2005-06-06", "end_date": "2005-06-13"},
+            {"start_date": "2005-06-06", "end_date": "2005-06-13", "format": "ndjson"},
+            {"start_date": "2005-06-06", "end_date": "2005-07-06", "limit": 50, "after": "2005-06-08_10_47000"},
+        ):
+            client.get(
+                "/api/admin/get_all_appointments",
+                query_string=query_string,
+                headers={"X-CSRF-TOKEN": auth.csrf_access_token()},
+            ).get_data()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture_statement)
+
+    assert len(statements) > 0
+    for statement, parameters in statements:
+        if statement.lstrip().upper().startswith(("COMMIT", "ROLLBACK")):
+            continue
+
+        plan = (
+            db.session.connection()
+            .exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+            .fetchone()[0][0]["Plan"]
+        )
+        assert find_seq_scans(plan) == [], statement
@@ -0,0 +1,47 @@
+from app.passwords import PasswordHasher, PasswordHasherSaturated
+import pytest
+import time
+
+
+def test_password_hasher_pool():
+    password_hasher = PasswordHasher()
+    password_hasher.rounds = 4
+    password_hasher.pool_size = 1
+
+    try:
+        password_hashed = password_hasher.hash_password("password")
+        assert password_hashed.startswith(b"$2b$04$")
+        assert password_hasher.check_password("password", password_hashed)
+        assert not password_hasher.check_password("wrong password", password_hashed)
+        assert password_hasher.stats()["completed"] == 3
+    finally:
+        password_hasher.shutdown()
+
+
+def test_password_hasher_timeout_keeps_slot_until_done():
+    password_hasher = PasswordHasher()
+    password_hasher.pool_size = 1
+
+    try:
+        # Started once so the pool's process is already up when the timed call is made
+        password_hasher._run(time.sleep, 0)
+        password_hasher.timeout_seconds = 0.05
+        with pytest.raises(PasswordHasherSaturated):
+            password_hasher._run(time.sleep, 1)
+        assert password_hasher.stats()["timed_out"] == 1
+
+        # The timed out call is still running, and with it holding the only slot the next one is turned away
+        with pytest.raises(PasswordHasherSaturated):
+            password_hasher._run(time.sleep, 0)
+        assert password_hasher.stats()["rejected"] == 1
+    finally:
+        password_hasher.shutdown()
+
+
+def test_needs_rehash():
+    password_hasher = PasswordHasher()
+    password_hasher.rounds = 12
+
+    assert not password_hasher.needs_rehash(b"$2b$12$" + b"a" * 53)
+    assert password_hasher.needs_rehash(b"$2b$04$" + b"a" * 53)
+    assert password_hasher.needs_rehash(b"not a bcrypt hash")
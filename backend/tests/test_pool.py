@@ -0,0 +1,102 @@
+from app.config import ProductionConfig
+from app.pool import pool_monitor
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from threading import Thread
+import pytest
+import time
+
+
+def create_saturated_engine(app):
+    engine_options = {
+        **app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+        "pool_size": 1,
+        "max_overflow": 0,
+        "pool_timeout": 0.5,
+    }
+    return create_engine(app.config["SQLALCHEMY_DATABASE_URI"], **engine_options)
+
+
+def test_pool_queues_checkouts_when_saturated(app):
+    engine = create_saturated_engine(app)
+    checkouts = pool_monitor.stats()["checkouts"]
+    timeouts = pool_monitor.stats()["timeouts"]
+    waited = []
+
+    def checkout():
+        start = time.perf_counter()
+        with engine.connect() as connection:
+            waited.append(time.perf_counter() - start)
+            connection.execute(text("SELECT 1;"))
+
+    try:
+        with engine.connect():
+            # The only connection is taken, so this one queues until it's returned
+            waiter = Thread(target=checkout)
+            waiter.start()
+            time.sleep(0.2)
+            assert len(waited) == 0
+
+        waiter.join(5)
+        assert len(waited) == 1
+        assert waited[0] >= 0.2
+
+        with engine.connect():
+            with pytest.raises(PoolTimeoutError):
+                engine.connect()
+    finally:
+        engine.dispose()
+
+    stats = pool_monitor.stats()
+    assert stats["checkouts"] == checkouts + 3
+    assert stats["timeouts"] == timeouts + 1
+    assert stats["wait_seconds_buckets"]["0.5"] >= 1
+
+
+def test_pool_reports_connections_held_too_long(app):
+    engine = create_saturated_engine(app)
+    pool_monitor.leak_seconds = 0.1
+    leaks = pool_monitor.stats()["leaks"]
+
+    try:
+        with engine.connect():
+            time.sleep(0.2)
+            assert len(pool_monitor.stats()["held_too_long"]) == 1
+
+        assert pool_monitor.stats()["leaks"] == leaks + 1
+        assert pool_monitor.stats()["held_too_long"] == []
+    finally:
+        engine.dispose()
+
+
+def test_statement_timeout(app):
+    engine = create_engine(
+        app.config["SQLALCHEMY_DATABASE_URI"],
+        **{
+            **app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+            "connect_args": {"options": "-c statement_timeout=100"},
+        },
+    )
+
+    try:
+        with engine.connect() as connection:
+            with pytest.raises(OperationalError, match="statement timeout"):
+                connection.execute(text("SELECT pg_sleep(1);"))
+    finally:
+        engine.dispose()
+
+
+# The budget worked out above ProductionConfig, from the settings it's made of, with 10 connections left for psql
+# and migrations
+def test_production_connection_budget():
+    config = ProductionConfig()
+    jobs = sum(config.WORKER_QUEUE_CONCURRENCY.values())
+    # Every running job holds a connection from the worker process' own pool
+    assert jobs <= config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW
+
+    gunicorn_process = config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW + 1
+    uvicorn_process = gunicorn_process + config.ASYNC_DB_POOL_SIZE + config.ASYNC_DB_MAX_OVERFLOW
+    # The supervisor's outbox relay and email sender each use one connection to listen and one to work
+    worker = config.WORKER_PROCESSES * (jobs + config.WORKER_DB_POOL_SIZE) + 2 + 2
+    for web_process in (gunicorn_process, uvicorn_process):
+        assert config.WEB_PROCESSES * web_process + worker <= 100 - 3 - 10
@@ -0,0 +1,115 @@
+from app.config import ProductionConfig, config_from_env
+from app.db import db
+from app.ratelimit import login_rate_limiter, MemorySlidingWindowStore, PostgresSlidingWindowStore, RateLimiter
+from sqlalchemy import text
+from werkzeug.middleware.proxy_fix import ProxyFix
+import time
+
+
+def test_memory_sliding_window_store():
+    store = MemorySlidingWindowStore()
+
+    assert store.hit("login_email", "alice@gmail.com", 2, 60)
+    assert store.hit("login_email", "alice@gmail.com", 2, 60)
+    assert not store.hit("login_email", "alice@gmail.com", 2, 60)
+    assert store.hit("login_email", "bob@gmail.com", 2, 60)
+    assert store.hit("login_ip", "alice@gmail.com", 2, 60)
+
+
+def test_memory_sliding_window_store_expires_hits():
+    store = MemorySlidingWindowStore()
+
+    assert store.hit("login_ip", "127.0.0.1", 1, 0.05)
+    assert not store.hit("login_ip", "127.0.0.1", 1, 0.05)
+    time.sleep(0.1)
+    assert store.hit("login_ip", "127.0.0.1", 1, 0.05)
+
+
+def test_rate_limiter_stats():
+    rate_limiter = RateLimiter("login_ip", 1, 60, MemorySlidingWindowStore())
+
+    assert rate_limiter.hit("127.0.0.1")
+    assert not rate_limiter.hit("127.0.0.1")
+    assert rate_limiter.stats() == {
+        "limit": 1,
+        "window_seconds": 60,
+        "allowed": 1,
+        "rejected": 1,
+    }
+
+
+def test_postgres_sliding_window_store(app):
+    store = PostgresSlidingWindowStore()
+
+    assert store.hit("login_email", "alice@gmail.com", 2, 60)
+    assert store.hit("login_email", "alice@gmail.com", 2, 60)
+    assert not store.hit("login_email", "alice@gmail.com", 2, 60)
+    assert store.hit("login_email", "bob@gmail.com", 2, 60)
+    assert store.hit("login_ip", "alice@gmail.com", 2, 60)
+
+    # Hits are committed on their own connection, so rolling back the request's transaction keeps them
+    db.session.rollback()
+    assert not store.hit("login_email", "alice@gmail.com", 2, 60)
+    record = db.session.execute(
+        text("SELECT COUNT(*) FROM RateLimitHits WHERE limiterName = 'login_email' AND limitKey = 'alice@gmail.com';")
+    ).fetchone()
+    assert record[0] == 2
+
+
+def test_postgres_sliding_window_store_expires_hits(app):
+    store = PostgresSlidingWindowStore()
+
+    assert store.hit("login_ip", "127.0.0.1", 1, 0.05)
+    assert not store.hit("login_ip", "127.0.0.1", 1, 0.05)
+    time.sleep(0.1)
+    assert store.hit("login_ip", "127.0.0.1", 1, 0.05)
+
+    # The expired hit was pruned by the one that replaced it
+    record = db.session.execute(
+        text("SELECT COUNT(*) FROM RateLimitHits WHERE limiterName = 'login_ip' AND limitKey = '127.0.0.1';")
+    ).fetchone()
+    assert record[0] == 1
+
+
+def test_production_config_from_env(monkeypatch):
+    monkeypatch.setenv("FLASK_ENV", "production")
+    config = config_from_env()
+    assert isinstance(config, ProductionConfig)
+    assert config.PROXY_FIX_X_FOR == 1
+
+
+# Behind Caddy every request comes from its address, so the limit has to be kept per forwarded client address
+def test_login_throttled_per_forwarded_ip(app, client):
+    # As create_app sets it up for ProductionConfig
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+    login_rate_limiter.ip_limiter.limit = 1
+
+    def login(forwarded_for: str):
+        return client.post(
+            "/api/auth/login",
+            json={"email": "alice@gmail.com", "password": "password1"},
+            headers={"X-Forwarded-For": forwarded_for},
+            environ_base={"REMOTE_ADDR": "10.0.0.2"},
+        )
+
+    assert login("203.0.113.1").status_code == 200
+    assert login("203.0.113.1").status_code == 429
+    assert login("203.0.113.2").status_code == 200
+
+
+def test_login_rejects_emails_that_are_not_strings(client):
+    for email in (42, None, ["alice@gmail.com"]):
+        response = client.post("/api/auth/login", json={"email": email, "password": "password1"})
+        assert response.status_code == 400
+
+
+# Keys in the shared store are limited in length, and login emails are throttled before they're validated
+def test_login_with_long_email_uses_postgres_store(app, client):
+    app.config["LOGIN_RATE_LIMIT_STORE"] = "postgres"
+    login_rate_limiter.init_app(app)
+    assert isinstance(login_rate_limiter.email_limiter.store, PostgresSlidingWindowStore)
+
+    response = client.post(
+        "/api/auth/login", json={"email": "a" * 1000 + "@gmail.com", "password": "password1"}
+    )
+    assert response.status_code == 400
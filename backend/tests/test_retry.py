@@ -0,0 +1,64 @@
+from app.retry import transaction_retrier
+from psycopg.errors import DeadlockDetected, SerializationFailure, UniqueViolation
+from sqlalchemy.exc import IntegrityError, OperationalError
+import pytest
+
+
+def failing_work(errors: list[Exception]):
+    attempts = []
+
+    def work() -> int:
+        attempts.append(len(attempts) + 1)
+        if len(errors) > 0:
+            raise errors.pop(0)
+        return len(attempts)
+
+    return work, attempts
+
+
+def test_retries_lost_races_until_they_succeed(app):
+    work, attempts = failing_work(
+        [
+            OperationalError("UPDATE", {}, SerializationFailure()),
+            OperationalError("UPDATE", {}, DeadlockDetected()),
+        ]
+    )
+
+    assert transaction_retrier.run("test_succeeds", work) == 3
+    assert attempts == [1, 2, 3]
+    stats = transaction_retrier.stats()["test_succeeds"]
+    assert stats["calls"] == 1
+    assert stats["attempts"] == 3
+    assert stats["retries"] == 2
+    assert stats["aborts"] == 0
+
+
+def test_gives_up_after_max_attempts(app):
+    work, attempts = failing_work(
+        [OperationalError("UPDATE", {}, SerializationFailure()) for _ in range(10)]
+    )
+
+    with pytest.raises(OperationalError):
+        transaction_retrier.run("test_gives_up", work)
+    assert len(attempts) == app.config["TRANSACTION_RETRY_ATTEMPTS"]
+    assert transaction_retrier.stats()["test_gives_up"]["aborts"] == 1
+
+
+def test_gives_up_at_the_deadline(app):
+    work, attempts = failing_work(
+        [OperationalError("UPDATE", {}, SerializationFailure()) for _ in range(10)]
+    )
+
+    with pytest.raises(OperationalError):
+        transaction_retrier.run("test_deadline", work, deadline_seconds=0)
+    assert attempts == [1]
+    assert transaction_retrier.stats()["test_deadline"]["aborts"] == 1
+
+
+def test_does_not_retry_other_errors(app):
+    work, attempts = failing_work([IntegrityError("INSERT", {}, UniqueViolation())])
+
+    with pytest.raises(IntegrityError):
+        transaction_retrier.run("test_other_errors", work)
+    assert attempts == [1]
+    assert transaction_retrier.stats()["test_other_errors"]["retries"] == 0
@@ -0,0 +1,209 @@
+from app.db import db
+from app.emails import email_sender
+from app.outbox import enqueue, relay_outbox
+from app.tasks import (
+    book_new_appointment_task,
+    cancel_appointment_task,
+    job_lock,
+    reconcile_slots_booked,
+    send_time_slot_removed_emails_task,
+)
+from app.worker import JobStats, run_in_app_context
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+import pytest
+import threading
+
+
+def get_slots_booked(appointment_id: int) -> int:
+    return db.session.execute(
+        text(
+            "SELECT slotsBooked FROM AppointmentTimeSlots WHERE appointmentID = :appointment_id;"
+        ),
+        {"appointment_id": appointment_id},
+    ).fetchone()[0]
+
+
+def test_slots_booked_follows_bookings(app):
+    assert get_slots_booked(6) == 2
+    assert get_slots_booked(2) == 1
+    assert get_slots_booked(1) == 0
+
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Bookings
+            (appointmentID, userID, bookingTimestamp, comments, pending)
+            VALUES
+            (1, 4, CURRENT_TIMESTAMP, '', FALSE);
+            """
+        )
+    )
+    assert get_slots_booked(1) == 1
+
+    db.session.execute(
+        text("DELETE FROM Bookings WHERE appointmentID = 6 AND userID = 2;")
+    )
+    assert get_slots_booked(6) == 1
+
+
+def test_reconcile_slots_booked(app):
+    db.session.execute(
+        text(
+            "UPDATE AppointmentTimeSlots SET slotsBooked = 5 WHERE appointmentID IN (1, 6);"
+        )
+    )
+
+    assert sorted(reconcile_slots_booked()) == [1, 6]
+    assert get_slots_booked(1) == 0
+    assert get_slots_booked(6) == 2
+    assert reconcile_slots_booked() == []
+
+
+def test_concurrent_jobs_get_their_own_sessions(app):
+    job_stats = JobStats()
+    barrier = threading.Barrier(2)
+    sessions = []
+
+    def job():
+        # Both jobs hold their session at the same time
+        sessions.append(db.session())
+        barrier.wait()
+
+    def failing_job():
+        raise ValueError("Job failed")
+
+    run_job = run_in_app_context(app, job, "bookings", job_stats)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda _: run_job(), range(2)))
+
+    assert len({id(session) for session in sessions}) == 2
+    assert db.session() not in sessions
+
+    with pytest.raises(ValueError):
+        run_in_app_context(app, failing_job, "bookings", job_stats)()
+
+    queues, _ = job_stats.take()
+    assert queues["bookings"]["succeeded"] == 2
+    assert queues["bookings"]["failed"] == 1
+    assert job_stats.take()[0] == {}
+
+
+def test_job_queue_metrics(client, auth):
+    auth.login("testadmin@gmail.com", "password7")
+
+    def get_bookings_queue() -> dict:
+        response = client.get(
+            "/api/admin/get_metrics", headers={"X-CSRF-TOKEN": auth.csrf_access_token()}
+        )
+        assert response.status_code == 200
+        return response.json["job_queues"].get("bookings", {"queued": 0, "running": 0, "lag_seconds": 0})
+
+    old_queued = get_bookings_queue()["queued"]
+
+    enqueue(cancel_appointment_task, appointment_id=6, user_id=1)
+    assert relay_outbox(10) == 1
+
+    bookings_queue = get_bookings_queue()
+    assert bookings_queue["queued"] == old_queued + 1
+    assert bookings_queue["lag_seconds"] >= 0
+
+
+def test_job_lock_is_per_appointment():
+    assert job_lock(book_new_appointment_task, {"appointment_id": 3, "user_id": 1}) == "appointment-3"
+    assert job_lock(cancel_appointment_task, {"appointment_id": 3, "user_id": 2}) == "appointment-3"
+    assert job_lock(cancel_appointment_task, {"appointment_id": 4, "user_id": 2}) == "appointment-4"
+    assert job_lock(send_time_slot_removed_emails_task, {"recipients": []}) is None
+
+
+def get_slot(appointment_id: int) -> dict:
+    return (
+        db.session.execute(
+            text(
+                """
+                SELECT leaderUserID AS leader_user_id, confirmationCode AS confirmation_code, subject, location
+                FROM AppointmentTimeSlots
+                WHERE appointmentID = :appointment_id;
+                """
+            ),
+            {"appointment_id": appointment_id},
+        )
+        .mappings()
+        .fetchone()
+    )
+
+
+def sent_to() -> list[str]:
+    email_sender.send_all()
+    return [email["to"] for email in email_sender.transport.sent]
+
+
+def test_book_new_appointment_task(app):
+    db.session.execute(
+        text(
+            """
+            INSERT INTO Bookings
+            (appointmentID, userID, bookingTimestamp, comments, pending)
+            VALUES
+            (1, 4, CURRENT_TIMESTAMP, '', TRUE);
+            """
+        )
+    )
+    db.session.commit()
+
+    book_new_appointment_task(
+        appointment_id=1, user_id=4, comments="Chapter 3", subject="English", location="Building Z"
+    )
+
+    slot = get_slot(1)
+    assert slot["leader_user_id"] == 4
+    assert len(slot["confirmation_code"]) == 6
+    assert (slot["subject"], slot["location"]) == ("English", "Building Z")
+    booking = db.session.execute(
+        text("SELECT comments, pending FROM Bookings WHERE appointmentID = 1 AND userID = 4;")
+    ).fetchone()
+    assert tuple(booking) == ("Chapter 3", False)
+    # Committed along with the booking, before anything tries to send it
+    email = db.session.execute(text("SELECT email->>'to' FROM PendingEmails;")).fetchall()
+    assert [tuple(record) for record in email] == [("daniel@gmail.com",)]
+    assert sent_to() == ["daniel@gmail.com"]
+
+
+def test_cancel_appointment_task_reassigns_leader(app):
+    # Alice leads appointment 6, and Bob booked it after her
+    cancel_appointment_task(appointment_id=6, user_id=1)
+
+    slot = get_slot(6)
+    assert slot["leader_user_id"] == 2
+    assert slot["confirmation_code"] not in (None, "387122")
+    assert (slot["subject"], slot["location"]) == ("Math", "Building B")
+
+    cancel_appointment_task(appointment_id=6, user_id=2)
+
+    slot = get_slot(6)
+    assert slot["leader_user_id"] is None
+    assert slot["confirmation_code"] is None
+    assert slot["subject"] is None
+    assert get_slots_booked(6) == 0
+    assert sent_to() == ["alice@gmail.com", "bob@gmail.com"]
+
+
+def test_cancel_appointment_task_keeps_leader(app):
+    cancel_appointment_task(appointment_id=6, user_id=2)
+
+    slot = get_slot(6)
+    assert slot["leader_user_id"] == 1
+    assert slot["confirmation_code"] == "387122"
+    assert get_slots_booked(6) == 1
+
+
+def test_cancel_appointment_task_twice(app):
+    cancel_appointment_task(appointment_id=6, user_id=2)
+    cancel_appointment_task(appointment_id=6, user_id=2)
+    # Nor for a user who never booked the slot
+    cancel_appointment_task(appointment_id=6, user_id=4)
+
+    slot = get_slot(6)
+    assert slot["leader_user_id"] == 1
+    assert get_slots_booked(6) == 1
+    assert sent_to() == ["bob@gmail.com"]
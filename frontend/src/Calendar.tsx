@@ -14,7 +14,12 @@ import {
 } from "./dates";
 import SiteNavbar from "./SiteNavbar";
 import { isRecord } from "./types";
-import { parseAppointments, type Appointment } from "./appointments";
+import {
+  parseAppointments,
+  parseAvailabilityChange,
+  applyAvailabilityChange,
+  type Appointment,
+} from "./appointments";
 import AppointmentList from "./AppointmentList";
 import "./Calendar.css";
 
@@ -34,6 +39,22 @@ function Calendar() {
       dateToString(start_date)
     )}&end_date=${encodeURIComponent(dateToString(end_date))}`;
     fetch(url).then(doGetAvailableAppointmentsResp).catch(doGetAvailableAppointmentsError);
+
+    // Other users' bookings are pushed as they happen instead of being polled for
+    const feed = new EventSource(
+      `/api/book/get_availability_feed?start_date=${encodeURIComponent(
+        dateToString(start_date)
+      )}&end_date=${encodeURIComponent(dateToString(end_date))}`
+    );
+    feed.addEventListener("slot", (event: MessageEvent) => {
+      const change = parseAvailabilityChange(JSON.parse(event.data));
+      setAppointmentsMap((map) => (map === undefined ? map : applyAvailabilityChange(map, change)));
+    });
+    feed.addEventListener("resync", () => {
+      fetch(url).then(doGetAvailableAppointmentsResp).catch(doGetAvailableAppointmentsError);
+    });
+
+    return () => feed.close();
   }, [date]);
 
   function doGetAvailableAppointmentsResp(res: Response): void {
@@ -144,7 +165,7 @@ function Calendar() {
 
     const appointments = appointments_map.get(dateToString(selected_date));
     if (appointments === undefined) {
-      console.error(`Error: Appointments for date ${dateToString(selected_date)} undefined`);
+      // The selected day can fill up while it's open
       return <></>;
     }
 
@@ -59,3 +59,49 @@ export const compareAppointments = (a: Appointment, b: Appointment): number => {
 
   return a.hour_24 - b.hour_24;
 };
+
+export type AvailabilityChange = {
+  appointment_id: number;
+  date: string;
+  hour_24: number;
+  capacity: number;
+  slots_booked: number;
+  deleted: boolean;
+};
+
+export const parseAvailabilityChange = (data: unknown): AvailabilityChange => {
+  const appointment = parseAppointment(data);
+  if (!isRecord(data) || typeof data.deleted !== "boolean") {
+    throw new Error("data.deleted is not a boolean");
+  }
+
+  return { ...appointment, deleted: data.deleted };
+};
+
+// Returns a copy of a date -> available appointments map with the change applied. Appointments that were deleted or
+// filled up are dropped, along with days left without any available appointments
+export const applyAvailabilityChange = (
+  map: Map<string, Appointment[]>,
+  change: AvailabilityChange
+): Map<string, Appointment[]> => {
+  const new_map = new Map<string, Appointment[]>();
+  for (const [date, appointments] of map) {
+    const remaining = appointments.filter((appointment) => appointment.appointment_id !== change.appointment_id);
+    if (remaining.length > 0) {
+      new_map.set(date, remaining);
+    }
+  }
+
+  if (!change.deleted && change.slots_booked < change.capacity) {
+    const appointment: Appointment = {
+      appointment_id: change.appointment_id,
+      date: change.date,
+      hour_24: change.hour_24,
+      capacity: change.capacity,
+      slots_booked: change.slots_booked,
+    };
+    new_map.set(change.date, [...(new_map.get(change.date) ?? []), appointment].sort(compareAppointments));
+  }
+
+  return new_map;
+};